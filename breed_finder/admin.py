@@ -1,11 +1,22 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import CustomUser, Pet, UserProfile
+from .models import Breed, BreedAlias, CustomUser, Pet, UserProfile
+
+class BreedAliasInline(admin.TabularInline):
+    model = BreedAlias
+    extra = 1
+
+@admin.register(Breed)
+class BreedAdmin(admin.ModelAdmin):
+    list_display = ('name', 'slug')
+    search_fields = ('name', 'slug', 'aliases__slug')
+    prepopulated_fields = {'slug': ('name',)}
+    inlines = (BreedAliasInline,)
 
 @admin.register(Pet)
 class PetAdmin(admin.ModelAdmin):
     list_display = ('name', 'breed', 'get_age_display', 'gender', 'status')
-    list_filter = ('status', 'gender', 'breed')
+    list_filter = ('status', 'gender', 'canonical_breed')
     search_fields = ('name', 'breed')
     
     def get_age_display(self, obj):
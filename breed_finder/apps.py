@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class BreedFinderConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "breed_finder"
+
+    def ready(self):
+        # Registers the SQLite connection hook (WAL, busy timeout, ...)
+        from breedchat import db  # noqa: F401
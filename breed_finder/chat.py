@@ -0,0 +1,164 @@
+"""
+Server-side breed identification for the chatbot.
+
+The chatbot used to run its fallback chain in the browser: check the model
+list, ask a vision model, retry with a simpler prompt, check the models again,
+then fall back to a text-only model. Each step was a separate round trip.
+``identify`` runs the same chain here. Every step has its own deadline, so
+one request returns one answer within a bounded time and records how long
+each step took.
+"""
+import asyncio
+import time
+
+from django.conf import settings
+
+from . import ollama, result_cache
+from .model_registry import get_inventory
+from .scheduler import get_scheduler
+
+SYSTEM_PROMPT = (
+    "You are a dog breed expert. Given a description, identify the breed of the dog accurately. "
+    "If unsure, ask for more info. Provide detailed information about the breed including temperament, "
+    "size, care needs, and common health issues."
+)
+
+IMAGE_PROMPT = (
+    "You are a dog breed identification expert. Your task is to analyze this image and identify the EXACT "
+    "breed of dog shown with high confidence. Be very specific and precise with the breed name. First, state "
+    "the breed name clearly. Then provide detailed information about this specific breed including: "
+    "distinctive physical characteristics, temperament traits, typical size and weight, special care "
+    "requirements, and common health issues. If you're not 100% certain about the breed, list the top 2-3 "
+    "most likely breeds in order of probability and explain your reasoning based on the specific visual "
+    "characteristics visible in this image such as coat type, color pattern, ear shape, muzzle length, body "
+    "structure, and any distinctive markings."
+)
+
+SIMPLE_IMAGE_PROMPT = (
+    "What specific breed of dog is shown in this image? Be very precise with the breed name. First, clearly "
+    "state the exact breed name. Then briefly describe the key physical characteristics that identify this "
+    "breed. If you're not certain, list the 2-3 most likely breeds in order of probability."
+)
+
+NO_VISION_PROMPT = (
+    "I'm trying to identify a dog breed from an image, but I can't process images directly. Please provide "
+    "information about common dog breeds including their distinctive features, temperament, size, care "
+    "needs, and health issues."
+)
+
+IMAGE_FAILED_PROMPT = (
+    "I'm trying to identify a dog breed from an image. Please help me identify what breed this dog might be "
+    "based on common characteristics. Provide detailed information about popular dog breeds including "
+    "temperament, size, care needs, and common health issues."
+)
+
+IMAGE_FAILED_PREFIX = (
+    "I encountered an issue analyzing your specific image. Please try uploading a clearer image of the dog, "
+    "preferably one that shows the full body and face clearly. In the meantime, here's some information "
+    "about common dog breeds: "
+)
+
+GAVE_UP_MESSAGE = (
+    "I'm having trouble analyzing your image. Please try uploading a clearer image of the dog, preferably "
+    "one that shows the full body and face clearly. This will help me identify the breed more accurately."
+)
+
+TEXT_FAILED_MESSAGE = 'Sorry, I encountered an error while processing your request. Please try again.'
+
+
+def description_prompt(message):
+    return (
+        f"Based on this description, identify the most likely dog breed(s): {message}. Please provide "
+        "detailed information about the breed including temperament, size, care needs, and common health "
+        "issues. If multiple breeds match the description, list them in order of likelihood and explain why."
+    )
+
+
+async def complete(payload):
+    """Run one generation through the result cache and scheduler and return its text."""
+    cached = await result_cache.get_result(payload)
+    if cached is not None:
+        return cached.get('response', '')
+    lines = [line async for line in get_scheduler().generation(payload).subscribe()]
+    return result_cache.combine_lines(lines).get('response', '')
+
+
+class Orchestration:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.steps = []
+
+    def remaining(self):
+        return settings.CHAT_DEADLINE - (time.monotonic() - self.started)
+
+    async def step(self, name, payload):
+        """Run one step within its deadline; return the answer, or None if it failed."""
+        timeout = min(settings.CHAT_STEP_TIMEOUT, self.remaining())
+        started = time.monotonic()
+        status, answer = 'ok', None
+        if timeout <= 0:
+            status = 'skipped'
+        else:
+            try:
+                answer = await asyncio.wait_for(complete(payload), timeout)
+                if not answer.strip():
+                    status, answer = 'empty', None
+            except asyncio.TimeoutError:
+                status = 'timeout'
+            except ollama.OllamaError as e:
+                if e.retry_after:
+                    # Ollama is saturated; falling back would only add more load
+                    raise
+                status = f'error: {e}'
+        self.steps.append({
+            'step': name,
+            'model': payload['model'],
+            'status': status,
+            'elapsed_ms': round((time.monotonic() - started) * 1000),
+        })
+        return answer
+
+    def result(self, answer, model=None):
+        return {
+            'response': answer,
+            'model': model,
+            'steps': self.steps,
+            'elapsed_ms': round((time.monotonic() - self.started) * 1000),
+        }
+
+
+async def identify(message='', images=None):
+    """Answer a chatbot message, running the vision and text fallbacks as needed."""
+    run = Orchestration()
+    text_model = settings.OLLAMA_TEXT_MODEL
+
+    if not images:
+        payload = {'model': text_model, 'prompt': description_prompt(message), 'system': SYSTEM_PROMPT}
+        answer = await run.step('describe', payload)
+        return run.result(answer or TEXT_FAILED_MESSAGE, text_model if answer else None)
+
+    inventory = await get_inventory()
+    vision_models = inventory['vision_models']
+    llava = next((name for name in vision_models if 'llava' in name.lower()), None)
+    vision_model = llava or (vision_models[0] if vision_models else None)
+
+    if vision_model is None:
+        payload = {'model': text_model, 'prompt': NO_VISION_PROMPT, 'system': SYSTEM_PROMPT}
+        answer = await run.step('no_vision_model', payload)
+        return run.result(answer or GAVE_UP_MESSAGE, text_model if answer else None)
+
+    answer = await run.step('identify', {'model': vision_model, 'prompt': IMAGE_PROMPT, 'images': images})
+    if answer:
+        return run.result(answer, vision_model)
+
+    if llava:
+        payload = {'model': llava, 'prompt': SIMPLE_IMAGE_PROMPT, 'images': images}
+        answer = await run.step('retry_simple_prompt', payload)
+        if answer:
+            return run.result(answer, llava)
+
+    payload = {'model': text_model, 'prompt': IMAGE_FAILED_PROMPT, 'system': SYSTEM_PROMPT}
+    answer = await run.step('text_fallback', payload)
+    if answer:
+        return run.result(IMAGE_FAILED_PREFIX + answer, text_model)
+    return run.result(GAVE_UP_MESSAGE)
@@ -1,6 +1,6 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
-from .models import CustomUser, Pet, UserProfile
+from .models import Breed, CustomUser, Pet, UserProfile
 
 class CustomUserCreationForm(UserCreationForm):
     email = forms.EmailField(required=True)
@@ -31,12 +31,17 @@ class PetForm(forms.ModelForm):
             'status': forms.Select(attrs={'class': 'form-select'}),
             'gender': forms.Select(attrs={'class': 'form-select'}),
             'name': forms.TextInput(attrs={'class': 'form-control'}),
-            'breed': forms.TextInput(attrs={'class': 'form-control'}),
+            'breed': forms.TextInput(attrs={'class': 'form-control', 'list': 'breed-options', 'autocomplete': 'off'}),
             'age_years': forms.NumberInput(attrs={'class': 'form-control', 'min': '0', 'placeholder': 'Years'}),
             'age_months': forms.NumberInput(attrs={'class': 'form-control', 'min': '0', 'max': '11', 'placeholder': 'Months'}),
             'price': forms.NumberInput(attrs={'class': 'form-control', 'step': '0.01'}),
         }
         
+    @property
+    def breed_names(self):
+        # Known canonical breeds, offered as autocomplete options for the breed field
+        return Breed.objects.values_list('name', flat=True)
+
     def clean_age_months(self):
         months = self.cleaned_data.get('age_months')
         if months is not None and (months < 0 or months > 11):
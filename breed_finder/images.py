@@ -0,0 +1,67 @@
+"""
+Image preprocessing for vision model requests.
+
+Uploaded photos are decoded with Pillow, downscaled to the model's input
+resolution, stripped of EXIF and re-encoded as a compact JPEG before they are
+sent to Ollama. Images are handled one at a time so at most one decoded frame
+is held in memory.
+"""
+import base64
+import binascii
+import io
+
+from django.conf import settings
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def decode_base64_image(value):
+    """Return the raw bytes of a base64 image, accepting data: URLs as sent by the browser."""
+    if not isinstance(value, str):
+        raise InvalidImage('Images must be base64 strings')
+    if value.startswith('data:'):
+        value = value.partition(',')[2]
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise InvalidImage(f'Invalid base64 image: {e}') from e
+
+
+def prepare_image(source, max_size=None, quality=None):
+    """
+    Downscale ``source`` (bytes or a file object) and return it as JPEG bytes.
+
+    For JPEGs, draft mode lets the decoder scale down while decoding, so a
+    large phone photo is never fully expanded in memory.
+    """
+    max_size = max_size or settings.OLLAMA_IMAGE_MAX_SIZE
+    quality = quality or settings.OLLAMA_IMAGE_QUALITY
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+
+    try:
+        with Image.open(source) as image:
+            image.draft('RGB', (max_size, max_size))
+            # Apply the EXIF orientation before the metadata is dropped
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=quality, optimize=True)
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise InvalidImage(f'Could not read image: {e}') from e
+    return output.getvalue()
+
+
+def prepare_images(images):
+    """Preprocess a list of base64 images or uploaded files into base64 JPEG strings."""
+    prepared = []
+    for image in images:
+        if isinstance(image, str):
+            image = decode_base64_image(image)
+        prepared.append(base64.b64encode(prepare_image(image)).decode())
+    return prepared
@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from breed_finder.models import CustomUser
+
+SESSION_ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+
+# The configuration before sessions were moved off the database
+BASELINE = {
+    'SESSION_ENGINE': SESSION_ENGINES['db'],
+    'CSRF_USE_SESSIONS': True,
+    'MESSAGE_STORAGE': 'django.contrib.messages.storage.fallback.FallbackStorage',
+}
+
+PAGES = ('breed_finder:landing', 'breed_finder:pet_list', 'breed_finder:user_profile')
+
+
+class Command(BaseCommand):
+    help = 'Measures database queries per authenticated page view for each session backend'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=30, help='Page views measured per backend')
+
+    def handle(self, *args, **options):
+        requests = max(1, options['requests'])
+        configs = [('db + CSRF in session (before)', BASELINE)] + [
+            (name, {'SESSION_ENGINE': engine, 'CSRF_USE_SESSIONS': False,
+                    'MESSAGE_STORAGE': 'django.contrib.messages.storage.cookie.CookieStorage'})
+            for name, engine in SESSION_ENGINES.items()
+        ]
+
+        self.stdout.write(f"{'backend':<32} {'queries/req':>12} {'session/req':>12} {'ms/req':>8}")
+        # The benchmark user and sessions are rolled back afterwards
+        with transaction.atomic():
+            user = CustomUser.objects.create(username='session-benchmark', email='session-benchmark@example.com')
+            for name, config in configs:
+                with override_settings(**config):
+                    queries, session_queries, elapsed = self.measure(user, requests)
+                self.stdout.write(
+                    f"{name:<32} {queries / requests:>12.2f} {session_queries / requests:>12.2f} "
+                    f"{elapsed * 1000 / requests:>8.2f}"
+                )
+            transaction.set_rollback(True)
+
+    def measure(self, user, requests):
+        client = Client(HTTP_HOST='localhost')
+        client.force_login(user)
+        urls = [reverse(page) for page in PAGES]
+        # Warm up: the first view creates the CSRF token and fills caches
+        for url in urls:
+            client.get(url)
+
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            for i in range(requests):
+                client.get(urls[i % len(urls)])
+            elapsed = time.perf_counter() - started
+        session_queries = sum('django_session' in query['sql'] for query in captured.captured_queries)
+        return len(captured.captured_queries), session_queries, elapsed
@@ -4,21 +4,36 @@ from breed_finder.models import CustomUser, UserProfile
 class Command(BaseCommand):
     help = 'Creates UserProfile objects for users that do not have one'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Profiles created per INSERT')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many profiles are missing')
+
     def handle(self, *args, **options):
-        users_without_profiles = []
-        for user in CustomUser.objects.all():
-            try:
-                # Try to access the profile
-                profile = user.profile
-            except UserProfile.DoesNotExist:
-                # If profile doesn't exist, add user to the list
-                users_without_profiles.append(user)
+        batch_size = max(1, options['batch_size'])
+        dry_run = options['dry_run']
 
-        self.stdout.write(self.style.SUCCESS(f"Found {len(users_without_profiles)} users without profiles"))
+        # Anti-join: users with no matching profile row
+        missing = CustomUser.objects.filter(profile__isnull=True).order_by('id')
+        total = missing.count()
+        self.stdout.write(self.style.SUCCESS(f"Found {total} users without profiles"))
+        if dry_run or not total:
+            return
 
-        # Create profiles for users without them
-        for user in users_without_profiles:
-            UserProfile.objects.create(user=user)
-            self.stdout.write(self.style.SUCCESS(f"Created profile for {user.email}"))
+        # Walk the ids in keyset batches so memory stays constant however
+        # many users there are
+        processed = 0
+        last_id = 0
+        while True:
+            ids = list(missing.filter(id__gt=last_id).values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            # ignore_conflicts covers profiles created concurrently by signups
+            UserProfile.objects.bulk_create(
+                [UserProfile(user_id=user_id) for user_id in ids], ignore_conflicts=True
+            )
+            # Rows skipped as conflicts are not reported apart, so this counts users, not inserts
+            processed += len(ids)
+            last_id = ids[-1]
+            self.stdout.write(f"Processed {processed}/{total} users")
 
-        self.stdout.write(self.style.SUCCESS("Done creating profiles!"))
\ No newline at end of file
+        self.stdout.write(self.style.SUCCESS("Done creating profiles!"))
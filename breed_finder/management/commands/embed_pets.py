@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from breed_finder.models import Pet
+from breed_finder.similarity import embed_image_field
+
+
+class Command(BaseCommand):
+    help = 'Computes photo embeddings for pets that do not have one yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Recompute every embedding, not just missing ones')
+        parser.add_argument('--batch-size', type=int, default=500, help='Pets read per query')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        pets = Pet.objects.exclude(image='').only('id', 'image').order_by('id')
+        if not options['all']:
+            pets = pets.filter(embedding__isnull=True)
+
+        # Keyset batches by id rather than one iterator, as the loop writes
+        # to the rows being read and SQLite cursors may then skip or repeat rows
+        embedded = failed = 0
+        last_id = 0
+        while True:
+            batch = list(pets.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            for pet in batch:
+                embedding = embed_image_field(pet.image)
+                if embedding is None:
+                    failed += 1
+                    self.stdout.write(self.style.WARNING(f"Could not read the photo of pet {pet.id} ({pet.image.name})"))
+                    continue
+                # A queryset update skips Pet.save and its breed lookup
+                Pet.objects.filter(id=pet.id).update(embedding=embedding)
+                embedded += 1
+            last_id = batch[-1].id
+
+        self.stdout.write(self.style.SUCCESS(f"Embedded {embedded} pet photos, {failed} could not be read"))
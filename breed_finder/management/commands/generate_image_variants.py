@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from breed_finder.images import InvalidImage
+from breed_finder.models import Pet, UserProfile
+from breed_finder.variants import generate_variants
+
+
+class Command(BaseCommand):
+    help = 'Renders the resized WebP/JPEG variants of existing pet photos and profile pictures'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Re-render variants that already exist')
+
+    def handle(self, *args, **options):
+        images = [
+            *Pet.objects.exclude(image='').values_list('image', flat=True),
+            *UserProfile.objects.exclude(profile_picture='').exclude(profile_picture=None)
+            .values_list('profile_picture', flat=True),
+        ]
+
+        written = failed = 0
+        for name in images:
+            try:
+                count = generate_variants(name, force=options['force'])
+            except (OSError, InvalidImage) as e:
+                failed += 1
+                self.stdout.write(self.style.WARNING(f"Skipped {name}: {e}"))
+                continue
+            written += count
+            if count:
+                self.stdout.write(f"Rendered {count} variants of {name}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {written} variants written for {len(images)} images, {failed} could not be read"
+        ))
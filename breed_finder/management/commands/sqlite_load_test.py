@@ -0,0 +1,100 @@
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from breedchat.db import apply_pragmas
+
+
+class Command(BaseCommand):
+    help = ('Runs concurrent reads and writes against a scratch SQLite file, first with SQLite defaults '
+            'and then with SQLITE_PRAGMAS, and reports throughput and "database is locked" errors')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help='Concurrent connections')
+        parser.add_argument('--seconds', type=float, default=3.0, help='Duration of each run')
+        parser.add_argument('--write-ratio', type=float, default=0.2, help='Share of operations that write')
+        parser.add_argument('--timeout', type=float, default=0.1,
+                            help='Seconds a connection waits on a lock before failing, the same for both runs')
+
+    def handle(self, *args, **options):
+        tuned = {**settings.SQLITE_PRAGMAS, 'busy_timeout': int(options['timeout'] * 1000)}
+        self.stdout.write(f"{'settings':<10} {'ops/s':>10} {'reads/s':>10} {'writes/s':>10} {'lock errors':>12}")
+        for name, pragmas in (('default', {}), ('tuned', tuned)):
+            # A fresh scratch database per run; the application database is never touched
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'load.sqlite3')
+                self.create_database(path, pragmas)
+                result = self.run_load(path, pragmas, options)
+            seconds = options['seconds']
+            attempts = result['reads'] + result['writes'] + result['errors']
+            self.stdout.write(
+                f"{name:<10} {(result['reads'] + result['writes']) / seconds:>10.0f} "
+                f"{result['reads'] / seconds:>10.0f} {result['writes'] / seconds:>10.0f} "
+                f"{result['errors']:>6} ({result['errors'] / max(attempts, 1):.1%})"
+            )
+
+    def connect(self, path, pragmas, timeout):
+        connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        apply_pragmas(connection.cursor(), pragmas)
+        return connection
+
+    def create_database(self, path, pragmas):
+        connection = self.connect(path, pragmas, 5)
+        connection.executescript('''
+            CREATE TABLE pet (id INTEGER PRIMARY KEY, status TEXT NOT NULL, views INTEGER NOT NULL DEFAULT 0);
+            CREATE INDEX pet_status ON pet (status);
+            CREATE TABLE payment (id INTEGER PRIMARY KEY, pet_id INTEGER NOT NULL, status TEXT NOT NULL);
+        ''')
+        connection.execute('BEGIN')
+        connection.executemany(
+            'INSERT INTO pet (status) VALUES (?)',
+            [(random.choice(('AVAILABLE', 'ADOPTED')),) for _ in range(1000)],
+        )
+        connection.execute('COMMIT')
+        connection.close()
+
+    def run_load(self, path, pragmas, options):
+        totals = {'reads': 0, 'writes': 0, 'errors': 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + options['seconds']
+
+        def worker():
+            connection = self.connect(path, pragmas, options['timeout'])
+            counts = {'reads': 0, 'writes': 0, 'errors': 0}
+            while time.monotonic() < deadline:
+                pet_id = random.randint(1, 1000)
+                try:
+                    if random.random() < options['write_ratio']:
+                        # Shaped like a payment callback: a short write transaction
+                        connection.execute('BEGIN')
+                        connection.execute('UPDATE pet SET views = views + 1 WHERE id = ?', (pet_id,))
+                        connection.execute("INSERT INTO payment (pet_id, status) VALUES (?, 'COMPLETED')", (pet_id,))
+                        connection.execute('COMMIT')
+                        counts['writes'] += 1
+                    else:
+                        # Shaped like a catalog page: a count and a page of rows
+                        connection.execute("SELECT count(*) FROM pet WHERE status = 'AVAILABLE'").fetchone()
+                        connection.execute('SELECT * FROM pet WHERE id >= ? LIMIT 20', (pet_id,)).fetchall()
+                        counts['reads'] += 1
+                except sqlite3.OperationalError as e:
+                    if 'locked' not in str(e) and 'busy' not in str(e):
+                        raise
+                    counts['errors'] += 1
+                    if connection.in_transaction:
+                        connection.execute('ROLLBACK')
+            connection.close()
+            with lock:
+                for key, value in counts.items():
+                    totals[key] += value
+
+        threads = [threading.Thread(target=worker) for _ in range(max(1, options['threads']))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return totals
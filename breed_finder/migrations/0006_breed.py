@@ -0,0 +1,45 @@
+# Generated by Django 5.0.2 on 2026-10-18 15:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("breed_finder", "0005_remove_pet_age_pet_age_months_pet_age_years"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Breed",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100)),
+                ("slug", models.SlugField(max_length=100, unique=True)),
+                ("aliases", models.JSONField(blank=True, default=list)),
+            ],
+            options={
+                "ordering": ["name"],
+            },
+        ),
+        migrations.AddField(
+            model_name="pet",
+            name="canonical_breed",
+            field=models.ForeignKey(
+                blank=True,
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="pets",
+                to="breed_finder.breed",
+            ),
+        ),
+    ]
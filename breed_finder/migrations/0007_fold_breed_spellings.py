@@ -0,0 +1,36 @@
+from collections import Counter, defaultdict
+
+from django.db import migrations
+from django.utils.text import slugify
+
+
+def fold_breed_spellings(apps, schema_editor):
+    Breed = apps.get_model("breed_finder", "Breed")
+    Pet = apps.get_model("breed_finder", "Pet")
+
+    # Group every spelling of a breed under its slug, e.g. "Golden Retriever",
+    # "golden retriever" and "Golden-Retriever" all fold to "golden-retriever"
+    spellings = defaultdict(Counter)
+    for breed in Pet.objects.values_list("breed", flat=True):
+        slug = slugify(breed.strip(), allow_unicode=True)
+        if slug:
+            spellings[slug][breed] += 1
+
+    for slug, counter in spellings.items():
+        # The most common spelling becomes the canonical name
+        name = counter.most_common(1)[0][0].strip()
+        aliases = sorted({spelling.strip() for spelling in counter} - {name})
+        breed, _ = Breed.objects.get_or_create(
+            slug=slug, defaults={"name": name, "aliases": aliases}
+        )
+        Pet.objects.filter(breed__in=list(counter)).update(canonical_breed=breed)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("breed_finder", "0006_breed"),
+    ]
+
+    operations = [
+        migrations.RunPython(fold_breed_spellings, migrations.RunPython.noop),
+    ]
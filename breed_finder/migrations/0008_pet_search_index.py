@@ -0,0 +1,77 @@
+from django.db import migrations
+
+FTS_TABLE = "breed_finder_pet_fts"
+VOCAB_TABLE = "breed_finder_pet_fts_vocab"
+
+CREATE_SQL = [
+    f"""
+    CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        name, breed, description,
+        content='breed_finder_pet', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    f"CREATE VIRTUAL TABLE {VOCAB_TABLE} USING fts5vocab({FTS_TABLE}, 'row')",
+    f"""
+    CREATE TRIGGER breed_finder_pet_fts_insert AFTER INSERT ON breed_finder_pet BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, name, breed, description)
+        VALUES (new.id, new.name, new.breed, new.description);
+    END
+    """,
+    f"""
+    CREATE TRIGGER breed_finder_pet_fts_delete AFTER DELETE ON breed_finder_pet BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, breed, description)
+        VALUES ('delete', old.id, old.name, old.breed, old.description);
+    END
+    """,
+    f"""
+    CREATE TRIGGER breed_finder_pet_fts_update AFTER UPDATE OF name, breed, description ON breed_finder_pet BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, breed, description)
+        VALUES ('delete', old.id, old.name, old.breed, old.description);
+        INSERT INTO {FTS_TABLE}(rowid, name, breed, description)
+        VALUES (new.id, new.name, new.breed, new.description);
+    END
+    """,
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS breed_finder_pet_fts_insert",
+    "DROP TRIGGER IF EXISTS breed_finder_pet_fts_delete",
+    "DROP TRIGGER IF EXISTS breed_finder_pet_fts_update",
+    f"DROP TABLE IF EXISTS {VOCAB_TABLE}",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+
+def fts5_supported(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA compile_options")
+        return "ENABLE_FTS5" in {row[0] for row in cursor.fetchall()}
+
+
+def create_search_index(apps, schema_editor):
+    # Only SQLite builds with FTS5 get the index; breed_finder.search falls
+    # back to substring filters everywhere else
+    connection = schema_editor.connection
+    if connection.vendor != "sqlite" or not fts5_supported(connection):
+        return
+    for sql in CREATE_SQL:
+        schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for sql in DROP_SQL:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("breed_finder", "0007_fold_breed_spellings"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.2 on 2026-10-18 15:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("breed_finder", "0008_pet_search_index"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="pet",
+            index=models.Index(
+                fields=["status", "-created_at", "-id"], name="pet_status_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="pet",
+            index=models.Index(fields=["-created_at", "-id"], name="pet_created_idx"),
+        ),
+    ]
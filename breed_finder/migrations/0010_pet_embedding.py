@@ -0,0 +1,17 @@
+# Generated by Django 5.0.2 on 2026-10-18 16:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("breed_finder", "0009_pet_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="pet",
+            name="embedding",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,77 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils.text import slugify
+
+
+def copy_aliases(apps, schema_editor):
+    Breed = apps.get_model("breed_finder", "Breed")
+    BreedAlias = apps.get_model("breed_finder", "BreedAlias")
+
+    # Alias slugs are unique and must not shadow a canonical breed slug
+    taken = set(Breed.objects.values_list("slug", flat=True))
+    aliases = []
+    for breed_id, names in Breed.objects.exclude(legacy_aliases=[]).values_list(
+        "id", "legacy_aliases"
+    ):
+        for name in names:
+            slug = slugify(name.strip(), allow_unicode=True)
+            if slug and slug not in taken:
+                taken.add(slug)
+                aliases.append(
+                    BreedAlias(breed_id=breed_id, name=name.strip(), slug=slug)
+                )
+    BreedAlias.objects.bulk_create(aliases)
+
+
+def restore_aliases(apps, schema_editor):
+    Breed = apps.get_model("breed_finder", "Breed")
+    for breed in Breed.objects.filter(aliases__isnull=False).distinct():
+        breed.legacy_aliases = list(breed.aliases.values_list("name", flat=True))
+        breed.save(update_fields=["legacy_aliases"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("breed_finder", "0010_pet_embedding"),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name="breed",
+            old_name="aliases",
+            new_name="legacy_aliases",
+        ),
+        migrations.CreateModel(
+            name="BreedAlias",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100)),
+                ("slug", models.SlugField(editable=False, max_length=100, unique=True)),
+                (
+                    "breed",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="aliases",
+                        to="breed_finder.breed",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "breed aliases",
+                "ordering": ["name"],
+            },
+        ),
+        migrations.RunPython(copy_aliases, restore_aliases),
+        migrations.RemoveField(
+            model_name="breed",
+            name="legacy_aliases",
+        ),
+    ]
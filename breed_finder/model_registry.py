@@ -0,0 +1,98 @@
+"""
+Cached inventory of the models installed in Ollama.
+
+Every chatbot page used to poll Ollama's /api/tags itself. The inventory is
+now fetched server-side, classified once, and kept in the default cache.
+Once it is older than OLLAMA_MODELS_TTL, the next request starts a refresh
+and waits up to OLLAMA_MODELS_REFRESH_TIMEOUT for it; if Ollama is slower,
+that request gets the stale copy and the refresh carries on in the
+background. Requests arriving meanwhile are served the stale copy without
+waiting, so Ollama sees at most one tags call per interval per worker no
+matter how many pages load. The entry itself expires after STALE_LIMIT
+intervals, so a refresh that keeps failing cannot pin an old inventory.
+"""
+import asyncio
+import time
+import weakref
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import ollama
+
+CACHE_KEY = 'ollama:models'
+
+# Name fragments of vision-capable models; Ollama also reports a "clip"
+# family for the image encoder of multimodal models
+VISION_MODEL_PATTERNS = ('llava', 'bakllava', 'moondream', 'cogvlm')
+
+# Intervals of OLLAMA_MODELS_TTL after which the cache entry expires
+STALE_LIMIT = 5
+
+_refreshes = weakref.WeakKeyDictionary()
+
+
+def is_vision_model(model):
+    name = (model.get('name') or '').lower()
+    families = (model.get('details') or {}).get('families') or []
+    return any(pattern in name for pattern in VISION_MODEL_PATTERNS) or 'clip' in families
+
+
+def classify(models):
+    vision_models = [model['name'] for model in models if model.get('name') and is_vision_model(model)]
+    # llava models first, as the chatbot prefers them
+    vision_models.sort(key=lambda name: 'llava' not in name.lower())
+    return {
+        'models': [
+            {
+                'name': model.get('name'),
+                'size': model.get('size'),
+                'modified_at': model.get('modified_at'),
+                'vision': is_vision_model(model),
+            }
+            for model in models
+        ],
+        'vision_models': vision_models,
+        'llava_available': any('llava' in name.lower() for name in vision_models),
+    }
+
+
+async def refresh():
+    """Fetch /api/tags once and cache the classified inventory."""
+    try:
+        inventory = {**classify(await ollama.list_models()), 'ollama_available': True}
+    except ollama.OllamaError as e:
+        # Cache the failure too, so a down Ollama is not polled on every page load
+        inventory = {**classify([]), 'ollama_available': False, 'error': str(e)}
+    inventory['fetched_at'] = time.time()
+    # Outlive the TTL, so a stale copy can be served while refreshing
+    await cache.aset(CACHE_KEY, inventory, timeout=max(1, settings.OLLAMA_MODELS_TTL * STALE_LIMIT))
+    return inventory
+
+
+def _running_refresh():
+    task = _refreshes.get(asyncio.get_running_loop())
+    return task if task is not None and not task.done() else None
+
+
+def _refresh_once():
+    """Start a refresh unless one is already running on this event loop."""
+    task = _running_refresh()
+    if task is None:
+        loop = asyncio.get_running_loop()
+        task = _refreshes[loop] = loop.create_task(refresh())
+    return task
+
+
+async def get_inventory():
+    inventory = await cache.aget(CACHE_KEY)
+    if inventory is None:
+        return await _refresh_once()
+    if time.time() - inventory['fetched_at'] > settings.OLLAMA_MODELS_TTL and _running_refresh() is None:
+        # Await the refresh rather than leave it to a task nothing waits for;
+        # the shield keeps it running if this request stops waiting
+        try:
+            return await asyncio.wait_for(asyncio.shield(_refresh_once()), settings.OLLAMA_MODELS_REFRESH_TIMEOUT)
+        except TimeoutError:
+            pass
+    return inventory
@@ -1,7 +1,10 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from django.utils.text import slugify
+
+from . import similarity, variants
 
 class CustomUser(AbstractUser):
     email = models.EmailField(unique=True)
@@ -11,6 +14,15 @@ class CustomUser(AbstractUser):
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username']
     
+    def get_profile(self):
+        """Return the user's profile, creating it for accounts that have none."""
+        try:
+            return self.profile
+        except UserProfile.DoesNotExist:
+            profile, _ = UserProfile.objects.get_or_create(user=self)
+            self.profile = profile
+            return profile
+    
     def __str__(self):
         return self.email
 
@@ -23,21 +35,76 @@ class UserProfile(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    def save(self, *args, **kwargs):
+        new_upload = bool(self.profile_picture) and not self.profile_picture._committed
+        super().save(*args, **kwargs)
+        if new_upload:
+            variants.generate_on_upload(self.profile_picture)
+    
     def __str__(self):
         return f"{self.user.username}'s Profile"
 
 @receiver(post_save, sender=CustomUser)
 def create_user_profile(sender, instance, created, **kwargs):
+    # Only new users need a profile; saving a user (e.g. last_login on every
+    # login) must not touch it. Older accounts get one from get_profile().
     if created:
         UserProfile.objects.create(user=instance)
 
-@receiver(post_save, sender=CustomUser)
-def save_user_profile(sender, instance, **kwargs):
-    try:
-        instance.profile.save()
-    except UserProfile.DoesNotExist:
-        # Create profile if it doesn't exist
-        UserProfile.objects.create(user=instance)
+class BreedManager(models.Manager):
+    def resolve(self, name):
+        """Return the Breed for a free-text spelling, creating it if it is new."""
+        slug = Breed.make_slug(name)
+        if not slug:
+            return None
+        # Two unique-index lookups: the canonical slug, then the alias slugs
+        breed = self.filter(slug=slug).first() or self.filter(aliases__slug=slug).first()
+        if breed:
+            return breed
+        breed, _ = self.get_or_create(slug=slug, defaults={'name': name.strip()})
+        return breed
+
+    def matching(self, query):
+        # The breed table is small, so substring matching here is cheap and the
+        # pet lookup becomes an indexed join on canonical_breed_id
+        condition = models.Q(name__icontains=query)
+        slug = Breed.make_slug(query)
+        if slug:
+            condition |= models.Q(slug__icontains=slug) | models.Q(aliases__slug__icontains=slug)
+        return self.filter(condition).distinct()
+
+class Breed(models.Model):
+    name = models.CharField(max_length=100)
+    slug = models.SlugField(max_length=100, unique=True)
+
+    objects = BreedManager()
+
+    class Meta:
+        ordering = ['name']
+
+    @staticmethod
+    def make_slug(name):
+        return slugify((name or '').strip(), allow_unicode=True)
+
+    def __str__(self):
+        return self.name
+
+class BreedAlias(models.Model):
+    """Another spelling of a breed, e.g. "Chiwawa" for Chihuahua, looked up by its slug."""
+    breed = models.ForeignKey(Breed, on_delete=models.CASCADE, related_name='aliases')
+    name = models.CharField(max_length=100)
+    slug = models.SlugField(max_length=100, unique=True, editable=False)
+
+    class Meta:
+        ordering = ['name']
+        verbose_name_plural = 'breed aliases'
+
+    def save(self, *args, **kwargs):
+        self.slug = Breed.make_slug(self.name)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return self.name
 
 class Pet(models.Model):
     GENDER_CHOICES = [
@@ -53,15 +120,26 @@ class Pet(models.Model):
     
     name = models.CharField(max_length=100)
     breed = models.CharField(max_length=100)
+    canonical_breed = models.ForeignKey(Breed, on_delete=models.SET_NULL, null=True, blank=True, editable=False, related_name='pets')
     age_years = models.IntegerField(default=0)
     age_months = models.IntegerField(default=0)
     gender = models.CharField(max_length=1, choices=GENDER_CHOICES)
     description = models.TextField()
     image = models.ImageField(upload_to='pets/')
+    # Unit-length float32 photo embedding for similar-pet search (see similarity.py)
+    embedding = models.BinaryField(null=True, blank=True, editable=False)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='AVAILABLE')
     price = models.DecimalField(max_digits=10, decimal_places=2, default=1000.00)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Available-pet listings: landing_page, chatbot, pet_list
+            models.Index(fields=['status', '-created_at', '-id'], name='pet_status_created_idx'),
+            # Newest-first catalog pages keyed on (created_at, id)
+            models.Index(fields=['-created_at', '-id'], name='pet_created_idx'),
+        ]
     
     @property
     def age_display(self):
@@ -77,5 +155,31 @@ class Pet(models.Model):
         else:
             return "Unknown"
     
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'breed' in update_fields:
+            self.canonical_breed = Breed.objects.resolve(self.breed)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'canonical_breed'}
+        new_upload = bool(self.image) and not self.image._committed
+        if (update_fields is None or 'image' in update_fields) and (new_upload or not self.image):
+            # The old embedding no longer matches; a new upload is embedded in the background
+            self.embedding = None
+            if update_fields is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'embedding'}
+        super().save(*args, **kwargs)
+        if new_upload:
+            variants.generate_on_upload(self.image)
+            similarity.embed_on_upload(self)
+
     def __str__(self):
         return f'{self.name} - {self.breed}'
+
+@receiver(post_save, sender=Pet)
+def update_similarity_index(sender, instance, **kwargs):
+    transaction.on_commit(lambda: similarity.pet_changed(instance))
+
+@receiver(post_delete, sender=Pet)
+def remove_from_similarity_index(sender, instance, **kwargs):
+    pet_id = instance.id  # delete() clears instance.id before the commit
+    transaction.on_commit(lambda: similarity.remove_pet(pet_id))
@@ -0,0 +1,92 @@
+"""
+Async client for the local Ollama server.
+
+One pooled keep-alive httpx.AsyncClient is kept per event loop, so concurrent
+chats share connections instead of opening a new one per request. That is
+one client per ASGI worker process; WSGI is not supported (see
+breedchat/wsgi.py).
+"""
+import asyncio
+import json
+import weakref
+
+import httpx
+from django.conf import settings
+
+
+class OllamaError(Exception):
+    def __init__(self, message, status=502, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.OLLAMA_TIMEOUT, connect=settings.OLLAMA_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=settings.OLLAMA_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.OLLAMA_MAX_CONNECTIONS,
+            ),
+        )
+        _clients[loop] = client
+    return client
+
+
+def api_url(path):
+    return f"{settings.OLLAMA_URL.rstrip('/')}{path}"
+
+
+async def stream_generate(payload):
+    """Yield the NDJSON lines of an /api/generate call as Ollama produces them."""
+    try:
+        async with get_client().stream('POST', api_url('/api/generate'), json=payload) as response:
+            if response.status_code >= 400:
+                body = await response.aread()
+                raise OllamaError(body.decode(errors='replace') or response.reason_phrase, response.status_code)
+            async for line in response.aiter_lines():
+                if line:
+                    yield line + '\n'
+    except httpx.TimeoutException as e:
+        raise OllamaError(f'Ollama timed out: {e}', status=504) from e
+    except httpx.HTTPError as e:
+        raise OllamaError(f'Could not reach Ollama: {e}') from e
+
+
+async def generate(payload):
+    """Run a non-streaming generation and return Ollama's JSON response."""
+    try:
+        response = await get_client().post(api_url('/api/generate'), json={**payload, 'stream': False})
+    except httpx.TimeoutException as e:
+        raise OllamaError(f'Ollama timed out: {e}', status=504) from e
+    except httpx.HTTPError as e:
+        raise OllamaError(f'Could not reach Ollama: {e}') from e
+    if response.status_code >= 400:
+        raise OllamaError(response.text or response.reason_phrase, response.status_code)
+    try:
+        return response.json()
+    except json.JSONDecodeError as e:
+        raise OllamaError(f'Invalid response from Ollama: {e}') from e
+
+
+async def list_models():
+    """Return the model list from Ollama's /api/tags."""
+    try:
+        response = await get_client().get(api_url('/api/tags'), timeout=settings.OLLAMA_CONNECT_TIMEOUT)
+    except httpx.TimeoutException as e:
+        raise OllamaError(f'Ollama timed out: {e}', status=504) from e
+    except httpx.HTTPError as e:
+        raise OllamaError(f'Could not reach Ollama: {e}') from e
+    if response.status_code >= 400:
+        raise OllamaError(response.text or response.reason_phrase, response.status_code)
+    try:
+        data = response.json()
+    except json.JSONDecodeError as e:
+        raise OllamaError(f'Invalid response from Ollama: {e}') from e
+    return data.get('models', []) if isinstance(data, dict) else data
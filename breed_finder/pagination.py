@@ -0,0 +1,93 @@
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_key(*values):
+    raw = '|'.join(str(value) for value in values)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_key(cursor, *types):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        parts = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        if len(parts) != len(types):
+            raise ValueError(cursor)
+        return tuple(cast(part) for cast, part in zip(types, parts))
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f'Invalid cursor: {cursor}') from e
+
+
+def encode_cursor(pet):
+    return encode_key(pet.created_at.isoformat(), pet.id)
+
+
+def decode_cursor(cursor):
+    return decode_key(cursor, datetime.fromisoformat, int)
+
+
+def get_page_size(value=None):
+    """Clamp a requested page size to PET_LIST_MAX_PAGE_SIZE, falling back to the default."""
+    default = getattr(settings, 'PET_LIST_PAGE_SIZE', 24)
+    maximum = getattr(settings, 'PET_LIST_MAX_PAGE_SIZE', 100)
+    try:
+        size = int(value) if value else default
+    except (TypeError, ValueError):
+        size = default
+    return max(1, min(size, maximum))
+
+
+class CursorPage:
+    def __init__(self, items, has_next, has_previous, cursor_for=encode_cursor):
+        self.items = items
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.cursor_for = cursor_for
+
+    @property
+    def next_cursor(self):
+        return self.cursor_for(self.items[-1]) if self.has_next and self.items else None
+
+    @property
+    def previous_cursor(self):
+        return self.cursor_for(self.items[0]) if self.has_previous and self.items else None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def paginate_pets(queryset, after=None, before=None, page_size=None):
+    """
+    Keyset-paginate pets newest first on (created_at, id).
+
+    ``after`` returns the page of older pets following a cursor and ``before``
+    the page of newer pets preceding it. Only page_size + 1 rows are read.
+    """
+    page_size = page_size or get_page_size()
+
+    if before:
+        created_at, pk = decode_cursor(before)
+        rows = list(
+            queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+            .order_by('created_at', 'id')[:page_size + 1]
+        )
+        has_previous = len(rows) > page_size
+        items = rows[:page_size][::-1]
+        return CursorPage(items, has_next=True, has_previous=has_previous)
+
+    if after:
+        created_at, pk = decode_cursor(after)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    rows = list(queryset.order_by('-created_at', '-id')[:page_size + 1])
+    return CursorPage(rows[:page_size], has_next=len(rows) > page_size, has_previous=bool(after))
@@ -0,0 +1,100 @@
+"""
+Content-addressed cache for Ollama generations.
+
+Results are keyed on a SHA-256 of every generation field (model, prompt,
+context, options, ...) and the decoded image bytes, so resending the same
+photo or breed prompt skips the inference. The in-memory tier is the
+"ollama" cache alias (LRU bounded by MAX_ENTRIES with a TTL); if an
+"ollama_disk" alias is configured it is used as a persistent second tier.
+"""
+import base64
+import binascii
+import hashlib
+import json
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+# Every /api/generate field that changes what Ollama generates. The key also
+# decides which concurrent requests share one generation in the scheduler, so
+# a missing field would hand one request another's answer.
+KEY_FIELDS = ('model', 'prompt', 'suffix', 'system', 'template', 'context', 'format', 'options', 'raw', 'think')
+
+# Hit/miss counters for this process
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def cache_key(payload):
+    digest = hashlib.sha256()
+    fields = {field: payload.get(field) for field in KEY_FIELDS}
+    digest.update(json.dumps(fields, sort_keys=True, default=str).encode())
+    for image in payload.get('images') or []:
+        try:
+            data = base64.b64decode(image, validate=True)
+        except (binascii.Error, TypeError, ValueError):
+            data = str(image).encode()
+        digest.update(hashlib.sha256(data).digest())
+    return f'generate:{digest.hexdigest()}'
+
+
+def _tiers():
+    tiers = [caches[settings.OLLAMA_CACHE_ALIAS]]
+    try:
+        tiers.append(caches['ollama_disk'])
+    except InvalidCacheBackendError:
+        pass
+    return tiers
+
+
+async def get_result(payload):
+    """Return the cached result for ``payload`` or None, counting the hit or miss."""
+    key = cache_key(payload)
+    memory, *persistent = _tiers()
+    result = await memory.aget(key)
+    if result is None:
+        for tier in persistent:
+            result = await tier.aget(key)
+            if result is not None:
+                # Promote disk hits so the next lookup stays in memory
+                await memory.aset(key, result)
+                break
+    with _stats_lock:
+        _stats['hits' if result is not None else 'misses'] += 1
+    return result
+
+
+async def store_result(payload, result):
+    key = cache_key(payload)
+    for tier in _tiers():
+        await tier.aset(key, result)
+
+
+def stats():
+    with _stats_lock:
+        hits, misses = _stats['hits'], _stats['misses']
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / total, 4) if total else 0.0,
+    }
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.update(hits=0, misses=0)
+
+
+def combine_lines(lines):
+    """Fold a streamed generation into the single response Ollama returns with stream=false."""
+    result = {}
+    text = []
+    for line in lines:
+        chunk = json.loads(line)
+        text.append(chunk.get('response', ''))
+        result.update(chunk)
+    result['response'] = ''.join(text)
+    return result
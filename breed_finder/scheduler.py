@@ -0,0 +1,220 @@
+"""
+Admission control for Ollama generations.
+
+Ollama usually runs on a single GPU, so a burst of requests only makes every
+generation slower. The scheduler admits at most OLLAMA_MAX_CONCURRENCY
+generations at a time and queues the rest in FIFO order. When the queue is
+full, requests fail fast with 429. If a request waits longer than
+OLLAMA_QUEUE_TIMEOUT, it gets 503. Identical requests that arrive while a
+generation is queued or running share that one upstream call. The call is
+cancelled once all of its subscribers have gone, and a generation that was
+cancelled or has finished is never handed to a new request. Any failure,
+not only an Ollama error, is raised to every subscriber.
+
+State is kept per event loop. The app is served over ASGI only (see
+breedchat/wsgi.py), where one loop runs for the life of a worker process,
+so this is per worker process.
+"""
+import asyncio
+import collections
+import time
+import weakref
+
+from django.conf import settings
+
+from . import ollama, result_cache
+
+
+class FairLimiter:
+    """A FIFO semaphore with a bounded wait queue."""
+
+    def __init__(self, limit, max_queue):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiters = collections.deque()
+        self.rejected = 0
+        self.timed_out = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def check(self):
+        """Raise OllamaError(429) now if a new request could not even be queued."""
+        if self.active >= self.limit and len(self.waiters) >= self.max_queue:
+            self.rejected += 1
+            raise ollama.OllamaError(
+                'The breed identification service is busy, please try again shortly',
+                status=429,
+                retry_after=settings.OLLAMA_RETRY_AFTER,
+            )
+
+    async def acquire(self, timeout):
+        started = time.monotonic()
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+        else:
+            self.check()
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if waiter.done() and not waiter.cancelled():
+                    # The slot was handed over just as we gave up
+                    self.release()
+                elif waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self.timed_out += 1
+                raise ollama.OllamaError(
+                    'Timed out waiting for the breed identification service',
+                    status=503,
+                    retry_after=settings.OLLAMA_RETRY_AFTER,
+                ) from e
+        waited = time.monotonic() - started
+        self.waits += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def release(self):
+        # Hand the slot straight to the oldest waiter that is still waiting
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class SharedGeneration:
+    """One upstream streaming generation whose lines are replayed to every subscriber."""
+
+    def __init__(self, scheduler, key, payload, store):
+        self.scheduler = scheduler
+        self.key = key
+        self.payload = payload
+        self.store = store
+        self.lines = []
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    @property
+    def joinable(self):
+        return not (self.done or self.cancelled or self.task.done())
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _forget(self):
+        # Only drop our own entry; a newer generation may have taken the key
+        if self.scheduler.inflight.get(self.key) is self:
+            del self.scheduler.inflight[self.key]
+
+    async def _run(self):
+        limiter = self.scheduler.limiter
+        try:
+            await limiter.acquire(settings.OLLAMA_QUEUE_TIMEOUT)
+            try:
+                async for line in ollama.stream_generate({**self.payload, 'stream': True}):
+                    self.lines.append(line)
+                    self._notify()
+            finally:
+                limiter.release()
+            if self.store and self.lines:
+                result = result_cache.combine_lines(self.lines)
+                if result.get('done'):
+                    await result_cache.store_result(self.payload, result)
+        except ollama.OllamaError as e:
+            self.error = e
+        except asyncio.CancelledError as e:
+            self.error = ollama.OllamaError('The generation was cancelled', status=503)
+            self.error.__cause__ = e
+            raise
+        except Exception as e:
+            # Anything else, e.g. a failed cache write, must not pass for a clean finish
+            self.error = ollama.OllamaError(f'The generation failed: {e}', status=500)
+            self.error.__cause__ = e
+        finally:
+            self.done = True
+            self._forget()
+            self._notify()
+
+    async def subscribe(self):
+        """Yield every line of the generation, from the first one, as it arrives."""
+        self.subscribers += 1
+        position = 0
+        try:
+            while True:
+                changed = self._changed
+                while position < len(self.lines):
+                    yield self.lines[position]
+                    position += 1
+                if self.done:
+                    if self.error:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                # Everyone gave up (disconnect or deadline), so stop the
+                # generation and free its slot instead of computing for nobody.
+                # New identical requests start a fresh generation from now on.
+                self.cancelled = True
+                self._forget()
+                self.task.cancel()
+
+
+class Scheduler:
+    def __init__(self):
+        self.limiter = FairLimiter(settings.OLLAMA_MAX_CONCURRENCY, settings.OLLAMA_MAX_QUEUE)
+        self.inflight = {}
+        self.coalesced = 0
+
+    def generation(self, payload, store=True):
+        """Return the in-flight generation for ``payload``, starting one if needed."""
+        key = result_cache.cache_key(payload)
+        generation = self.inflight.get(key)
+        if generation is not None and generation.joinable:
+            self.coalesced += 1
+            return generation
+        self.limiter.check()
+        generation = self.inflight[key] = SharedGeneration(self, key, payload, store)
+        return generation
+
+    def stats(self):
+        limiter = self.limiter
+        return {
+            'active': limiter.active,
+            'queued': len(limiter.waiters),
+            'limit': limiter.limit,
+            'max_queue': limiter.max_queue,
+            'inflight': len(self.inflight),
+            'coalesced': self.coalesced,
+            'rejected': limiter.rejected,
+            'timed_out': limiter.timed_out,
+            'wait_seconds': {
+                'count': limiter.waits,
+                'avg': round(limiter.wait_total / limiter.waits, 4) if limiter.waits else 0.0,
+                'max': round(limiter.wait_max, 4),
+            },
+        }
+
+
+_schedulers = weakref.WeakKeyDictionary()
+
+
+def get_scheduler():
+    loop = asyncio.get_running_loop()
+    scheduler = _schedulers.get(loop)
+    if scheduler is None:
+        scheduler = _schedulers[loop] = Scheduler()
+    return scheduler
+
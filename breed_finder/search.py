@@ -0,0 +1,158 @@
+"""
+Full-text pet search.
+
+On SQLite the pet name, breed and description are indexed in an FTS5 table
+that triggers keep in sync with breed_finder_pet (see migration 0008). Results
+are ranked with bm25 and every search term is treated as a prefix. Other
+database backends fall back to case-insensitive substring filters.
+"""
+import difflib
+import re
+
+from django.db import connections
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+
+from .models import Breed
+from .pagination import CursorPage, decode_key, encode_key, get_page_size, paginate_pets
+
+FTS_TABLE = 'breed_finder_pet_fts'
+VOCAB_TABLE = 'breed_finder_pet_fts_vocab'
+
+# Column weights for bm25: name, breed, description
+RANK_EXPRESSION = f'bm25({FTS_TABLE}, 5.0, 3.0, 1.0)'
+
+TOKEN_RE = re.compile(r'\w+')
+
+_fts_available = {}
+
+
+def fts_available(using='default'):
+    """Return True if the FTS5 index exists on this database connection."""
+    if using not in _fts_available:
+        connection = connections[using]
+        _fts_available[using] = (
+            connection.vendor == 'sqlite'
+            and FTS_TABLE in connection.introspection.table_names()
+        )
+    return _fts_available[using]
+
+
+def tokenize(query):
+    return TOKEN_RE.findall(query.lower())
+
+
+def build_match(tokens):
+    # Quote each token so FTS5 syntax in user input is taken literally, and
+    # add * so "lab" also matches "labrador"
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def encode_rank_cursor(pet):
+    return encode_key(pet.search_rank, pet.id)
+
+
+def search_pets(queryset, query, after=None, before=None, page_size=None):
+    """
+    Return a CursorPage of pets matching ``query``.
+
+    With FTS5 the page is ordered by relevance and keyset-paginated on
+    (rank, id); otherwise it is a substring match ordered newest first. When
+    nothing matches, ``page.suggestion`` holds the query with each term
+    replaced by its closest indexed spelling, if there is one.
+    """
+    page_size = page_size or get_page_size()
+    tokens = tokenize(query)
+    using = queryset.db
+
+    if not tokens:
+        page = paginate_pets(queryset.none(), page_size=page_size)
+    elif fts_available(using):
+        page = _ranked_page(queryset, tokens, after, before, page_size)
+    else:
+        page = paginate_pets(_substring_filter(queryset, tokens), after, before, page_size)
+
+    page.suggestion = None if page.items or not tokens else suggest(tokens, using)
+    return page
+
+
+def _substring_filter(queryset, tokens):
+    for token in tokens:
+        queryset = queryset.filter(
+            Q(name__icontains=token)
+            | Q(description__icontains=token)
+            | Q(canonical_breed__in=Breed.objects.matching(token))
+        )
+    return queryset
+
+
+def ranked(queryset, tokens):
+    """Filter ``queryset`` to FTS matches for ``tokens``, annotated with their bm25 ``search_rank``."""
+    match = build_match(tokens)
+    # Only matching pets are read, by primary key, and ranked through the FTS index
+    return queryset.filter(
+        id__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [match])
+    ).annotate(search_rank=RawSQL(
+        f'SELECT {RANK_EXPRESSION} FROM {FTS_TABLE} '
+        f'WHERE {FTS_TABLE} MATCH %s AND {FTS_TABLE}.rowid = breed_finder_pet.id',
+        [match],
+        output_field=FloatField(),
+    ))
+
+
+def _ranked_page(queryset, tokens, after, before, page_size):
+    queryset = ranked(queryset, tokens)
+    if before:
+        rank, pk = decode_key(before, float, int)
+        queryset = queryset.filter(Q(search_rank__lt=rank) | Q(search_rank=rank, id__lt=pk))
+        order_by = ['-search_rank', '-id']
+    else:
+        order_by = ['search_rank', 'id']
+        if after:
+            rank, pk = decode_key(after, float, int)
+            queryset = queryset.filter(Q(search_rank__gt=rank) | Q(search_rank=rank, id__gt=pk))
+
+    rows = list(queryset.order_by(*order_by)[:page_size + 1])
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    if before:
+        return CursorPage(rows[::-1], has_next=True, has_previous=more, cursor_for=encode_rank_cursor)
+    return CursorPage(rows, has_next=more, has_previous=bool(after), cursor_for=encode_rank_cursor)
+
+
+def suggest(tokens, using='default'):
+    """Suggest a corrected query by replacing each term with its closest indexed word."""
+    vocabulary = _vocabulary(tokens, using)
+    corrected = []
+    for token in tokens:
+        if token in vocabulary.get(token[0], ()):
+            corrected.append(token)
+            continue
+        matches = difflib.get_close_matches(token, vocabulary.get(token[0], ()), n=1, cutoff=0.7)
+        if not matches:
+            return None
+        corrected.append(matches[0])
+    if corrected == tokens:
+        return None
+    return ' '.join(corrected)
+
+
+def _vocabulary(tokens, using):
+    # Typos rarely change the first letter, so only terms sharing it are compared
+    initials = sorted({token[0] for token in tokens})
+    vocabulary = {initial: [] for initial in initials}
+    if fts_available(using):
+        with connections[using].cursor() as cursor:
+            for initial in initials:
+                cursor.execute(
+                    f'SELECT term FROM {VOCAB_TABLE} WHERE term >= %s AND term < %s',
+                    [initial, chr(ord(initial) + 1)],
+                )
+                vocabulary[initial] = [row[0] for row in cursor.fetchall()]
+    else:
+        for name in Breed.objects.values_list('name', flat=True):
+            for word in tokenize(name):
+                if word[0] in vocabulary:
+                    vocabulary[word[0]].append(word)
+    return vocabulary
@@ -0,0 +1,207 @@
+"""
+Visual similarity between pet photos.
+
+Each pet photo gets a compact embedding: the image is box-downscaled to
+8x8 RGB, scaled to [-1, 1] and L2-normalised, then stored as 192 float32
+values in Pet.embedding. Because the vectors are unit length, cosine
+similarity is a dot product. A new upload is embedded by a background task
+queued when the pet is saved, so the upload request does no image work;
+until then the pet has no embedding and is left out of the index. The
+embed_pets command fills in embeddings that are missing.
+
+The index of available pets is an in-memory float32 NumPy matrix with an
+id map, so a search is one matrix-vector product followed by argpartition
+for the top k. It is loaded from the database on first use and updated
+incrementally by the Pet signals in models.py when a pet is added, edited,
+adopted or deleted. Other processes pick up those changes when their index
+reaches PET_SIMILARITY_REFRESH seconds and is reloaded.
+"""
+import io
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from PIL import Image, UnidentifiedImageError
+from taskqueue.runner import task
+
+from .images import InvalidImage, decode_base64_image
+
+EMBEDDING_SIZE = 8
+DIMENSIONS = EMBEDDING_SIZE ** 2 * 3
+
+
+def pixels(source, size=EMBEDDING_SIZE):
+    """Return the RGB values in [0, 1] of an image (bytes, base64 or a file object) box-downscaled to size x size."""
+    if isinstance(source, str):
+        source = decode_base64_image(source)
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    try:
+        with Image.open(source) as image:
+            image.draft('RGB', (size, size))
+            image = image.convert('RGB').resize((size, size), Image.Resampling.BOX)
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise InvalidImage(f'Could not read image: {e}') from e
+    return np.asarray(image, dtype=np.float64).reshape(-1) / 255
+
+
+def image_embedding(source):
+    """Return the unit-length embedding of an image (bytes, base64 or a file object) as float32 bytes."""
+    values = pixels(source) * 2 - 1
+    norm = np.linalg.norm(values) or 1.0
+    return (values / norm).astype(np.float32).tobytes()
+
+
+def embed_image_field(image):
+    """Embed the stored photo behind an ImageField, or return None if it cannot be read."""
+    if not image:
+        return None
+    try:
+        with image.storage.open(image.name, 'rb') as f:
+            return image_embedding(f.read())
+    except (OSError, InvalidImage):
+        return None
+
+
+@task(max_attempts=3)
+def embed_pet(pet_id, name):
+    from .models import Pet
+
+    pet = Pet.objects.filter(id=pet_id, image=name).only('id', 'image', 'status').first()
+    if pet is None:
+        # Deleted, or given another photo that has its own task
+        return
+    pet.embedding = embed_image_field(pet.image)
+    if pet.embedding is None:
+        # Retrying cannot fix a missing or unreadable upload
+        return
+    # A queryset update skips Pet.save, so update the index here
+    Pet.objects.filter(id=pet_id, image=name).update(embedding=pet.embedding)
+    transaction.on_commit(lambda: pet_changed(pet))
+
+
+def embed_on_upload(pet):
+    """Queue the embedding of a pet's just-saved upload for the background worker."""
+    if pet.image:
+        embed_pet.enqueue(key=f'pet-embedding:{pet.id}:{pet.image.name}', pet_id=pet.id, name=pet.image.name)
+
+
+def to_vector(embedding):
+    return np.frombuffer(bytes(embedding), dtype=np.float32)
+
+
+class SimilarityIndex:
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+        # Rows past len(self.ids) are spare capacity
+        self.matrix = np.empty((0, DIMENSIONS), dtype=np.float32)
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        from .models import Pet
+
+        rows = Pet.objects.filter(status='AVAILABLE', embedding__isnull=False).values_list('id', 'embedding')
+        with self.lock:
+            self.ids, self.positions = [], {}
+            self.matrix = np.empty((0, DIMENSIONS), dtype=np.float32)
+            for pet_id, embedding in rows.iterator():
+                self._add(pet_id, to_vector(embedding))
+            self.loaded_at = time.monotonic()
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def ensure_loaded(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > settings.PET_SIMILARITY_REFRESH:
+            self.load()
+
+    def _add(self, pet_id, vector):
+        position = len(self.ids)
+        if position == len(self.matrix):
+            # Double the capacity so adding a pet is amortised O(1)
+            matrix = np.empty((max(64, 2 * position), DIMENSIONS), dtype=np.float32)
+            matrix[:position] = self.matrix[:position]
+            self.matrix = matrix
+        self.matrix[position] = vector
+        self.positions[pet_id] = position
+        self.ids.append(pet_id)
+
+    def update(self, pet_id, embedding):
+        """Add or replace a pet; ``embedding=None`` removes it."""
+        if embedding is None:
+            return self.remove(pet_id)
+        vector = to_vector(embedding)
+        with self.lock:
+            position = self.positions.get(pet_id)
+            if position is None:
+                self._add(pet_id, vector)
+            else:
+                self.matrix[position] = vector
+
+    def remove(self, pet_id):
+        with self.lock:
+            position = self.positions.pop(pet_id, None)
+            if position is None:
+                return
+            # Move the last row into the hole so removal is O(1)
+            last_id = self.ids.pop()
+            if last_id != pet_id:
+                self.ids[position] = last_id
+                self.matrix[position] = self.matrix[len(self.ids)]
+                self.positions[last_id] = position
+
+    def search(self, embedding, k, exclude=()):
+        """Return [(pet id, cosine similarity)] for the ``k`` closest pets."""
+        self.ensure_loaded()
+        query = to_vector(embedding)
+        with self.lock:
+            scores = self.matrix[:len(self.ids)] @ query
+            excluded = [self.positions[pet_id] for pet_id in exclude if pet_id in self.positions]
+            scores[excluded] = -np.inf
+            k = min(k, len(scores) - len(excluded))
+            if k <= 0:
+                return []
+            # The k best in any order, then only those k sorted
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            return [(self.ids[position], round(float(scores[position]), 4)) for position in best]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+index = SimilarityIndex()
+
+
+def pet_changed(pet):
+    """Keep the index in step with a saved pet, if the index is loaded in this process."""
+    if index.loaded_at is None:
+        return
+    if pet.status == 'AVAILABLE' and pet.embedding is not None:
+        index.update(pet.id, pet.embedding)
+    else:
+        index.remove(pet.id)
+
+
+def remove_pet(pet_id):
+    if index.loaded_at is not None:
+        index.remove(pet_id)
+
+
+def similar_pets(embedding, k=6, exclude=()):
+    """Return the available pets most similar to ``embedding``, each with a ``similarity`` attribute."""
+    from .models import Pet
+
+    matches = index.search(embedding, k, exclude)
+    pets = Pet.objects.in_bulk([pet_id for pet_id, _ in matches])
+    results = []
+    for pet_id, score in matches:
+        pet = pets.get(pet_id)
+        if pet is not None:
+            pet.similarity = score
+            results.append(pet)
+    return results
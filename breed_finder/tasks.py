@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.mail import send_mail
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+
+from taskqueue.runner import task
+
+from .models import CustomUser
+from .tokens import account_activation_token
+
+
+def activation_link(user):
+    uid = urlsafe_base64_encode(force_bytes(user.pk))
+    token = account_activation_token.make_token(user)
+    path = reverse('breed_finder:activate', kwargs={'uidb64': uid, 'token': token})
+    return f"{settings.EMAIL_PAGE_DOMAIN.rstrip('/')}{path}"
+
+
+@task(max_attempts=5)
+def send_activation_email(user_id):
+    user = CustomUser.objects.filter(id=user_id, is_active=False).first()
+    if user is None:
+        # Already activated or deleted since the task was queued
+        return
+    context = {'user': user, 'link': activation_link(user)}
+    send_mail(
+        settings.SUBJECT,
+        render_to_string(settings.TEXT_MESSAGE_TEMPLATE, context),
+        settings.EMAIL_FROM,
+        [user.email],
+        html_message=render_to_string(settings.HTML_MESSAGE_TEMPLATE, context),
+    )
@@ -0,0 +1,35 @@
+from django import template
+from django.conf import settings
+from django.forms.utils import flatatt
+from django.utils.html import format_html
+
+from breed_finder import variants
+
+register = template.Library()
+
+
+@register.simple_tag
+def responsive_image(image, sizes='100vw', **attrs):
+    """
+    Render ``image`` as a <picture> with WebP and JPEG srcsets, so browsers
+    download a variant sized for the layout instead of the original upload.
+
+    Usage: {% responsive_image pet.image sizes="(min-width: 992px) 33vw, 100vw" class="card-img-top" alt=pet.name %}
+    """
+    if not image:
+        return ''
+    fallback = variants.variant_url(image.name, settings.IMAGE_VARIANT_WIDTHS[-1], 'jpg', image.storage)
+    attrs.setdefault('loading', 'lazy')
+    attrs.setdefault('decoding', 'async')
+    return format_html(
+        '<picture style="display: contents">'
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}"{}>'
+        '</picture>',
+        variants.srcset(image, 'webp'),
+        sizes,
+        fallback,
+        variants.srcset(image, 'jpg'),
+        sizes,
+        flatatt(attrs),
+    )
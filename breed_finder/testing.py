@@ -0,0 +1,23 @@
+"""Test helpers shared by the breed_finder and payment test suites."""
+from .models import Pet
+
+
+def make_pet(**kwargs):
+    fields = {
+        'name': 'Buddy',
+        'breed': 'Labrador',
+        'gender': 'M',
+        'description': 'Friendly dog',
+        'image': 'pets/buddy.png',
+    }
+    fields.update(kwargs)
+    return Pet.objects.create(**fields)
+
+
+def full_scans(queryset):
+    """Return the EXPLAIN QUERY PLAN lines that scan a table without an index."""
+    plan = queryset.explain()
+    return [
+        line for line in plan.splitlines()
+        if ('SCAN' in line and 'USING' not in line) or 'TEMP B-TREE' in line
+    ]
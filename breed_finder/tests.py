@@ -1,3 +1,1050 @@
-from django.test import TestCase
+import asyncio
+import base64
+import importlib
+import io
+import json
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+from breedchat.db import ReadWriteRouter
+from taskqueue.runner import run_pending
+
+from . import model_registry, ollama, result_cache, search, similarity, variants
+from .images import InvalidImage, prepare_image
+from .scheduler import get_scheduler
+from .models import Breed, CustomUser, Pet, UserProfile
+from .testing import full_scans, make_pet
+
+
+def photo_bytes(size=(3000, 2000), format='JPEG', orientation=None, color=(200, 120, 40)):
+    image = Image.new('RGB', size, color)
+    exif = Image.Exif()
+    exif[0x010F] = 'PhoneMaker'
+    if orientation:
+        exif[0x0112] = orientation
+    output = io.BytesIO()
+    image.save(output, format=format, exif=exif)
+    return output.getvalue()
+
+
+BREED_COLORS = {'Vizsla': (200, 120, 40), 'Black Labrador': (20, 20, 20), 'Samoyed': (240, 240, 240)}
+
+
+class PetListTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='tester', email='tester@gmail.com', password='pass12345'
+        )
+        self.client.force_login(self.user)
+
+    def test_breed_counts_are_case_insensitive(self):
+        make_pet(name='A', breed='Labrador')
+        make_pet(name='B', breed='labrador', status='ADOPTED')
+        make_pet(name='C', breed='Beagle')
+
+        response = self.client.get(reverse('breed_finder:pet_list'))
+
+        counts = {pet.name: (pet.breed_total, pet.breed_available) for pet in response.context['pets']}
+        self.assertEqual(counts, {'A': (2, 1), 'B': (2, 1), 'C': (1, 1)})
+
+    def pet_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('breed_finder:pet_list'))
+        return [q['sql'] for q in ctx.captured_queries if 'breed_finder_pet' in q['sql']]
+
+    def test_query_count_does_not_grow_with_pets(self):
+        for i in range(3):
+            make_pet(name=f'Small {i}', breed=f'Breed {i}')
+        self.assertEqual(len(self.pet_queries()), 2)
+
+        for i in range(30):
+            make_pet(name=f'Large {i}', breed=f'Breed {i % 7}')
+        self.assertEqual(len(self.pet_queries()), 2)
+
+
+class RegistrationTests(TestCase):
+    def test_verification_email_is_sent_by_the_worker(self):
+        response = self.client.post(reverse('breed_finder:register'), {
+            'username': 'newbie',
+            'email': 'newbie@gmail.com',
+            'password1': 'Tr1cky-pass-42',
+            'password2': 'Tr1cky-pass-42',
+        })
+        self.assertTemplateUsed(response, 'breed_finder/email_sent.html')
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        link = mail.outbox[0].body.split('/activate/')[1].split()[0]
+        self.client.get(f'/activate/{link}')
+        self.assertTrue(CustomUser.objects.get(email='newbie@gmail.com').is_active)
+
+
+class ProfileTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='tester', email='tester@gmail.com', password='pass12345'
+        )
+
+    def queries(self, func):
+        with CaptureQueriesContext(connection) as ctx:
+            func()
+        return [q['sql'] for q in ctx.captured_queries]
+
+    def test_login_does_not_touch_the_profile(self):
+        # Login benchmark: 13 queries when every user save also re-saved the
+        # profile (SELECT + UPDATE on breed_finder_userprofile), 11 now
+        queries = self.queries(lambda: self.client.post(
+            reverse('breed_finder:login'), {'username': 'tester@gmail.com', 'password': 'pass12345'}
+        ))
+        self.assertEqual([sql for sql in queries if 'breed_finder_userprofile' in sql], [])
+        self.assertLessEqual(len(queries), 11)
+
+    def test_profile_is_created_once_and_on_access_for_old_accounts(self):
+        self.assertTrue(UserProfile.objects.filter(user=self.user).exists())
+        UserProfile.objects.filter(user=self.user).delete()
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('breed_finder:edit_profile'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(UserProfile.objects.filter(user=self.user).count(), 1)
+
+    def test_unchanged_profile_form_is_not_saved(self):
+        self.client.force_login(self.user)
+        data = {'username': 'tester', 'email': 'tester@gmail.com', 'bio': '', 'phone_number': '', 'address': ''}
+        queries = self.queries(lambda: self.client.post(reverse('breed_finder:edit_profile'), data))
+        self.assertEqual([sql for sql in queries if sql.startswith('UPDATE "breed_finder_')], [])
+
+        data['bio'] = 'Loves dogs'
+        self.client.post(reverse('breed_finder:edit_profile'), data)
+        self.assertEqual(UserProfile.objects.get(user=self.user).bio, 'Loves dogs')
+
+
+class SessionBackendTests(TestCase):
+    ENGINES = {
+        'db': 'django.contrib.sessions.backends.db',
+        'cached_db': 'django.contrib.sessions.backends.cached_db',
+        'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+    }
+
+    def setUp(self):
+        self.user = CustomUser.objects.create(username='tester', email='tester@gmail.com')
+        caches['sessions'].clear()
+
+    def session_queries(self, engine):
+        with override_settings(SESSION_ENGINE=self.ENGINES[engine]):
+            # A new client, as SessionMiddleware picks its engine when the handler loads
+            client = Client()
+            client.force_login(self.user)
+            client.get(reverse('breed_finder:user_profile'))
+            with CaptureQueriesContext(connection) as ctx:
+                response = client.get(reverse('breed_finder:user_profile'))
+        self.assertEqual(response.status_code, 200)
+        return [q['sql'] for q in ctx.captured_queries if 'django_session' in q['sql']]
+
+    def test_page_views_skip_the_session_table(self):
+        # Benchmark (manage.py benchmark_sessions): the db backend reads the
+        # session row on every authenticated view; cached_db and signed
+        # cookies do not touch the table at all
+        self.assertEqual(len(self.session_queries('db')), 1)
+        self.assertEqual(self.session_queries('cached_db'), [])
+        self.assertEqual(self.session_queries('signed_cookies'), [])
+
+    def test_messages_and_csrf_token_do_not_write_the_session(self):
+        self.client.force_login(self.user)
+        pet = make_pet(status='ADOPTED')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse('breed_finder:pet_detail', args=[pet.id]))
+        self.assertContains(response, 'csrfmiddlewaretoken')
+        self.assertIn('messages', response.cookies)
+        writes = [q['sql'] for q in ctx.captured_queries if 'django_session' in q['sql'] and not q['sql'].startswith('SELECT')]
+        self.assertEqual(writes, [])
+
+    def test_benchmark_command(self):
+        out = io.StringIO()
+        call_command('benchmark_sessions', '--requests', '3', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[1].startswith('db + CSRF in session (before)'))
+
+
+class DatabaseTuningTests(TestCase):
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_connections_are_tuned_for_concurrency(self):
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('synchronous'), 1)  # NORMAL
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+        self.assertEqual(self.pragma('cache_size'), -20000)
+
+    def test_reads_outside_transactions_go_to_the_read_connection(self):
+        router = ReadWriteRouter()
+        with mock.patch.object(connections['default'], 'in_atomic_block', False):
+            self.assertEqual(router.db_for_read(Pet), 'replica')
+        # TestCase wraps each test in a transaction
+        self.assertEqual(router.db_for_read(Pet), 'default')
+        self.assertEqual(router.db_for_write(Pet), 'default')
+        self.assertFalse(router.allow_migrate('replica', 'breed_finder'))
+
+    def test_load_test_command(self):
+        out = io.StringIO()
+        call_command('sqlite_load_test', '--threads', '4', '--seconds', '0.2', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines], ['settings', 'default', 'tuned'])
+
+
+class CreateMissingProfilesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(7):
+            CustomUser.objects.create(username=f'user{i}', email=f'user{i}@gmail.com')
+        UserProfile.objects.filter(user__username__in=['user1', 'user2', 'user4', 'user5', 'user6']).delete()
+
+    def run_command(self, *args):
+        out = io.StringIO()
+        with CaptureQueriesContext(connection) as ctx:
+            call_command('create_missing_profiles', *args, stdout=out)
+        return out.getvalue(), len(ctx.captured_queries)
+
+    def test_dry_run_only_counts(self):
+        out, _ = self.run_command('--dry-run')
+        self.assertIn('Found 5 users without profiles', out)
+        self.assertEqual(UserProfile.objects.count(), 2)
+
+    def test_creates_profiles_in_batches(self):
+        out, queries = self.run_command('--batch-size', '2')
+        self.assertEqual(UserProfile.objects.count(), 7)
+        self.assertIn('Processed 5/5 users', out)
+        # count + 3 batches of (SELECT ids, INSERT) + the final empty SELECT,
+        # plus the savepoints around each bulk insert
+        self.assertLessEqual(queries, 1 + 3 * 4 + 1)
+
+        out, _ = self.run_command()
+        self.assertIn('Found 0 users without profiles', out)
+
+
+class PetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='tester', email='tester@gmail.com', password='pass12345'
+        )
+        self.client.force_login(self.user)
+        self.pets = [make_pet(name=f'Pet {i}') for i in range(5)]
+
+    def test_api_walks_pages_with_cursors(self):
+        url = reverse('breed_finder:pet_list_api')
+        first = self.client.get(url, {'page_size': 2}).json()
+        self.assertEqual([p['name'] for p in first['results']], ['Pet 4', 'Pet 3'])
+        self.assertIsNone(first['previous'])
+
+        second = self.client.get(url, {'page_size': 2, 'after': first['next']}).json()
+        self.assertEqual([p['name'] for p in second['results']], ['Pet 2', 'Pet 1'])
+
+        last = self.client.get(url, {'page_size': 2, 'after': second['next']}).json()
+        self.assertEqual([p['name'] for p in last['results']], ['Pet 0'])
+        self.assertIsNone(last['next'])
+
+        back = self.client.get(url, {'page_size': 2, 'before': second['previous']}).json()
+        self.assertEqual([p['name'] for p in back['results']], ['Pet 4', 'Pet 3'])
+        self.assertIsNone(back['previous'])
+
+    def test_api_rejects_invalid_cursor(self):
+        response = self.client.get(reverse('breed_finder:pet_list_api'), {'after': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_landing_page_uses_page_for_view_all(self):
+        response = self.client.get(reverse('breed_finder:landing'))
+        self.assertFalse(response.context['show_view_all'])
+        make_pet(name='Pet 5')
+        make_pet(name='Pet 6')
+        response = self.client.get(reverse('breed_finder:landing'))
+        self.assertEqual(len(response.context['pets']), 6)
+        self.assertTrue(response.context['show_view_all'])
+
+
+class BreedTests(TestCase):
+    def test_spellings_fold_to_one_breed(self):
+        first = make_pet(breed='Golden Retriever')
+        second = make_pet(breed='golden-retriever ')
+        self.assertEqual(first.canonical_breed_id, second.canonical_breed_id)
+        self.assertEqual(Breed.objects.count(), 1)
+
+    def test_aliases_resolve_to_canonical_breed(self):
+        breed = Breed.objects.create(name='Chihuahua', slug='chihuahua')
+        breed.aliases.create(name='Chiwawa')
+        Breed.objects.create(name='Pug', slug='pug')
+        # Indexed lookups by slug, never a scan of every breed's aliases
+        with self.assertNumQueries(2):
+            self.assertEqual(Breed.objects.resolve(' CHIWAWA'), breed)
+        self.assertEqual(make_pet(breed='chiwawa').canonical_breed, breed)
+        self.assertEqual(list(Breed.objects.matching('chiwa')), [breed])
+        # Matches normalised aliases, not the punctuation of how they are stored
+        self.assertEqual(list(Breed.objects.matching('"')), [])
+
+
+class PetSearchTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='tester', email='tester@gmail.com', password='pass12345'
+        )
+        self.client.force_login(self.user)
+
+    def search(self, query, **params):
+        return self.client.get(reverse('breed_finder:pet_list_api'), {'search': query, **params}).json()
+
+    def test_ranks_name_and_breed_matches_above_description(self):
+        make_pet(name='Max', breed='Beagle', description='Plays with a labrador next door')
+        make_pet(name='Rex', breed='Labrador', description='Loves water')
+        make_pet(name='Bo', breed='Poodle', description='Calm')
+
+        names = [pet['name'] for pet in self.search('labrador')['results']]
+        self.assertEqual(names, ['Rex', 'Max'])
+
+    def test_prefix_and_multiple_terms(self):
+        make_pet(name='Rex', breed='Labrador', description='Loves water')
+        make_pet(name='Sam', breed='Labrador', description='Loves snow')
+
+        self.assertEqual([pet['name'] for pet in self.search('lab wat')['results']], ['Rex'])
+
+    def test_index_follows_edits_and_deletes(self):
+        pet = make_pet(name='Rex', breed='Labrador')
+        pet.breed = 'Beagle'
+        pet.save()
+        self.assertEqual(self.search('labrador')['results'], [])
+        self.assertEqual(len(self.search('beagle')['results']), 1)
+        pet.delete()
+        self.assertEqual(self.search('beagle')['results'], [])
+
+    def test_ranked_results_paginate(self):
+        for i in range(5):
+            make_pet(name=f'Pet {i}', breed='Labrador')
+        first = self.search('labrador', page_size=3)
+        second = self.search('labrador', page_size=3, after=first['next'])
+        back = self.search('labrador', page_size=3, before=second['previous'])
+
+        ids = [pet['id'] for pet in first['results'] + second['results']]
+        self.assertEqual(len(set(ids)), 5)
+        self.assertIsNone(second['next'])
+        self.assertEqual(back['results'], first['results'])
+
+    def test_suggests_spelling_when_nothing_matches(self):
+        make_pet(name='Rex', breed='Labrador')
+        result = self.search('labradro')
+        self.assertEqual(result['results'], [])
+        self.assertEqual(result['suggestion'], 'labrador')
+
+    def test_ranked_search_reads_only_matching_pets(self):
+        make_pet(name='Rex', breed='Labrador')
+        plan = search.ranked(Pet.objects.all(), ['lab']).explain()
+        self.assertIn('SEARCH breed_finder_pet USING INTEGER PRIMARY KEY', plan)
+        # The only scans are FTS index lookups, never a pass over every pet
+        self.assertEqual([line for line in plan.splitlines() if 'SCAN' in line and 'VIRTUAL TABLE INDEX' not in line], [])
+
+    def test_falls_back_to_substring_search_without_fts(self):
+        make_pet(name='Rex', breed='Labrador', description='Loves water')
+        make_pet(name='Bo', breed='Poodle', description='Calm')
+        with mock.patch('breed_finder.search.fts_available', return_value=False):
+            self.assertEqual([pet['name'] for pet in self.search('water')['results']], ['Rex'])
+            self.assertEqual(self.search('labradro')['suggestion'], 'labrador')
+
+
+class QueryPlanTests(TestCase):
+    def test_available_pet_listing_uses_index(self):
+        queryset = Pet.objects.filter(status='AVAILABLE').order_by('-created_at', '-id')[:7]
+        self.assertEqual(full_scans(queryset), [])
+
+    def test_catalog_page_uses_index(self):
+        queryset = Pet.objects.order_by('-created_at', '-id')[:25]
+        self.assertEqual(full_scans(queryset), [])
+
+    def test_available_count_uses_index(self):
+        self.assertEqual(full_scans(Pet.objects.filter(status='AVAILABLE').values('id')), [])
+
+
+class SimilarPetsTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        similarity.index.invalidate()
+        self.user = CustomUser.objects.create(username='tester', email='tester@gmail.com')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.vizsla = self.make_pet('Vizsla', BREED_COLORS['Vizsla'])
+            self.lookalike = self.make_pet('Rusty', (190, 110, 50))
+            self.labrador = self.make_pet('Black Labrador', BREED_COLORS['Black Labrador'])
+            run_pending()
+        for pet in (self.vizsla, self.lookalike, self.labrador):
+            pet.refresh_from_db()
+
+    def make_pet(self, name, color):
+        upload = SimpleUploadedFile(f'{name}.jpg', photo_bytes((64, 48), color=color), content_type='image/jpeg')
+        return make_pet(name=name, image=upload)
+
+    def similar(self, pet):
+        self.client.force_login(self.user)
+        return self.client.get(reverse('breed_finder:pet_similar_pets', args=[pet.id])).json()['results']
+
+    def test_embedding_is_computed_in_the_background(self):
+        self.assertEqual(len(self.vizsla.embedding), similarity.EMBEDDING_SIZE ** 2 * 3 * 4)
+        self.assertIsNone(make_pet(name='No photo').embedding)
+
+        pet = self.make_pet('Copper', (205, 125, 35))
+        self.assertIsNone(pet.embedding)
+        self.assertEqual(run_pending(), 2)
+        pet.refresh_from_db()
+        self.assertEqual(len(pet.embedding), len(self.vizsla.embedding))
+
+        # A new photo drops the old embedding until its own task has run
+        pet.image = SimpleUploadedFile('Copper.jpg', photo_bytes((64, 48)), content_type='image/jpeg')
+        pet.save(update_fields=['image'])
+        pet.refresh_from_db()
+        self.assertIsNone(pet.embedding)
+
+    def test_embed_pets_fills_in_missing_embeddings_in_batches(self):
+        Pet.objects.filter(id__in=[self.vizsla.id, self.labrador.id]).update(embedding=None)
+        make_pet(name='Unreadable')
+        out = io.StringIO()
+        call_command('embed_pets', '--batch-size', '1', stdout=out)
+        self.assertIn('Embedded 2 pet photos, 1 could not be read', out.getvalue())
+        self.assertEqual(Pet.objects.filter(embedding__isnull=True).count(), 1)
+
+    def test_similar_pets_are_ranked_by_cosine_similarity(self):
+        results = self.similar(self.vizsla)
+        self.assertEqual([pet['name'] for pet in results], ['Rusty', 'Black Labrador'])
+        self.assertGreater(results[0]['similarity'], 0.99)
+
+    def upload(self, client=None, **extra):
+        upload = SimpleUploadedFile('dog.jpg', photo_bytes((640, 480), color=(25, 25, 25)), content_type='image/jpeg')
+        return (client or self.client).post(reverse('breed_finder:similar_pets') + '?count=1', {'image': upload}, **extra)
+
+    def test_similar_pets_require_login(self):
+        response = self.client.get(reverse('breed_finder:pet_similar_pets', args=[self.vizsla.id]))
+        self.assertEqual(response.status_code, 302)
+
+    def test_uploaded_photo_search(self):
+        self.client.force_login(self.user)
+        response = self.upload()
+        self.assertEqual([pet['name'] for pet in response.json()['results']], ['Black Labrador'])
+
+        for body in ({'image': 'bm90IGFuIGltYWdl'}, [], '"x"', 1):
+            with self.subTest(body=body):
+                response = self.client.post(reverse('breed_finder:similar_pets'), body, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+
+    def test_uploaded_photo_search_requires_login_and_csrf_token(self):
+        self.assertEqual(self.upload().status_code, 302)
+
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        self.assertEqual(self.upload(client).status_code, 403)
+
+        # The chatbot page renders the token the photo search sends back
+        client.get(reverse('breed_finder:chatbot'))
+        response = self.upload(client, HTTP_X_CSRFTOKEN=client.cookies['csrftoken'].value)
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(PET_SIMILAR_MAX_UPLOAD=1024)
+    def test_uploaded_photo_size_is_capped(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.upload().status_code, 413)
+
+    def test_index_is_updated_incrementally(self):
+        self.similar(self.vizsla)
+        loaded_at = similarity.index.loaded_at
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.lookalike.status = 'ADOPTED'
+            self.lookalike.save()
+            self.labrador.delete()
+            self.make_pet('Copper', (205, 125, 35))
+            run_pending()
+        self.assertEqual([pet['name'] for pet in self.similar(self.vizsla)], ['Copper'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.lookalike.status = 'AVAILABLE'
+            self.lookalike.save(update_fields=['status'])
+        self.assertEqual({pet['name'] for pet in self.similar(self.vizsla)}, {'Copper', 'Rusty'})
+        self.assertEqual(similarity.index.loaded_at, loaded_at)
+
+
+@override_settings(IMAGE_VARIANT_WIDTHS=[160, 320])
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.user = CustomUser.objects.create_user(
+            username='tester', email='tester@gmail.com', password='pass12345'
+        )
+        self.client.force_login(self.user)
+
+    def screenshot(self):
+        image = Image.new('RGBA', (1200, 800), (30, 60, 90, 0))
+        output = io.BytesIO()
+        image.save(output, format='PNG')
+        return output.getvalue()
+
+    def test_upload_renders_every_variant(self):
+        upload = SimpleUploadedFile('shot.png', self.screenshot(), content_type='image/png')
+        pet = make_pet(image=upload)
+        self.assertFalse(default_storage.exists(variants.variant_name(pet.image.name, 160, 'webp')))
+        # The variants and the similarity embedding
+        self.assertEqual(run_pending(), 2)
+
+        for width in (160, 320):
+            for fmt, (image_format, _) in variants.VARIANT_FORMATS.items():
+                with default_storage.open(variants.variant_name(pet.image.name, width, fmt)) as f:
+                    image = Image.open(f)
+                    self.assertEqual((image.format, image.size), (image_format, (width, round(width * 2 / 3))))
+                    if fmt == 'jpg':
+                        self.assertEqual(image.getpixel((0, 0)), (255, 255, 255))
+
+    def test_missing_variants_are_rendered_on_first_request(self):
+        name = default_storage.save('pets/existing.jpg', ContentFile(photo_bytes((800, 600))))
+        make_pet(image=name)
+        url = reverse('breed_finder:image_variant', args=[320, 'webp', name])
+
+        content = self.client.get(reverse('breed_finder:pet_list')).content.decode()
+        self.assertIn(f'{url} 320w', content)
+
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertEqual(Image.open(io.BytesIO(b''.join(response.streaming_content))).size, (320, 240))
+        self.assertTrue(default_storage.exists(variants.variant_name(name, 320, 'webp')))
+
+        content = self.client.get(reverse('breed_finder:pet_list')).content.decode()
+        self.assertIn('/media/variants/320/pets/existing.webp 320w', content)
+
+    def test_rejects_unknown_variants(self):
+        default_storage.save('pets/existing.jpg', ContentFile(photo_bytes((800, 600))))
+        for args in ([999, 'webp', 'pets/existing.jpg'], [320, 'gif', 'pets/existing.jpg'],
+                     [320, 'webp', 'pets/../secret.jpg'], [320, 'webp', 'pets/missing.jpg']):
+            self.assertEqual(self.client.get(reverse('breed_finder:image_variant', args=args)).status_code, 404)
+
+    def test_backfill_command(self):
+        name = default_storage.save('pets/existing.jpg', ContentFile(photo_bytes((800, 600))))
+        make_pet(image=name)
+        call_command('generate_image_variants', stdout=io.StringIO())
+        self.assertTrue(default_storage.exists(variants.variant_name(name, 160, 'jpg')))
+        self.assertEqual(variants.generate_variants(name), 0)
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        self.server.calls.append((self.path, body))
+        status, lines = self.server.reply(self.path, body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            for line in lines:
+                if isinstance(line, (int, float)):
+                    time.sleep(line)
+                    continue
+                self.wfile.write(json.dumps(line).encode() + b'\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The proxy hung up, e.g. after a deadline
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeOllama:
+    """
+    A local stand-in for the Ollama HTTP API.
+
+    ``reply(path, body)`` returns (status, items); dict items are written as
+    NDJSON lines and numbers pause the response for that many seconds.
+    """
+
+    def __init__(self, reply):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOllamaHandler)
+        self.server.reply = reply
+        self.server.calls = []
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    @property
+    def calls(self):
+        return self.server.calls
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.settings = override_settings(OLLAMA_URL=self.url)
+        self.settings.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def token_stream(*tokens, delay=0):
+    lines = []
+    for token in tokens:
+        lines += [{'response': token, 'done': False}, delay]
+    return lines + [{'response': '', 'done': True}]
+
+
+class OllamaTestCase(SimpleTestCase):
+    url = '/api/ollama/'
+
+    def setUp(self):
+        caches['ollama'].clear()
+        result_cache.reset_stats()
+
+    async def collect(self, response):
+        return [json.loads(line) async for chunk in response.streaming_content for line in chunk.decode().splitlines()]
+
+
+class OllamaProxyTests(OllamaTestCase):
+    async def test_relays_token_stream(self):
+        with FakeOllama(lambda path, body: (200, token_stream('Golden', ' Retriever'))) as fake:
+            response = await self.async_client.post(
+                self.url, {'model': 'llava', 'prompt': 'What breed?'}, content_type='application/json'
+            )
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            lines = await self.collect(response)
+        self.assertEqual(''.join(line['response'] for line in lines), 'Golden Retriever')
+        self.assertEqual(fake.calls[0][0], '/api/generate')
+
+    async def test_first_token_arrives_before_generation_finishes(self):
+        with FakeOllama(lambda path, body: (200, token_stream('a', 'b', 'c', delay=0.3))):
+            started = time.monotonic()
+            response = await self.async_client.post(self.url, {'model': 'llava'}, content_type='application/json')
+            chunks = response.streaming_content
+            await anext(chunks)
+            first_token = time.monotonic() - started
+            async for _ in chunks:
+                pass
+            total = time.monotonic() - started
+        self.assertLess(first_token, 0.3)
+        self.assertGreater(total, 0.8)
+
+    async def test_non_streaming_request_returns_json(self):
+        reply = {'response': 'Beagle', 'done': True}
+        with FakeOllama(lambda path, body: (200, [reply])):
+            response = await self.async_client.post(
+                self.url, {'model': 'llava', 'stream': False}, content_type='application/json'
+            )
+        self.assertEqual(response.json(), reply)
+
+    async def test_error_after_the_first_line_keeps_retry_after(self):
+        async def lines():
+            yield json.dumps({'response': 'Golden', 'done': False}) + '\n'
+            raise ollama.OllamaError('Ollama is overloaded', status=503, retry_after=5)
+
+        with mock.patch('breed_finder.views.get_scheduler') as get_scheduler:
+            get_scheduler.return_value.generation.return_value.subscribe.return_value = lines()
+            response = await self.async_client.post(
+                self.url, {'model': 'llava', 'stream': False}, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '5')
+
+    async def test_json_body_must_be_an_object(self):
+        for body in ([], '"x"', 1):
+            with self.subTest(body=body):
+                response = await self.async_client.post(self.url, body, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+
+    async def test_upstream_error_keeps_status(self):
+        with FakeOllama(lambda path, body: (404, [{'error': 'model not found'}])):
+            response = await self.async_client.post(self.url, {'model': 'nope'}, content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('model not found', response.json()['error'])
+
+    async def test_unreachable_ollama(self):
+        with override_settings(OLLAMA_URL='http://127.0.0.1:9'):
+            response = await self.async_client.post(self.url, {'model': 'llava'}, content_type='application/json')
+        self.assertEqual(response.status_code, 502)
+
+    def test_wsgi_is_refused(self):
+        # Streaming and the per-loop Ollama state only work under ASGI
+        with self.assertRaises(ImproperlyConfigured):
+            importlib.import_module('breedchat.wsgi')
+
+
+class OllamaResultCacheTests(OllamaTestCase):
+    payload = {'model': 'llava', 'prompt': 'What breed?', 'images': [base64.b64encode(photo_bytes((64, 64))).decode()]}
+
+    async def post(self, payload, **extra):
+        return await self.async_client.post(self.url, payload, content_type='application/json', **extra)
+
+    async def test_repeated_stream_is_served_from_cache(self):
+        with FakeOllama(lambda path, body: (200, token_stream('Pug'))) as fake:
+            first = await self.post(self.payload)
+            await self.collect(first)
+            second = await self.post(self.payload)
+        self.assertEqual(first['X-Cache'], 'MISS')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(json.loads(second.content)['response'], 'Pug')
+        self.assertEqual(len(fake.calls), 1)
+        self.assertEqual(result_cache.stats(), {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+    async def test_key_covers_image_bytes_and_options(self):
+        with FakeOllama(lambda path, body: (200, [{'response': 'Pug', 'done': True}])) as fake:
+            for payload in [
+                self.payload,
+                {**self.payload, 'images': [base64.b64encode(photo_bytes((64, 48))).decode()]},
+                {**self.payload, 'options': {'temperature': 0}},
+                {**self.payload, 'context': [1, 2, 3]},
+                {**self.payload, 'suffix': ' is the breed.'},
+                self.payload,
+            ]:
+                await self.post({**payload, 'stream': False})
+        self.assertEqual(len(fake.calls), 5)
+
+    async def test_no_cache_header_bypasses_cache(self):
+        with FakeOllama(lambda path, body: (200, [{'response': 'Pug', 'done': True}])) as fake:
+            await self.post({**self.payload, 'stream': False})
+            await self.post({**self.payload, 'stream': False}, headers={'Cache-Control': 'no-cache'})
+        self.assertEqual(len(fake.calls), 2)
+
+    async def test_incomplete_generation_is_not_cached(self):
+        with FakeOllama(lambda path, body: (200, [{'response': 'Pu', 'done': False}])) as fake:
+            await self.collect(await self.post(self.payload))
+            await self.collect(await self.post(self.payload))
+        self.assertEqual(len(fake.calls), 2)
+
+
+class ImagePreprocessingTests(SimpleTestCase):
+    @override_settings(OLLAMA_IMAGE_MAX_SIZE=672)
+    def test_downscales_and_strips_exif(self):
+        original = photo_bytes()
+        prepared = Image.open(io.BytesIO(prepare_image(original)))
+        self.assertEqual(prepared.format, 'JPEG')
+        self.assertEqual(prepared.size, (672, 448))
+        self.assertEqual(dict(prepared.getexif()), {})
+        self.assertLess(len(prepare_image(original)), len(original))
+
+    @override_settings(OLLAMA_IMAGE_MAX_SIZE=672)
+    def test_applies_orientation_before_stripping(self):
+        # Orientation 6 means the camera was rotated 90 degrees
+        prepared = Image.open(io.BytesIO(prepare_image(photo_bytes(orientation=6))))
+        self.assertEqual(prepared.size, (448, 672))
+
+    def test_converts_transparent_png(self):
+        output = io.BytesIO()
+        Image.new('RGBA', (100, 100)).save(output, format='PNG')
+        self.assertEqual(Image.open(io.BytesIO(prepare_image(output.getvalue()))).mode, 'RGB')
+
+    def test_rejects_non_images(self):
+        with self.assertRaises(InvalidImage):
+            prepare_image(b'not an image')
+
+
+@override_settings(OLLAMA_IMAGE_MAX_SIZE=336)
+class OllamaProxyImageTests(OllamaTestCase):
+    reply = staticmethod(lambda path, body: (200, [{'response': 'Pug', 'done': True}]))
+
+    def forwarded_image(self, fake):
+        return Image.open(io.BytesIO(base64.b64decode(fake.calls[0][1]['images'][0])))
+
+    async def test_multipart_upload_is_resized_before_forwarding(self):
+        upload = SimpleUploadedFile('dog.jpg', photo_bytes(), content_type='image/jpeg')
+        with FakeOllama(self.reply) as fake:
+            response = await self.async_client.post(
+                self.url, {'model': 'llava', 'prompt': 'What breed?', 'stream': 'false', 'image': upload}
+            )
+        self.assertEqual(response.json()['response'], 'Pug')
+        self.assertEqual(self.forwarded_image(fake).size, (336, 224))
+
+    async def test_data_url_images_are_resized(self):
+        data_url = 'data:image/jpeg;base64,' + base64.b64encode(photo_bytes()).decode()
+        with FakeOllama(self.reply) as fake:
+            await self.async_client.post(
+                self.url, {'model': 'llava', 'stream': False, 'images': [data_url]}, content_type='application/json'
+            )
+        self.assertEqual(self.forwarded_image(fake).size, (336, 224))
+
+    async def test_invalid_image_is_rejected(self):
+        with FakeOllama(self.reply) as fake:
+            response = await self.async_client.post(
+                self.url, {'model': 'llava', 'images': ['bm90IGFuIGltYWdl']}, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(fake.calls, [])
+
+
+class OllamaSchedulerTests(OllamaTestCase):
+    async def post(self, payload, **extra):
+        return await self.async_client.post(
+            self.url, payload, content_type='application/json', headers={'Cache-Control': 'no-cache'}, **extra
+        )
+
+    async def test_identical_requests_share_one_generation(self):
+        with FakeOllama(lambda path, body: (200, token_stream('Shiba', ' Inu', delay=0.2))) as fake:
+            responses = await asyncio.gather(*[self.post({'model': 'llava', 'prompt': 'Same'}) for _ in range(3)])
+            texts = [''.join(line['response'] for line in await self.collect(r)) for r in responses]
+            stats = get_scheduler().stats()
+        self.assertEqual(texts, ['Shiba Inu'] * 3)
+        self.assertEqual(len(fake.calls), 1)
+        self.assertEqual(stats['coalesced'], 2)
+
+    async def test_requests_differing_only_in_context_are_not_shared(self):
+        with FakeOllama(lambda path, body: (200, token_stream(str(body['context']), delay=0.2))) as fake:
+            responses = await asyncio.gather(*[
+                self.post({'model': 'llava', 'prompt': 'Same', 'context': context}) for context in ([1, 2], [3])
+            ])
+            texts = [''.join(line['response'] for line in await self.collect(r)) for r in responses]
+            stats = get_scheduler().stats()
+        self.assertEqual(texts, ['[1, 2]', '[3]'])
+        self.assertEqual(len(fake.calls), 2)
+        self.assertEqual(stats['coalesced'], 0)
+
+    @override_settings(OLLAMA_MAX_CONCURRENCY=1, OLLAMA_MAX_QUEUE=0)
+    async def test_full_queue_is_rejected_with_retry_after(self):
+        with FakeOllama(lambda path, body: (200, token_stream('Pug', delay=0.3))):
+            first, second = await asyncio.gather(
+                self.post({'model': 'llava', 'prompt': 'One'}),
+                self.post({'model': 'llava', 'prompt': 'Two'}),
+            )
+            await self.collect(first)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(second['Retry-After'], '5')
+        self.assertEqual(get_scheduler().stats()['rejected'], 1)
+
+    @override_settings(OLLAMA_MAX_CONCURRENCY=1, OLLAMA_MAX_QUEUE=1, OLLAMA_QUEUE_TIMEOUT=0.1)
+    async def test_queue_wait_times_out_with_503(self):
+        with FakeOllama(lambda path, body: (200, token_stream('Pug', delay=0.5))):
+            first, second = await asyncio.gather(
+                self.post({'model': 'llava', 'prompt': 'One'}),
+                self.post({'model': 'llava', 'prompt': 'Two'}),
+            )
+            await self.collect(first)
+        self.assertEqual(second.status_code, 503)
+        self.assertIn('Retry-After', second)
+
+    @override_settings(OLLAMA_MAX_CONCURRENCY=1, OLLAMA_MAX_QUEUE=5)
+    async def test_queued_requests_run_in_arrival_order(self):
+        order = []
+
+        def reply(path, body):
+            order.append(body['prompt'])
+            return 200, token_stream('ok', delay=0.05)
+
+        with FakeOllama(reply):
+            tasks = []
+            for prompt in ['a', 'b', 'c', 'd']:
+                tasks.append(asyncio.ensure_future(self.post({'model': 'llava', 'prompt': prompt})))
+                await asyncio.sleep(0.01)
+            for response in await asyncio.gather(*tasks):
+                await self.collect(response)
+            stats = get_scheduler().stats()
+        self.assertEqual(order, ['a', 'b', 'c', 'd'])
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['active'], 0)
+        self.assertGreater(stats['wait_seconds']['max'], 0)
+
+    async def test_unexpected_failure_reaches_every_subscriber(self):
+        scheduler = get_scheduler()
+        with FakeOllama(lambda path, body: (200, token_stream('Pug'))), \
+                mock.patch.object(result_cache, 'store_result', side_effect=RuntimeError('cache is down')):
+            generation = scheduler.generation({'model': 'llava', 'prompt': 'Store'})
+            for _ in range(2):
+                with self.assertRaises(ollama.OllamaError) as raised:
+                    [line async for line in generation.subscribe()]
+        self.assertIsInstance(raised.exception.__cause__, RuntimeError)
+        self.assertEqual(scheduler.inflight, {})
+
+    async def test_abandoned_generation_is_never_reused(self):
+        scheduler = get_scheduler()
+        payload = {'model': 'llava', 'prompt': 'Leave'}
+        with FakeOllama(lambda path, body: (200, token_stream('a', 'b', delay=0.3))) as fake:
+            first = scheduler.generation(payload)
+            lines = first.subscribe()
+            await anext(lines)
+            await lines.aclose()
+            # Released as soon as the last subscriber left, not when the task unwinds
+            self.assertNotIn(first.key, scheduler.inflight)
+            second = scheduler.generation(payload)
+            text = ''.join([json.loads(line)['response'] async for line in second.subscribe()])
+            await asyncio.wait([first.task])
+        self.assertIsNot(second, first)
+        self.assertEqual(text, 'ab')
+        self.assertEqual(len(fake.calls), 2)
+        self.assertTrue(first.task.cancelled())
+        self.assertEqual(first.error.status, 503)
+        self.assertEqual(scheduler.stats()['coalesced'], 0)
+
+
+class OllamaModelInventoryTests(OllamaTestCase):
+    url = '/api/ollama/models/'
+    tags = {'models': [
+        {'name': 'minicpm-v:8b', 'details': {'families': ['qwen2', 'clip']}},
+        {'name': 'gemma3:4b', 'details': {'families': ['gemma3']}},
+        {'name': 'llava:7b', 'size': 1, 'details': {'families': ['llama', 'clip']}},
+    ]}
+
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+
+    def reply(self, path, body):
+        return 200, [self.tags]
+
+    async def test_classifies_vision_models(self):
+        with FakeOllama(self.reply):
+            data = (await self.async_client.get(self.url)).json()
+        self.assertEqual(data['vision_models'], ['llava:7b', 'minicpm-v:8b'])
+        self.assertTrue(data['llava_available'])
+        self.assertTrue(data['ollama_available'])
+        self.assertEqual([model['vision'] for model in data['models']], [True, False, True])
+
+    async def test_page_loads_within_ttl_share_one_upstream_call(self):
+        with FakeOllama(self.reply) as fake:
+            for _ in range(5):
+                await self.async_client.get(self.url)
+        self.assertEqual([path for path, body in fake.calls], ['/api/tags'])
+
+    async def expire_inventory(self):
+        inventory = await caches['default'].aget(model_registry.CACHE_KEY)
+        inventory['fetched_at'] -= settings.OLLAMA_MODELS_TTL + 1
+        await caches['default'].aset(model_registry.CACHE_KEY, inventory)
+
+    async def test_inventory_is_refetched_once_the_ttl_has_passed(self):
+        with FakeOllama(self.reply) as fake:
+            await self.async_client.get(self.url)
+            self.tags = {'models': []}
+            await self.expire_inventory()
+            fresh = (await self.async_client.get(self.url)).json()
+            cached = (await self.async_client.get(self.url)).json()
+        self.assertEqual(fresh['models'], [])
+        self.assertEqual(cached['models'], [])
+        self.assertEqual([path for path, body in fake.calls], ['/api/tags', '/api/tags'])
+
+    @override_settings(OLLAMA_MODELS_REFRESH_TIMEOUT=0.1)
+    async def test_stale_inventory_is_served_while_refreshing(self):
+        with FakeOllama(self.reply) as fake:
+            await self.async_client.get(self.url)
+            self.tags = {'models': []}
+            fake.server.reply = lambda path, body: (200, [0.3, self.tags])
+            await self.expire_inventory()
+            stale = (await self.async_client.get(self.url)).json()
+            await asyncio.sleep(0.4)
+            fresh = (await self.async_client.get(self.url)).json()
+        self.assertEqual(len(stale['models']), 3)
+        self.assertEqual(fresh['models'], [])
+        self.assertEqual(len(fake.calls), 2)
+
+    @override_settings(OLLAMA_MODELS_TTL=0, OLLAMA_URL='http://127.0.0.1:9')
+    async def test_failed_inventory_is_not_kept_forever(self):
+        await self.async_client.get(self.url)
+        self.assertIsNotNone(await caches['default'].aget(model_registry.CACHE_KEY))
+        await asyncio.sleep(1.1)
+        self.assertIsNone(await caches['default'].aget(model_registry.CACHE_KEY))
+
+    async def test_unreachable_ollama_is_reported(self):
+        with override_settings(OLLAMA_URL='http://127.0.0.1:9'):
+            data = (await self.async_client.get(self.url)).json()
+        self.assertFalse(data['ollama_available'])
+        self.assertEqual(data['vision_models'], [])
+
+
+class ChatOrchestrationTests(OllamaTestCase):
+    url = '/api/chat/'
+    tags = {'models': [{'name': 'llava:7b'}, {'name': 'gemma3:4b'}]}
+
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+
+    def fake(self, generate):
+        def reply(path, body):
+            if path == '/api/tags':
+                return 200, [self.tags]
+            return generate(body)
+        return FakeOllama(reply)
+
+    def post_image(self, message=''):
+        upload = SimpleUploadedFile('dog.jpg', photo_bytes((640, 480)), content_type='image/jpeg')
+        return self.async_client.post(self.url, {'message': message, 'image': upload})
+
+    async def test_text_message_uses_text_model(self):
+        with self.fake(lambda body: (200, token_stream('A Beagle'))) as fake:
+            response = await self.async_client.post(
+                self.url, {'message': 'small hound, floppy ears'}, content_type='application/json'
+            )
+        data = response.json()
+        self.assertEqual(data['response'], 'A Beagle')
+        self.assertEqual(data['model'], 'gemma3:4b')
+        self.assertEqual([step['step'] for step in data['steps']], ['describe'])
+        self.assertIn('floppy ears', fake.calls[0][1]['prompt'])
+
+    async def test_empty_vision_answer_retries_with_simple_prompt(self):
+        def generate(body):
+            if body['prompt'].startswith('What specific breed'):
+                return 200, token_stream('Pug')
+            return 200, token_stream('')
+
+        with self.fake(generate):
+            data = (await self.post_image()).json()
+        self.assertEqual(data['response'], 'Pug')
+        self.assertEqual(data['model'], 'llava:7b')
+        self.assertEqual([(s['step'], s['status']) for s in data['steps']], [('identify', 'empty'), ('retry_simple_prompt', 'ok')])
+
+    @override_settings(CHAT_STEP_TIMEOUT=0.2)
+    async def test_slow_vision_model_falls_back_to_text_within_deadlines(self):
+        def generate(body):
+            if body.get('images'):
+                return 200, [1.0] + token_stream('too late')
+            return 200, token_stream('Common breeds...')
+
+        with self.fake(generate):
+            started = time.monotonic()
+            data = (await self.post_image()).json()
+            elapsed = time.monotonic() - started
+        self.assertTrue(data['response'].endswith('Common breeds...'))
+        self.assertEqual([s['status'] for s in data['steps']], ['timeout', 'timeout', 'ok'])
+        self.assertLess(elapsed, 1.0)
+
+    async def test_without_vision_models_answers_from_text_model(self):
+        self.tags = {'models': [{'name': 'gemma3:4b'}]}
+        with self.fake(lambda body: (200, token_stream('General info'))) as fake:
+            data = (await self.post_image()).json()
+        self.assertEqual(data['response'], 'General info')
+        self.assertNotIn('images', fake.calls[-1][1])
+
+    @override_settings(OLLAMA_MAX_CONCURRENCY=1, OLLAMA_MAX_QUEUE=0)
+    async def test_busy_backend_is_reported_without_fallbacks(self):
+        with self.fake(lambda body: (200, token_stream('Beagle', delay=0.3))):
+            first, second = await asyncio.gather(
+                self.async_client.post(self.url, {'message': 'one'}, content_type='application/json'),
+                self.async_client.post(self.url, {'message': 'two'}, content_type='application/json'),
+            )
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+
+    async def test_requires_message_or_image(self):
+        for body in ({'message': ' '}, [], '"x"', 1):
+            with self.subTest(body=body):
+                response = await self.async_client.post(self.url, body, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
@@ -8,6 +8,10 @@ urlpatterns = [
     path('', views.landing_page, name='landing'),
     path('chatbot/', views.chatbot, name='chatbot'),
     path('api/ollama/', views.ollama_proxy, name='ollama_proxy'),  # This URL is accessed as /api/ollama/
+    path('api/chat/', views.chat_identify, name='chat_identify'),
+    path('api/ollama/models/', views.ollama_models, name='ollama_models'),
+    path('api/ollama/cache-stats/', views.ollama_cache_stats, name='ollama_cache_stats'),
+    path('api/ollama/queue-stats/', views.ollama_queue_stats, name='ollama_queue_stats'),
     path('register/', views.register, name='register'),
     path('login/', auth_views.LoginView.as_view(template_name='breed_finder/login.html'), name='login'),
     path('logout/', auth_views.LogoutView.as_view(next_page='breed_finder:login'), name='logout'),
@@ -39,8 +43,14 @@ urlpatterns = [
     
     # Pet management URLs
     path('pets/', views.pet_list, name='pet_list'),
+    path('api/pets/', views.pet_list_api, name='pet_list_api'),
+    path('api/pets/similar/', views.similar_pets, name='similar_pets'),
+    path('api/pets/<int:pet_id>/similar/', views.pet_similar_pets, name='pet_similar_pets'),
     path('pets/add/', views.add_pet, name='add_pet'),
     path('pets/<int:pet_id>/', views.pet_detail, name='pet_detail'),
     path('pets/<int:pet_id>/edit/', views.edit_pet, name='edit_pet'),
     path('pets/<int:pet_id>/delete/', views.delete_pet, name='delete_pet'),
+    
+    # Resized photo variants, rendered on first request
+    path('images/<int:width>/<str:fmt>/<path:name>', views.image_variant, name='image_variant'),
 ]
\ No newline at end of file
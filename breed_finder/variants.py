@@ -0,0 +1,134 @@
+"""
+Resized WebP and JPEG variants of uploaded photos.
+
+Pet photos and profile pictures are stored at their full upload resolution.
+Templates ask for variants at each width in IMAGE_VARIANT_WIDTHS through the
+``responsive_image`` tag, which builds a WebP and a JPEG ``srcset``. Variants
+are written next to the media under IMAGE_VARIANT_DIR and act as a
+persistent on-disk cache. They are rendered by a background task after an
+upload, by the generate_image_variants command, or on the first request for
+one that is missing (see views.image_variant).
+"""
+import io
+import posixpath
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from PIL import Image, ImageOps, UnidentifiedImageError
+from taskqueue.runner import task
+
+from .images import InvalidImage
+
+# URL extension -> (Pillow format, content type)
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpg': ('JPEG', 'image/jpeg'),
+}
+
+# Upload folders that variants may be rendered from
+VARIANT_SOURCES = ('pets/', 'profile_pictures/')
+
+
+def variant_name(name, width, fmt):
+    stem = posixpath.splitext(name)[0]
+    return f'{settings.IMAGE_VARIANT_DIR}/{width}/{stem}.{fmt}'
+
+
+def is_allowed(name, width, fmt):
+    return (
+        width in settings.IMAGE_VARIANT_WIDTHS
+        and fmt in VARIANT_FORMATS
+        and name.startswith(VARIANT_SOURCES)
+        and '..' not in name.split('/')
+    )
+
+
+def render_variant(source, width, fmt):
+    """Return ``source`` scaled down to ``width`` pixels wide and encoded as ``fmt``."""
+    image_format = VARIANT_FORMATS[fmt][0]
+    try:
+        with Image.open(source) as image:
+            image.draft('RGB', (width, 1))
+            image = ImageOps.exif_transpose(image)
+            if image.width > width:
+                height = max(1, round(image.height * width / image.width))
+                image = image.resize((width, height), Image.Resampling.LANCZOS)
+            if image.mode in ('RGBA', 'LA', 'P') and image_format == 'JPEG':
+                # JPEG has no alpha channel: flatten transparent screenshots onto white
+                rgba = image.convert('RGBA')
+                image = Image.new('RGB', rgba.size, (255, 255, 255))
+                image.paste(rgba, mask=rgba.getchannel('A'))
+            elif image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGB')
+            output = io.BytesIO()
+            if image_format == 'JPEG':
+                image.save(output, format='JPEG', quality=settings.IMAGE_VARIANT_QUALITY, optimize=True, progressive=True)
+            else:
+                image.save(output, format='WEBP', quality=settings.IMAGE_VARIANT_QUALITY, method=4)
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise InvalidImage(f'Could not read image: {e}') from e
+    return output.getvalue()
+
+
+def ensure_variant(name, width, fmt, storage=default_storage, force=False):
+    """
+    Return the storage name of a variant, rendering it from the original if
+    it is not on disk yet. Raises FileNotFoundError or InvalidImage if the
+    original is missing or unreadable.
+    """
+    target = variant_name(name, width, fmt)
+    if storage.exists(target):
+        if not force:
+            return target
+        storage.delete(target)
+    with storage.open(name, 'rb') as f:
+        data = render_variant(f, width, fmt)
+    saved = storage.save(target, ContentFile(data))
+    if saved != target:
+        # Another request rendered it first; keep theirs
+        storage.delete(saved)
+    return target
+
+
+def generate_variants(name, storage=default_storage, force=False):
+    """Render every width and format of one photo; return how many were written."""
+    written = 0
+    for width in settings.IMAGE_VARIANT_WIDTHS:
+        for fmt in VARIANT_FORMATS:
+            if force or not storage.exists(variant_name(name, width, fmt)):
+                ensure_variant(name, width, fmt, storage, force)
+                written += 1
+    return written
+
+
+@task(max_attempts=3)
+def render_image_variants(name):
+    try:
+        generate_variants(name)
+    except (FileNotFoundError, InvalidImage):
+        # Retrying cannot fix a missing or unreadable upload
+        pass
+
+
+def generate_on_upload(image):
+    """Queue the variants of a just-saved upload for the background worker."""
+    if image and image.name.startswith(VARIANT_SOURCES):
+        render_image_variants.enqueue(key=f'image-variants:{image.name}', name=image.name)
+
+
+def variant_url(name, width, fmt, storage=default_storage):
+    # Rendered variants are served straight from media; missing ones go
+    # through the view that renders them on first request
+    target = variant_name(name, width, fmt)
+    if storage.exists(target):
+        return storage.url(target)
+    return reverse('breed_finder:image_variant', args=[width, fmt, name])
+
+
+def srcset(image, fmt):
+    return ', '.join(
+        f'{variant_url(image.name, width, fmt, image.storage)} {width}w'
+        for width in settings.IMAGE_VARIANT_WIDTHS
+    )
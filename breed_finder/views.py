@@ -3,15 +3,25 @@ from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.contrib.auth.decorators import user_passes_test
-from django.http import JsonResponse, HttpResponse
+from django.http import FileResponse, Http404, JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.db.models import Count, Q
 from django.utils.http import urlsafe_base64_decode
 from django.utils.encoding import force_str
+from django.urls import reverse
+from django.conf import settings
+from django.core.files.storage import default_storage
 import json
-import requests
-from verify_email.email_handler import send_verification_email
+from asgiref.sync import sync_to_async
 from .forms import CustomUserCreationForm, PetForm, UserUpdateForm, ProfileUpdateForm
+from . import chat, ollama, result_cache, similarity, variants
+from .images import InvalidImage, prepare_images
+from .model_registry import get_inventory
 from .models import CustomUser, Pet, UserProfile
+from .pagination import InvalidCursor, get_page_size, paginate_pets
+from .scheduler import get_scheduler
+from .search import search_pets
+from .tasks import send_activation_email
 from payment.models import Payment
 from .tokens import account_activation_token
 
@@ -47,19 +57,15 @@ def register(request):
                         'verification_link': verification_link
                     })
                 else:
-                    # In production, use the normal email verification flow
-                    # send_verification_email returns either an inactive_user object or False
-                    result = send_verification_email(request, form)
-                    
-                    # Check if we got a valid user object back
-                    if result and hasattr(result, 'email'):
-                        return render(request, 'breed_finder/email_sent.html', {
-                            'email': result.email
-                        })
-                    else:
-                        # This handles the case when send_verification_email returns False
-                        messages.error(request, 'Failed to send verification email. Please try again.')
-                        return render(request, 'breed_finder/register.html', {'form': form})
+                    # In production, save the inactive user and let the task
+                    # worker send the verification email
+                    user = form.save(commit=False)
+                    user.is_active = False
+                    user.save()
+                    send_activation_email.enqueue(key=f'activation-email:{user.pk}', user_id=user.pk)
+                    return render(request, 'breed_finder/email_sent.html', {
+                        'email': user.email
+                    })
             except Exception as e:
                 messages.error(request, f'Error sending verification email: {str(e)}')
                 return render(request, 'breed_finder/register.html', {'form': form})
@@ -69,13 +75,12 @@ def register(request):
 
 @login_required
 def landing_page(request):
-    # Get only the 6 most recent available pets for the homepage
-    pets = Pet.objects.filter(status='AVAILABLE').order_by('-created_at')[:6]
-    # Count total available pets to determine if we need the 'View All' button
-    total_available_pets = Pet.objects.filter(status='AVAILABLE').count()
+    # Get only the 6 most recent available pets for the homepage; the page
+    # already knows whether more exist, so no separate count() is needed
+    page = paginate_pets(Pet.objects.filter(status='AVAILABLE'), page_size=6)
     return render(request, 'breed_finder/landing.html', {
-        'pets': pets,
-        'show_view_all': total_available_pets > 6
+        'pets': page.items,
+        'show_view_all': page.has_next
     })
 
 def chatbot(request):
@@ -85,23 +90,141 @@ def chatbot(request):
         'dog_count': dog_count
     })
 
+def ollama_error_response(error):
+    response = JsonResponse({'error': str(error)}, status=error.status)
+    if error.retry_after:
+        response['Retry-After'] = str(error.retry_after)
+    return response
+
+def cached_response(result, stream):
+    if stream:
+        response = HttpResponse(json.dumps(result) + '\n', content_type='application/x-ndjson')
+    else:
+        response = JsonResponse(result)
+    response['X-Cache'] = 'HIT'
+    return response
+
+async def read_generate_request(request):
+    """
+    Build an Ollama /api/generate payload from a JSON body or a multipart upload.
+
+    Multipart requests carry the payload fields as form fields and the photos
+    as ``image`` files, so the browser does not have to base64 them. Either
+    way the images are downscaled and re-encoded before being forwarded.
+    """
+    if request.content_type == 'multipart/form-data':
+        data = request.POST.dict()
+        if 'options' in data:
+            data['options'] = json.loads(data['options'])
+        if 'stream' in data:
+            data['stream'] = data['stream'].lower() not in ('false', '0')
+        images = request.FILES.getlist('image')
+    else:
+        data = json.loads(request.body)
+        if not isinstance(data, dict):
+            raise ValueError('The JSON body must be an object')
+        images = data.get('images') or []
+    
+    if images:
+        # Pillow work is CPU bound, so keep it off the event loop
+        data['images'] = await sync_to_async(prepare_images, thread_sensitive=False)(images)
+    return data
+
 @csrf_exempt
-def ollama_proxy(request):
-    if request.method == 'POST':
+async def ollama_proxy(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
+    
+    try:
+        data = await read_generate_request(request)
+    except InvalidImage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+    
+    # Ollama streams by default; honour "stream": false with a single JSON reply
+    stream = data.get('stream', True) is not False
+    
+    # Identical model/prompt/image requests are answered from the result cache
+    use_cache = 'no-cache' not in request.headers.get('Cache-Control', '')
+    if use_cache:
+        cached = await result_cache.get_result(data)
+        if cached is not None:
+            return cached_response(cached, stream)
+    
+    # Identical requests already queued or running share one upstream call;
+    # wait for its first line so errors still get a proper status code
+    try:
+        generation = get_scheduler().generation(data, store=use_cache)
+        lines = generation.subscribe()
+        first_line = await anext(lines, '')
+    except ollama.OllamaError as e:
+        return ollama_error_response(e)
+    
+    if not stream:
+        received = [first_line] if first_line else []
         try:
-            # Forward the request to Ollama API
-            ollama_url = 'http://localhost:11434/api/generate'
+            received += [line async for line in lines]
+        except ollama.OllamaError as e:
+            return ollama_error_response(e)
+        response = JsonResponse(result_cache.combine_lines(received))
+        response['X-Cache'] = 'MISS'
+        return response
+    
+    # Relay the rest of the NDJSON token stream as it arrives
+    async def relay():
+        yield first_line
+        async for line in lines:
+            yield line
+    
+    response = StreamingHttpResponse(relay(), content_type='application/x-ndjson')
+    response['X-Cache'] = 'MISS'
+    return response
+
+@user_passes_test(lambda u: u.is_staff)
+def ollama_cache_stats(request):
+    return JsonResponse(result_cache.stats())
+
+@csrf_exempt
+async def chat_identify(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
+    
+    try:
+        if request.content_type == 'multipart/form-data':
+            message = request.POST.get('message', '')
+            images = request.FILES.getlist('image')
+        else:
             data = json.loads(request.body)
-            
-            # Make the request to Ollama
-            response = requests.post(ollama_url, json=data)
-            
-            # Return the response from Ollama
-            return JsonResponse(response.json())
-        except Exception as e:
-            return JsonResponse({'error': str(e)}, status=500)
+            if not isinstance(data, dict):
+                return JsonResponse({'error': 'The JSON body must be an object'}, status=400)
+            message = data.get('message', '')
+            images = data.get('images') or []
+        if images:
+            images = await sync_to_async(prepare_images, thread_sensitive=False)(images)
+    except InvalidImage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON body'}, status=400)
     
-    return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
+    if not message.strip() and not images:
+        return JsonResponse({'error': 'A message or an image is required'}, status=400)
+    
+    # The whole vision/retry/text fallback chain runs here with per-step deadlines
+    try:
+        return JsonResponse(await chat.identify(message.strip(), images))
+    except ollama.OllamaError as e:
+        return ollama_error_response(e)
+
+async def ollama_models(request):
+    return JsonResponse(await get_inventory())
+
+async def ollama_queue_stats(request):
+    # Scheduler state lives on the event loop, so this view must be async too
+    user = await request.auser()
+    if not user.is_staff:
+        return JsonResponse({'error': 'Staff only'}, status=403)
+    return JsonResponse(get_scheduler().stats())
 
 @user_passes_test(lambda u: u.is_staff)
 def add_pet(request):
@@ -137,39 +260,137 @@ def delete_pet(request, pet_id):
         return redirect('breed_finder:pet_list')
     return render(request, 'breed_finder/pet_confirm_delete.html', {'pet': pet})
 
-@login_required
-def pet_list(request):
+def breed_counts(breed_ids):
+    """Return {breed id: (total, available)} for the given canonical breeds."""
+    ids = {breed_id for breed_id in breed_ids if breed_id is not None}
+    if not ids:
+        return {}
+    rows = (
+        Pet.objects.filter(canonical_breed_id__in=ids)
+        .values('canonical_breed_id')
+        .annotate(total=Count('id'), available=Count('id', filter=Q(status='AVAILABLE')))
+    )
+    return {row['canonical_breed_id']: (row['total'], row['available']) for row in rows}
+
+def attach_breed_counts(pets):
+    # Set breed_total/breed_available on each pet from one aggregate query
+    counts = breed_counts(pet.canonical_breed_id for pet in pets)
+    for pet in pets:
+        pet.breed_total, pet.breed_available = counts.get(pet.canonical_breed_id, (0, 0))
+    return pets
+
+def get_pet_page(request):
     # Get search query from request
     search_query = request.GET.get('search', '')
     
     # Start with all pets
     pets = Pet.objects.all()
     
-    # Apply search filter if a query is provided
-    if search_query:
-        # Case-insensitive search on breed field
-        pets = pets.filter(breed__icontains=search_query)
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+    page_size = get_page_size(request.GET.get('page_size'))
     
-    # Order by creation date (newest first)
-    pets = pets.order_by('-created_at')
+    if search_query:
+        # Ranked full-text search over name, breed and description
+        page = search_pets(pets, search_query, after=after, before=before, page_size=page_size)
+    else:
+        # Fetch one page ordered by creation date (newest first)
+        page = paginate_pets(pets, after=after, before=before, page_size=page_size)
     
-    # Get breed counts for each pet
-    for pet in pets:
-        pet.breed_total = Pet.objects.filter(breed__iexact=pet.breed).count()
-        pet.breed_available = Pet.objects.filter(breed__iexact=pet.breed, status='AVAILABLE').count()
+    # Get breed counts for all listed breeds in a single grouped query
+    attach_breed_counts(page.items)
+    return page, search_query
+
+def pet_to_dict(pet):
+    return {
+        'id': pet.id,
+        'name': pet.name,
+        'breed': pet.breed,
+        'age': pet.age_display,
+        'gender': pet.get_gender_display(),
+        'status': pet.status,
+        'price': str(pet.price),
+        'image': pet.image.url if pet.image else None,
+        'url': reverse('breed_finder:pet_detail', args=[pet.id]),
+        'breed_total': getattr(pet, 'breed_total', None),
+        'breed_available': getattr(pet, 'breed_available', None),
+    }
+
+@login_required
+def pet_list(request):
+    try:
+        page, search_query = get_pet_page(request)
+    except InvalidCursor:
+        return redirect('breed_finder:pet_list')
     
     return render(request, 'breed_finder/pet_list.html', {
-        'pets': pets,
+        'pets': page.items,
+        'page': page,
         'search_query': search_query
     })
 
+@login_required
+def pet_list_api(request):
+    try:
+        page, search_query = get_pet_page(request)
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    return JsonResponse({
+        'results': [pet_to_dict(pet) for pet in page.items],
+        'next': page.next_cursor,
+        'previous': page.previous_cursor,
+        'suggestion': getattr(page, 'suggestion', None),
+    })
+
+def similar_pets_response(embedding, count, exclude=()):
+    pets = similarity.similar_pets(embedding, count, exclude)
+    return JsonResponse({
+        'results': [{**pet_to_dict(pet), 'similarity': pet.similarity} for pet in pets],
+    })
+
+@login_required
+def pet_similar_pets(request, pet_id):
+    # Pets that look like one from the catalog
+    pet = get_object_or_404(Pet, id=pet_id)
+    if pet.embedding is None:
+        return JsonResponse({'results': []})
+    count = get_page_size(request.GET.get('count') or settings.PET_SIMILAR_COUNT)
+    return similar_pets_response(pet.embedding, count, {pet.id})
+
+@login_required
+def similar_pets(request):
+    # Pets that look like an uploaded photo
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
+    # Checked before the body is read, so an oversized upload is never spooled to disk
+    if int(request.META.get('CONTENT_LENGTH') or 0) > settings.PET_SIMILAR_MAX_UPLOAD:
+        return JsonResponse({'error': 'The image is too large'}, status=413)
+    count = get_page_size(request.GET.get('count') or settings.PET_SIMILAR_COUNT)
+    try:
+        if request.content_type == 'multipart/form-data':
+            upload = request.FILES.get('image')
+            image = upload.read() if upload else None
+        else:
+            data = json.loads(request.body)
+            if not isinstance(data, dict):
+                return JsonResponse({'error': 'The JSON body must be an object'}, status=400)
+            image = data.get('image')
+        if not image:
+            return JsonResponse({'error': 'An image is required'}, status=400)
+        embedding = similarity.image_embedding(image)
+    except InvalidImage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+    return similar_pets_response(embedding, count)
+
 @login_required
 def pet_detail(request, pet_id):
     pet = get_object_or_404(Pet, id=pet_id)
     
     # Count total and available dogs of this breed
-    breed_total = Pet.objects.filter(breed__iexact=pet.breed).count()
-    breed_available = Pet.objects.filter(breed__iexact=pet.breed, status='AVAILABLE').count()
+    breed_total, breed_available = breed_counts([pet.canonical_breed_id]).get(pet.canonical_breed_id, (0, 0))
     
     if request.method == 'POST':
         if pet.status == 'AVAILABLE':
@@ -187,6 +408,20 @@ def pet_detail(request, pet_id):
         'breed_available': breed_available
     })
 
+def image_variant(request, width, fmt, name):
+    # Render a missing photo variant on first request; later requests find it
+    # on disk and templates then link to the media URL directly
+    if not variants.is_allowed(name, width, fmt):
+        raise Http404('Unknown image variant')
+    try:
+        target = variants.ensure_variant(name, width, fmt)
+    except (FileNotFoundError, InvalidImage):
+        raise Http404('Image not found')
+    
+    response = FileResponse(default_storage.open(target, 'rb'), content_type=variants.VARIANT_FORMATS[fmt][1])
+    response['Cache-Control'] = 'public, max-age=2592000'
+    return response
+
 @login_required
 def user_profile(request):
     # Get user's adoptions (completed payments)
@@ -198,18 +433,22 @@ def user_profile(request):
 
 @login_required
 def edit_profile(request):
+    profile = request.user.get_profile()
     if request.method == 'POST':
         user_form = UserUpdateForm(request.POST, instance=request.user)
-        profile_form = ProfileUpdateForm(request.POST, request.FILES, instance=request.user.profile)
+        profile_form = ProfileUpdateForm(request.POST, request.FILES, instance=profile)
         
         if user_form.is_valid() and profile_form.is_valid():
-            user_form.save()
-            profile_form.save()
+            # Only write the rows whose fields actually changed
+            if user_form.has_changed():
+                user_form.save()
+            if profile_form.has_changed():
+                profile_form.save()
             messages.success(request, 'Your profile has been updated successfully!')
             return redirect('breed_finder:user_profile')
     else:
         user_form = UserUpdateForm(instance=request.user)
-        profile_form = ProfileUpdateForm(instance=request.user.profile)
+        profile_form = ProfileUpdateForm(instance=profile)
     
     return render(request, 'breed_finder/edit_profile.html', {
         'user_form': user_form,
@@ -0,0 +1,64 @@
+"""
+SQLite tuning for concurrent use.
+
+Every new SQLite connection runs SQLITE_PRAGMAS. WAL journaling lets readers
+and a writer work at the same time instead of locking each other out.
+synchronous=NORMAL is durable across application crashes in WAL mode.
+mmap_size and cache_size keep the hot pages in memory, and busy_timeout
+makes a blocked writer wait instead of failing with "database is locked".
+Connections are not kept between requests: under ASGI, the only supported
+server, DB_CONN_MAX_AGE stays 0 (see DATABASES in settings).
+
+With DATABASE_READ_REPLICA on, ReadWriteRouter sends reads outside a
+transaction to a second connection to the same file that is opened
+read-only (PRAGMA query_only), so catalog reads never queue behind a
+write transaction on the default connection.
+"""
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+def apply_pragmas(cursor, pragmas):
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def is_in_memory(name):
+    name = str(name)
+    return name == ':memory:' or 'mode=memory' in name
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = dict(settings.SQLITE_PRAGMAS)
+    if is_in_memory(connection.settings_dict['NAME']):
+        # In-memory databases have no journal file to switch to WAL
+        pragmas.pop('journal_mode', None)
+    if connection.alias == settings.DATABASE_READ_ALIAS:
+        pragmas['query_only'] = 'ON'
+    with connection.cursor() as cursor:
+        apply_pragmas(cursor, pragmas)
+
+
+class ReadWriteRouter:
+    """Send reads to DATABASE_READ_ALIAS unless the default connection is inside a transaction."""
+
+    def db_for_read(self, model, **hints):
+        # Inside a transaction, read through the same connection to see its own writes
+        if connections['default'].in_atomic_block:
+            return 'default'
+        return settings.DATABASE_READ_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases are the same database file
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
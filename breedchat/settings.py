@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 import os
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -48,6 +49,7 @@ INSTALLED_APPS = [
     "corsheaders",
     "breed_finder",
     "payment",
+    "taskqueue",
 ]
 
 MIDDLEWARE = [
@@ -80,6 +82,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "breedchat.wsgi.application"
+ASGI_APPLICATION = "breedchat.asgi.application"
 
 
 # Database
@@ -89,9 +92,38 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Keep 0: the app is served over ASGI only (see breedchat/wsgi.py), and
+        # there async views run the ORM on threads that Django's request cleanup
+        # does not reach, so persistent connections pile up instead of being reused.
+        "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", 0)),
+        "CONN_HEALTH_CHECKS": True,
+        "OPTIONS": {"timeout": 5},  # Seconds a connection waits for a lock held by another one
+        # A file rather than the in-memory default, so threaded tests get real
+        # SQLite locking (busy waits) instead of shared-cache "table is locked" errors
+        "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
     }
 }
 
+# Applied to every new SQLite connection by breedchat.db.configure_sqlite
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # Readers and a writer no longer block each other
+    "synchronous": "NORMAL",  # Safe with WAL; fsyncs at checkpoints instead of every commit
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000)),  # Milliseconds to wait on a lock
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    "cache_size": -int(os.getenv("SQLITE_CACHE_KB", 20000)),  # Negative means KiB rather than pages
+    "temp_store": "MEMORY",
+}
+
+# Optional read-only connection for reads outside transactions (see breedchat/db.py)
+DATABASE_READ_REPLICA = os.getenv("DATABASE_READ_REPLICA", "False") == "True"
+DATABASE_READ_ALIAS = "replica"
+if DATABASE_READ_REPLICA:
+    DATABASES[DATABASE_READ_ALIAS] = {
+        **DATABASES["default"],
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_ROUTERS = ["breedchat.db.ReadWriteRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -135,6 +167,20 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Resized WebP/JPEG copies of uploaded photos, used for srcset (see breed_finder/variants.py)
+IMAGE_VARIANT_WIDTHS = [320, 640, 960]
+IMAGE_VARIANT_QUALITY = 80
+IMAGE_VARIANT_DIR = 'variants'  # Under MEDIA_ROOT
+
+# Pet catalog pagination
+PET_LIST_PAGE_SIZE = int(os.getenv('PET_LIST_PAGE_SIZE', 24))
+PET_LIST_MAX_PAGE_SIZE = 100
+
+# Similar-pet search
+PET_SIMILAR_COUNT = 6  # Pets returned by the similar-pets API by default
+PET_SIMILARITY_REFRESH = int(os.getenv('PET_SIMILARITY_REFRESH', 300))  # Seconds before a process reloads its index
+PET_SIMILAR_MAX_UPLOAD = int(os.getenv('PET_SIMILAR_MAX_UPLOAD', 5 * 1024 * 1024))  # Largest request, in bytes, the photo search accepts
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -178,12 +224,110 @@ EMAIL_FROM = EMAIL_HOST_USER
 EMAIL_TOKEN_LIFE = 60 * 60  # 1 hour
 EMAIL_MULTI_USER = False  # Prevent multiple users with same email
 
+# Background tasks (run with: python manage.py run_tasks)
+TASKS_RETRY_BACKOFF = 10  # Seconds before the first retry; doubles on each attempt
+TASKS_RETRY_MAX_DELAY = 60 * 60
+TASKS_LOCK_TIMEOUT = 10 * 60  # Seconds before a task left RUNNING by a dead worker is retried
+TASKS_POLL_INTERVAL = 1.0  # Seconds the worker sleeps when the queue is empty
+
 # Payment Settings
 KHALTI_SECRET_KEY = os.getenv('KHALTI_SECRET_KEY', 'test_secret_key_dc74e0fd57cb46cd93832aee0a507bbc')
 KHALTI_PUBLIC_KEY = os.getenv('KHALTI_PUBLIC_KEY', 'test_public_key_dc74e0fd57cb46cd93832aee0a390234')
 ESEWA_SECRET_KEY = os.getenv('ESEWA_SECRET_KEY', '8gBm/:&EnhH.1/q')  # Test secret key
 ESEWA_CLIENT_ID = os.getenv('ESEWA_CLIENT_ID', 'JB0BBQ4aD0UqIThFJwAKBgAXEUkEGQUBBAwdOgABHD4DChwUAB0R')
 ESEWA_MERCHANT_CODE = os.getenv('ESEWA_MERCHANT_CODE', 'EPAYTEST')
+KHALTI_API_URL = os.getenv('KHALTI_API_URL', 'https://a.khalti.com/api/v2/')
+ESEWA_API_URL = os.getenv('ESEWA_API_URL', 'https://uat.esewa.com.np/')
+GATEWAY_CONNECT_TIMEOUT = 5
+GATEWAY_READ_TIMEOUT = float(os.getenv('GATEWAY_READ_TIMEOUT', 15))
+GATEWAY_POOL_SIZE = int(os.getenv('GATEWAY_POOL_SIZE', 10))  # Keep-alive connections per gateway
+GATEWAY_FAILURE_THRESHOLD = 5  # Consecutive failures that open a gateway's circuit
+GATEWAY_RESET_TIMEOUT = 30  # Seconds an open circuit waits before a trial call
+PAYMENT_RESERVATION_MINUTES = int(os.getenv('PAYMENT_RESERVATION_MINUTES', 15))  # How long checkout holds a pet
+PAYMENT_RETENTION_DAYS = int(os.getenv('PAYMENT_RETENTION_DAYS', 365))  # Failed/expired payments older than this are archived
+PAYMENT_SWEEP_BATCH_SIZE = 1000
+PAYMENT_RECONCILE_WORKERS = int(os.getenv('PAYMENT_RECONCILE_WORKERS', 8))  # Concurrent gateway status lookups
+PAYMENT_RECONCILE_MIN_AGE = 10  # Minutes before an unfinished checkout is reconciled
+PAYMENT_RECONCILE_EXPIRED_WINDOW = int(os.getenv('PAYMENT_RECONCILE_EXPIRED_WINDOW', 120))  # Minutes after checkout an expired payment is still reconciled; gateway links last about an hour
+
+# Ollama Settings
+OLLAMA_URL = os.getenv('OLLAMA_URL', 'http://localhost:11434')
+OLLAMA_TIMEOUT = float(os.getenv('OLLAMA_TIMEOUT', 120))  # Read timeout between streamed tokens
+OLLAMA_CONNECT_TIMEOUT = 5
+OLLAMA_MAX_CONNECTIONS = int(os.getenv('OLLAMA_MAX_CONNECTIONS', 20))
+OLLAMA_MAX_CONCURRENCY = int(os.getenv('OLLAMA_MAX_CONCURRENCY', 2))  # Generations running at once
+OLLAMA_MAX_QUEUE = int(os.getenv('OLLAMA_MAX_QUEUE', 20))  # Requests waiting before 429s
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv('OLLAMA_QUEUE_TIMEOUT', 60))  # Seconds in the queue before a 503
+OLLAMA_RETRY_AFTER = 5  # Seconds suggested in Retry-After on 429/503
+OLLAMA_MODELS_TTL = int(os.getenv('OLLAMA_MODELS_TTL', 30))  # Seconds before the model list is refreshed
+OLLAMA_MODELS_REFRESH_TIMEOUT = float(os.getenv('OLLAMA_MODELS_REFRESH_TIMEOUT', 2))  # Seconds a page waits for a stale model list to refresh
+OLLAMA_TEXT_MODEL = os.getenv('OLLAMA_TEXT_MODEL', 'gemma3:4b')  # Text-only fallback model
+CHAT_STEP_TIMEOUT = float(os.getenv('CHAT_STEP_TIMEOUT', 90))  # Deadline for each step of the chatbot fallback chain
+CHAT_DEADLINE = float(os.getenv('CHAT_DEADLINE', 180))  # Deadline for the whole chain
+OLLAMA_IMAGE_MAX_SIZE = int(os.getenv('OLLAMA_IMAGE_MAX_SIZE', 672))  # LLaVA 1.6 native tile size
+OLLAMA_IMAGE_QUALITY = 85
+OLLAMA_CACHE_ALIAS = 'ollama'
+OLLAMA_CACHE_DIR = os.getenv('OLLAMA_CACHE_DIR')  # Optional persistent tier for generation results
+
+# Caches
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Generation results, evicted least-recently-used past MAX_ENTRIES
+    'ollama': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ollama-results',
+        'TIMEOUT': int(os.getenv('OLLAMA_CACHE_TTL', 60 * 60 * 24)),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('OLLAMA_CACHE_MAX_ENTRIES', 500))},
+    },
+}
+if OLLAMA_CACHE_DIR:
+    CACHES['ollama_disk'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': OLLAMA_CACHE_DIR,
+        'TIMEOUT': int(os.getenv('OLLAMA_CACHE_TTL', 60 * 60 * 24)),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('OLLAMA_CACHE_DISK_MAX_ENTRIES', 5000))},
+    }
+
+# Sessions: 'db' reads and writes a django_session row on every request that
+# touches the session, 'cached_db' reads from the "sessions" cache and only
+# writes through to the database, 'cache' never touches the database, and
+# 'signed_cookies' keeps the session in a signed cookie with no server state
+# (logging out cannot revoke a copied cookie).
+# 'cached_db' and 'cache' need a cache every worker process shares
+# (SESSION_CACHE_DIR). With a per-process local memory cache, logging out
+# only clears the session in the process that handled the logout, and the
+# other workers keep accepting the old session cookie.
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'db')
+SESSION_ENGINE = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}[SESSION_BACKEND]
+SESSION_CACHE_ALIAS = 'sessions'
+SESSION_CACHE_DIR = os.getenv('SESSION_CACHE_DIR')  # Shared by all worker processes; required by 'cached_db' and 'cache'
+if SESSION_BACKEND in ('cached_db', 'cache') and not SESSION_CACHE_DIR:
+    raise ImproperlyConfigured(
+        f"SESSION_BACKEND={SESSION_BACKEND!r} needs SESSION_CACHE_DIR, a session cache shared by every worker process"
+    )
+# Local memory is only safe for a single process, e.g. tests and benchmark_sessions
+CACHES['sessions'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'sessions',
+    'OPTIONS': {'MAX_ENTRIES': int(os.getenv('SESSION_CACHE_MAX_ENTRIES', 10000))},
+}
+if SESSION_CACHE_DIR:
+    CACHES['sessions'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': SESSION_CACHE_DIR,
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('SESSION_CACHE_MAX_ENTRIES', 10000))},
+    }
+SESSION_COOKIE_HTTPONLY = True
+
+# Flash messages live in a signed cookie instead of the session
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
 
 # Payment Context Processor
 def payment_context(request):
@@ -219,7 +363,7 @@ CORS_ALLOW_HEADERS = [
 CSRF_COOKIE_SECURE = False  # Set to True in production with HTTPS
 CSRF_COOKIE_HTTPONLY = False  # Set to True for added security in production
 CSRF_COOKIE_SAMESITE = 'Lax'  # Options: 'Strict', 'Lax', 'None' (with secure=True)
-CSRF_USE_SESSIONS = True  # Store CSRF token in session instead of cookie
+CSRF_USE_SESSIONS = os.getenv('CSRF_USE_SESSIONS', 'False') == 'True'  # A session-stored token writes the session of every visitor
 CSRF_FAILURE_VIEW = 'django.views.csrf.csrf_failure'
 
 # Authentication Backends
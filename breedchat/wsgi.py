@@ -1,16 +1,20 @@
 """
 WSGI config for breedchat project.
 
-It exposes the WSGI callable as a module-level variable named ``application``.
+BreedChat is served over ASGI only; run it with
+``uvicorn breedchat.asgi:application``. The Ollama proxy streams its reply
+from an async iterator, and the Ollama client, scheduler and model inventory
+are kept per event loop. Under WSGI each request runs on a fresh event loop,
+so the stream is cut off after the first line and pooling, coalescing and
+queueing silently stop working. Importing this module therefore fails
+instead, which also stops ``manage.py runserver`` at startup.
 
 For more information on this file, see
-https://docs.djangoproject.com/en/5.1/howto/deployment/wsgi/
+https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
-import os
+from django.core.exceptions import ImproperlyConfigured
 
-from django.core.wsgi import get_wsgi_application
-
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "breedchat.settings")
-
-application = get_wsgi_application()
+raise ImproperlyConfigured(
+    "BreedChat must be served over ASGI: run 'uvicorn breedchat.asgi:application' instead of runserver or a WSGI server."
+)
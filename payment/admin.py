@@ -1,9 +1,16 @@
 from django.contrib import admin
-from .models import Payment
+from .models import ArchivedPayment, Payment
 
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user', 'pet', 'amount', 'payment_method', 'payment_status', 'created_at')
+    list_display = ('id', 'user', 'pet', 'amount', 'payment_method', 'payment_status', 'expires_at', 'created_at')
     list_filter = ('payment_method', 'payment_status')
     search_fields = ('user__username', 'user__email', 'pet__name', 'transaction_id')
     readonly_fields = ('created_at',)
+
+
+@admin.register(ArchivedPayment)
+class ArchivedPaymentAdmin(admin.ModelAdmin):
+    list_display = ('payment_id', 'user_id', 'pet_id', 'amount', 'payment_method', 'payment_status', 'created_at', 'archived_at')
+    list_filter = ('payment_method', 'payment_status')
+    search_fields = ('=payment_id', '=user_id', 'transaction_id', 'transaction_uuid')
@@ -0,0 +1,179 @@
+"""
+HTTP clients for the Khalti and eSewa APIs.
+
+Each gateway has one ``requests.Session`` per process with a pooled
+keep-alive adapter, so verifications reuse connections instead of opening a
+new TLS connection per call. Every call has connect and read timeouts
+(GATEWAY_CONNECT_TIMEOUT, GATEWAY_READ_TIMEOUT) and is never retried here;
+callers decide whether to retry, e.g. by queueing a task.
+
+A circuit breaker per gateway counts consecutive failures (connection
+errors, timeouts and 5xx responses). After GATEWAY_FAILURE_THRESHOLD of them
+calls fail fast with GatewayUnavailable for GATEWAY_RESET_TIMEOUT seconds,
+then a single trial call decides whether the circuit closes again.
+
+Latencies are recorded per endpoint in fixed-bucket histograms; ``stats()``
+returns them with the breaker states.
+"""
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+
+class GatewayUnavailable(requests.RequestException):
+    """The circuit is open: the gateway failed repeatedly and is not being called."""
+
+
+# Upper bounds in seconds; slower calls land in the last, open-ended bucket
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def snapshot(self):
+        labels = [f'le_{bound}' for bound in self.buckets] + ['inf']
+        return {
+            'count': self.count,
+            'avg': round(self.total / self.count, 4) if self.count else 0.0,
+            'max': round(self.max, 4),
+            'buckets': dict(zip(labels, self.counts)),
+        }
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a call may go out now."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Let exactly one trial call through
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class GatewayClient:
+    def __init__(self, name, base_url):
+        self.name = name
+        self.base_url = base_url.rstrip('/') + '/'
+        self.timeout = (settings.GATEWAY_CONNECT_TIMEOUT, settings.GATEWAY_READ_TIMEOUT)
+        self.breaker = CircuitBreaker(settings.GATEWAY_FAILURE_THRESHOLD, settings.GATEWAY_RESET_TIMEOUT)
+        self.latency = {}
+        self.stats_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.GATEWAY_POOL_SIZE, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, endpoint, **kwargs):
+        """
+        Call ``endpoint`` (relative to the gateway's base URL) and return the
+        response. Raises GatewayUnavailable while the circuit is open, and
+        the usual requests exceptions on connection errors and timeouts.
+        """
+        if not self.breaker.allow():
+            raise GatewayUnavailable(f'{self.name} is unavailable; not calling it for now')
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, self.base_url + endpoint, timeout=self.timeout, **kwargs)
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise
+        finally:
+            self.observe(endpoint, time.monotonic() - started)
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            # 4xx responses mean the gateway is up and rejected our input
+            self.breaker.record_success()
+        return response
+
+    def post(self, endpoint, **kwargs):
+        return self.request('POST', endpoint, **kwargs)
+
+    def observe(self, endpoint, seconds):
+        with self.stats_lock:
+            self.latency.setdefault(endpoint, Histogram()).observe(seconds)
+
+    def stats(self):
+        with self.stats_lock:
+            latency = {endpoint: histogram.snapshot() for endpoint, histogram in self.latency.items()}
+        return {'circuit': self.breaker.state, 'failures': self.breaker.failures, 'latency': latency}
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(name, base_url):
+    # Keyed on the URL so tests that point a gateway at a stub get a fresh client
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None or client.base_url != base_url.rstrip('/') + '/':
+            if client is not None:
+                client.close()
+            client = _clients[name] = GatewayClient(name, base_url)
+        return client
+
+
+def khalti():
+    return get_client('khalti', settings.KHALTI_API_URL)
+
+
+def esewa():
+    return get_client('esewa', settings.ESEWA_API_URL)
+
+
+def stats():
+    with _clients_lock:
+        clients = list(_clients.values())
+    return {client.name: client.stats() for client in clients}
+
+
+def reset_clients():
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
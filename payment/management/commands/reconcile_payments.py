@@ -0,0 +1,58 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from payment.reconcile import reconcile
+
+OUTCOMES = ('completed', 'conflicts', 'expired', 'cancelled', 'refunded', 'unchanged', 'errors')
+
+
+class Command(BaseCommand):
+    help = ('Checks unresolved PENDING and INITIATED payments, and recently EXPIRED ones, '
+            'with the Khalti and eSewa status APIs')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=100, help='Payments looked up per page')
+        parser.add_argument('--workers', type=int, default=settings.PAYMENT_RECONCILE_WORKERS,
+                            help='Concurrent gateway lookups')
+        parser.add_argument('--limit', type=int, help='Stop after this many payments; resume from the checkpoint')
+        parser.add_argument('--min-age', type=int, default=settings.PAYMENT_RECONCILE_MIN_AGE,
+                            help='Skip payments created less than this many minutes ago')
+        parser.add_argument('--checkpoint', help='File recording the last reconciled payment id')
+        parser.add_argument('--reset', action='store_true', help='Ignore the checkpoint and start from the first payment')
+
+    def handle(self, *args, **options):
+        checkpoint = options['checkpoint']
+        after_id = 0
+        if checkpoint and not options['reset'] and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                after_id = json.load(f)['last_id']
+            self.stdout.write(f"Resuming after payment {after_id}")
+
+        def save_checkpoint(last_id, report):
+            self.stdout.write(f"Checked {report['checked']} payments (up to id {last_id})")
+            if checkpoint:
+                # Write then rename so an interrupted run never leaves a torn file
+                with open(f'{checkpoint}.tmp', 'w') as f:
+                    json.dump({'last_id': last_id}, f)
+                os.replace(f'{checkpoint}.tmp', checkpoint)
+
+        report = reconcile(
+            after_id=after_id,
+            page_size=max(1, options['page_size']),
+            workers=max(1, options['workers']),
+            limit=options['limit'],
+            min_age=options['min_age'],
+            on_page=save_checkpoint,
+        )
+
+        summary = ', '.join(f"{report.get(outcome, 0)} {outcome}" for outcome in OUTCOMES)
+        self.stdout.write(self.style.SUCCESS(f"Reconciled {report.get('checked', 0)} payments: {summary}"))
+        if report['last_id'] is None:
+            # A full pass finished; the next run starts from the beginning
+            if checkpoint and os.path.exists(checkpoint):
+                os.remove(checkpoint)
+            self.stdout.write("No unresolved payments left")
+        else:
+            self.stdout.write(f"Stopped after payment {report['last_id']}; run again to continue")
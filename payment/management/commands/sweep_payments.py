@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from payment.services import archive_payments, expire_payments
+
+
+class Command(BaseCommand):
+    help = 'Expires abandoned checkout reservations and archives old failed or expired payments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.PAYMENT_SWEEP_BATCH_SIZE,
+                            help='Payments updated or archived per query')
+        parser.add_argument('--retention-days', type=int, default=settings.PAYMENT_RETENTION_DAYS,
+                            help='Archive finished payments not updated for this many days')
+        parser.add_argument('--no-archive', action='store_true', help='Only expire reservations')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        expired = expire_payments(batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f"Expired {expired} abandoned payments"))
+        if options['no_archive']:
+            return
+        archived = archive_payments(days=options['retention_days'], batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f"Archived {archived} payments older than {options['retention_days']} days"))
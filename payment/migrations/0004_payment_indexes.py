@@ -0,0 +1,25 @@
+# Generated by Django 5.0.2 on 2026-10-18 15:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("payment", "0003_alter_payment_transaction_uuid"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                fields=["user", "payment_status", "-created_at"],
+                name="payment_user_status_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                fields=["user", "-created_at"], name="payment_user_created_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.0.2 on 2026-10-18 16:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("breed_finder", "0010_pet_embedding"),
+        ("payment", "0004_payment_indexes"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchivedPayment",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("payment_id", models.IntegerField(unique=True)),
+                ("user_id", models.IntegerField(db_index=True)),
+                ("pet_id", models.IntegerField()),
+                ("amount", models.DecimalField(decimal_places=2, max_digits=10)),
+                ("payment_method", models.CharField(max_length=10)),
+                ("payment_status", models.CharField(max_length=10)),
+                (
+                    "transaction_id",
+                    models.CharField(blank=True, max_length=100, null=True),
+                ),
+                (
+                    "transaction_uuid",
+                    models.CharField(blank=True, max_length=36, null=True),
+                ),
+                ("pidx", models.CharField(blank=True, max_length=100, null=True)),
+                ("error_message", models.TextField(blank=True, null=True)),
+                ("created_at", models.DateTimeField()),
+                ("updated_at", models.DateTimeField()),
+                ("archived_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="payment",
+            name="expires_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                fields=["pet", "payment_status", "expires_at"],
+                name="payment_pet_reserved_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                fields=["payment_status", "expires_at"],
+                name="payment_status_expires_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.2 on 2026-10-18 16:28
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("breed_finder", "0010_pet_embedding"),
+        ("payment", "0005_payment_reservations"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                fields=["transaction_id"], name="payment_transaction_id_idx"
+            ),
+        ),
+    ]
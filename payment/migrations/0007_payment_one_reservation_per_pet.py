@@ -0,0 +1,37 @@
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def expire_duplicate_reservations(apps, schema_editor):
+    Payment = apps.get_model("payment", "Payment")
+    reserved = Payment.objects.filter(payment_status__in=("PENDING", "INITIATED"))
+
+    # Keep the newest reservation of each pet; older ones were abandoned checkouts
+    newest = (
+        reserved.values("pet_id")
+        .annotate(newest_id=Max("id"))
+        .values_list("pet_id", "newest_id")
+    )
+    for pet_id, newest_id in newest:
+        reserved.filter(pet_id=pet_id).exclude(id=newest_id).update(
+            payment_status="EXPIRED",
+            error_message="The reservation expired before the payment was made.",
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("payment", "0006_payment_transaction_id_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(expire_duplicate_reservations, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="payment",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("payment_status__in", ("PENDING", "INITIATED"))),
+                fields=("pet",),
+                name="payment_one_reservation_per_pet",
+            ),
+        ),
+    ]
@@ -0,0 +1,53 @@
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def clear_duplicate_transaction_ids(apps, schema_editor):
+    Payment = apps.get_model("payment", "Payment")
+
+    duplicates = (
+        Payment.objects.exclude(transaction_id=None)
+        .exclude(transaction_id="")
+        .values("transaction_id")
+        .annotate(uses=Count("id"))
+        .filter(uses__gt=1)
+        .values_list("transaction_id", flat=True)
+    )
+    for transaction_id in list(duplicates):
+        payments = Payment.objects.filter(transaction_id=transaction_id)
+        # The completed payment keeps the id; the others were replays
+        keep = payments.order_by(
+            models.Case(
+                models.When(payment_status="COMPLETED", then=0), default=1
+            ),
+            "id",
+        ).first()
+        payments.exclude(id=keep.id).update(
+            transaction_id=None,
+            error_message=f"Gateway transaction {transaction_id} was already used by payment {keep.id}.",
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("payment", "0007_payment_one_reservation_per_pet"),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_transaction_ids, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name="payment",
+            name="payment_transaction_id_idx",
+        ),
+        migrations.AddConstraint(
+            model_name="payment",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(
+                    models.Q(("transaction_id", None), _negated=True),
+                    models.Q(("transaction_id", ""), _negated=True),
+                ),
+                fields=("transaction_id",),
+                name="payment_unique_transaction_id",
+            ),
+        ),
+    ]
@@ -19,6 +19,11 @@ class Payment(models.Model):
         ('CANCELLED', 'Cancelled')
     ]
 
+    # A payment in one of these states holds its pet until expires_at
+    RESERVED_STATUSES = ('PENDING', 'INITIATED')
+    # Finished without an adoption; moved to ArchivedPayment after PAYMENT_RETENTION_DAYS
+    ARCHIVABLE_STATUSES = ('FAILED', 'EXPIRED', 'CANCELLED', 'REFUNDED')
+
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     pet = models.ForeignKey(Pet, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
@@ -30,20 +35,73 @@ class Payment(models.Model):
     signature = models.TextField(blank=True, null=True)  # eSewa signature
     payment_url = models.URLField(blank=True, null=True)  # Payment gateway URL
     error_message = models.TextField(blank=True, null=True)
+    expires_at = models.DateTimeField(blank=True, null=True)  # End of the checkout reservation
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
-    def mark_as_completed(self):
-        self.payment_status = 'COMPLETED'
-        self.pet.status = 'ADOPTED'
-        self.pet.save()
-        self.save()
+    class Meta:
+        indexes = [
+            # Latest pending payment for a user: esewa_verify, payment_failed
+            models.Index(fields=['user', 'payment_status', '-created_at'], name='payment_user_status_idx'),
+            # Adoption history on user_profile
+            models.Index(fields=['user', '-created_at'], name='payment_user_created_idx'),
+            # Reservations of a pet, and the expiry sweep
+            models.Index(fields=['pet', 'payment_status', 'expires_at'], name='payment_pet_reserved_idx'),
+            models.Index(fields=['payment_status', 'expires_at'], name='payment_status_expires_idx'),
+        ]
+        constraints = [
+            # At most one reservation (RESERVED_STATUSES) per pet, so two checkouts cannot both hold it
+            models.UniqueConstraint(
+                fields=['pet'],
+                condition=models.Q(payment_status__in=('PENDING', 'INITIATED')),
+                name='payment_one_reservation_per_pet',
+            ),
+            # A gateway transaction pays for one payment; a replayed eSewa callback cannot complete another
+            models.UniqueConstraint(
+                fields=['transaction_id'],
+                condition=~models.Q(transaction_id=None) & ~models.Q(transaction_id=''),
+                name='payment_unique_transaction_id',
+            ),
+        ]
+
+    def mark_as_completed(self, method=None, transaction_id=None):
+        # Atomic and race-safe; returns False if the pet went to another payment
+        from .services import complete_payment
+        return complete_payment(self, method=method, transaction_id=transaction_id)
 
     def mark_as_failed(self, error_message=None):
-        self.payment_status = 'FAILED'
-        if error_message:
-            self.error_message = error_message
-        self.save()
+        from .services import fail_payment
+        return fail_payment(self, error_message)
 
     def __str__(self):
         return f"{self.user.username}'s payment for {self.pet.name} - {self.payment_status}"
+
+
+class ArchivedPayment(models.Model):
+    """
+    A failed, expired, cancelled or refunded payment moved out of the live
+    Payment table by the retention sweep. Users and pets are stored as plain
+    ids so the record outlives them.
+    """
+    payment_id = models.IntegerField(unique=True)
+    user_id = models.IntegerField(db_index=True)
+    pet_id = models.IntegerField()
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    payment_method = models.CharField(max_length=10)
+    payment_status = models.CharField(max_length=10)
+    transaction_id = models.CharField(max_length=100, blank=True, null=True)
+    transaction_uuid = models.CharField(max_length=36, blank=True, null=True)
+    pidx = models.CharField(max_length=100, blank=True, null=True)
+    error_message = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    # Payment fields copied as they are
+    COPIED_FIELDS = (
+        'user_id', 'pet_id', 'amount', 'payment_method', 'payment_status', 'transaction_id',
+        'transaction_uuid', 'pidx', 'error_message', 'created_at', 'updated_at',
+    )
+
+    def __str__(self):
+        return f"Archived payment {self.payment_id} - {self.payment_status}"
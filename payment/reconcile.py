@@ -0,0 +1,176 @@
+"""
+Reconciliation of payments whose outcome never reached us.
+
+A payment stays PENDING or INITIATED if the user closes the tab on the
+gateway's page, so neither payment_success nor esewa_verify runs. Its
+reservation then usually expires before anyone checks, so payments that
+became EXPIRED within PAYMENT_RECONCILE_EXPIRED_WINDOW minutes of checkout
+are checked as well; one that was paid is completed, or reported as a
+conflict needing a refund if the pet went to someone else. The
+reconcile_payments command pages through those rows in id order, asks each
+gateway's status API about a page at a time from a bounded thread pool, and
+applies the answers: completions go through complete_payment one by one,
+since they adopt a pet and may lose a race, while failures, expiries,
+cancellations and refunds are written with one UPDATE per status.
+
+Worker threads only make HTTP calls; all database work happens on the
+calling thread.
+"""
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
+import requests
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from . import gateways
+from .models import Payment
+from .services import DuplicateTransaction, complete_payment
+
+UNRESOLVED_STATUSES = ('PENDING', 'INITIATED')
+
+# Gateway status -> our status; statuses not listed leave the payment as it is
+KHALTI_STATUSES = {
+    'Completed': 'COMPLETED',
+    'Expired': 'EXPIRED',
+    'User canceled': 'CANCELLED',
+    'Refunded': 'REFUNDED',
+    'Partially Refunded': 'REFUNDED',
+}
+ESEWA_STATUSES = {
+    'COMPLETE': 'COMPLETED',
+    'CANCELED': 'CANCELLED',
+    'FULL_REFUND': 'REFUNDED',
+    'PARTIAL_REFUND': 'REFUNDED',
+}
+
+ESEWA_STATUS_PATH = 'api/epay/transaction/status/'
+
+
+class GatewayAnswer:
+    """What a gateway said about one payment."""
+
+    def __init__(self, payment, status=None, transaction_id=None, error=None):
+        self.payment = payment
+        self.status = status
+        self.transaction_id = transaction_id
+        self.error = error
+
+
+def to_decimal(value):
+    try:
+        return Decimal(str(value).replace(',', ''))
+    except InvalidOperation:
+        return None
+
+
+def check_khalti(payment):
+    response = gateways.khalti().post(
+        'epayment/lookup/', json={'pidx': payment.pidx},
+        headers={'Authorization': f'Key {settings.KHALTI_SECRET_KEY}'},
+    )
+    if response.status_code == 404:
+        return GatewayAnswer(payment)
+    response.raise_for_status()
+    data = response.json()
+    status = KHALTI_STATUSES.get(data.get('status'))
+    # Khalti reports amounts in paisa
+    if status == 'COMPLETED' and to_decimal(data.get('total_amount')) != payment.amount * 100:
+        return GatewayAnswer(payment, error=f'Khalti reports {data.get("total_amount")} paisa')
+    return GatewayAnswer(payment, status, data.get('transaction_id'))
+
+
+def check_esewa(payment):
+    response = gateways.esewa().request('GET', ESEWA_STATUS_PATH, params={
+        'product_code': settings.ESEWA_MERCHANT_CODE,
+        'total_amount': payment.amount,
+        'transaction_uuid': payment.transaction_uuid,
+    })
+    response.raise_for_status()
+    data = response.json()
+    status = ESEWA_STATUSES.get(data.get('status'))
+    if status == 'COMPLETED' and to_decimal(data.get('total_amount')) != payment.amount:
+        return GatewayAnswer(payment, error=f'eSewa reports {data.get("total_amount")}')
+    return GatewayAnswer(payment, status, data.get('ref_id'))
+
+
+def check_payment(payment):
+    try:
+        if payment.pidx:
+            return check_khalti(payment)
+        return check_esewa(payment)
+    except (requests.RequestException, ValueError) as e:
+        return GatewayAnswer(payment, error=str(e))
+
+
+def unresolved_payments(min_age=None):
+    minutes = settings.PAYMENT_RECONCILE_MIN_AGE if min_age is None else min_age
+    now = timezone.now()
+    # The buyer may have paid after the reservation ran out
+    recently_expired = Q(
+        payment_status='EXPIRED',
+        created_at__gte=now - timedelta(minutes=settings.PAYMENT_RECONCILE_EXPIRED_WINDOW),
+    )
+    # Leave checkouts that may still be in progress alone
+    return Payment.objects.filter(
+        Q(payment_status__in=UNRESOLVED_STATUSES) | recently_expired,
+        created_at__lt=now - timedelta(minutes=minutes),
+    ).exclude(pidx__isnull=True, transaction_uuid__isnull=True).only(
+        'id', 'pet_id', 'amount', 'payment_status', 'pidx', 'transaction_uuid'
+    ).order_by('id')
+
+
+def apply_answers(answers, report):
+    """Write a page of gateway answers to the database, counting outcomes in ``report``."""
+    to_update = defaultdict(list)
+    for answer in answers:
+        if answer.error:
+            report['errors'] += 1
+        elif answer.status is None:
+            report['unchanged'] += 1
+        elif answer.status == 'COMPLETED':
+            method = 'KHALTI' if answer.payment.pidx else 'ESEWA'
+            try:
+                completed = complete_payment(answer.payment, method=method, transaction_id=answer.transaction_id)
+            except DuplicateTransaction:
+                report['errors'] += 1
+                continue
+            report['completed' if completed else 'conflicts'] += 1
+        else:
+            to_update[answer.status].append(answer.payment.id)
+
+    now = timezone.now()
+    for status, ids in to_update.items():
+        # The status filter skips payments resolved by a callback meanwhile
+        report[status.lower()] += Payment.objects.filter(id__in=ids, payment_status__in=UNRESOLVED_STATUSES).update(
+            payment_status=status, updated_at=now,
+            error_message=f'Marked {status.lower()} by reconciliation with the payment gateway.',
+        )
+
+
+def reconcile(after_id=0, page_size=100, workers=None, limit=None, min_age=None, on_page=None):
+    """
+    Reconcile unresolved payments with an id above ``after_id``, at most
+    ``limit`` of them, and return a report of counts. ``on_page(last_id,
+    report)`` is called after each page is written, e.g. to save a
+    checkpoint. ``report['last_id']`` is None once no payments are left.
+    """
+    payments = unresolved_payments(min_age)
+    report = Counter()
+    last_id = after_id
+    with ThreadPoolExecutor(max_workers=workers or settings.PAYMENT_RECONCILE_WORKERS) as executor:
+        while limit is None or report['checked'] < limit:
+            size = page_size if limit is None else min(page_size, limit - report['checked'])
+            page = list(payments.filter(id__gt=last_id)[:size])
+            if not page:
+                last_id = None
+                break
+            apply_answers(executor.map(check_payment, page), report)
+            report['checked'] += len(page)
+            last_id = page[-1].id
+            if on_page:
+                on_page(last_id, report)
+    return {**report, 'last_id': last_id}
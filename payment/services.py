@@ -0,0 +1,197 @@
+"""
+Payment state changes that must not race.
+
+Gateway callbacks, browser redirects and the background re-verification can
+all try to complete the same payment, or different payments for the same
+pet, at the same time. Each change below is a conditional UPDATE (``... WHERE
+status != 'COMPLETED'``) inside one transaction. The database decides the
+winner, so whatever the interleaving, a pet is adopted through exactly one
+payment. This works on SQLite, which has no SELECT FOR UPDATE, as well as on
+server databases.
+
+Checkout also reserves the pet: payment_page reuses the user's PENDING or
+INITIATED payment until it expires instead of creating a row per page view,
+and other users cannot start a checkout for the pet meanwhile. A partial
+unique constraint allows one reservation per pet, so of two checkouts racing
+for the same pet only one gets it. Reservations that run out are moved to
+EXPIRED by a task queued with each one and by the sweep_payments command,
+which also archives old finished payments.
+"""
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from breed_finder import similarity
+from breed_finder.models import Pet
+
+from .models import ArchivedPayment, Payment
+from .tasks import expire_reservation
+
+
+class PetAlreadyAdopted(Exception):
+    pass
+
+
+class PetReserved(Exception):
+    pass
+
+
+class DuplicateTransaction(Exception):
+    pass
+
+
+def reserve_pet(user, pet):
+    """
+    Return the payment that reserves ``pet`` for ``user``, reusing the
+    user's PENDING or INITIATED reservation if there is one. Raises
+    PetReserved if another user holds the pet.
+    """
+    # Run-out reservations of this pet would otherwise still count against the unique constraint
+    expire_payments(Payment.objects.filter(pet=pet))
+    reservations = Payment.objects.filter(pet=pet, payment_status__in=Payment.RESERVED_STATUSES)
+    mine = reservations.filter(user=user, amount=pet.price).order_by('-created_at').first()
+    if mine:
+        return mine
+    if reservations.exclude(user=user).exists():
+        raise PetReserved
+    # A changed price needs a new payment for the new amount
+    now = timezone.now()
+    reservations.filter(user=user).exclude(amount=pet.price).update(
+        payment_status='CANCELLED', error_message='The price changed before the payment was made.', updated_at=now,
+    )
+
+    minutes = settings.PAYMENT_RESERVATION_MINUTES
+    try:
+        # payment_one_reservation_per_pet decides between concurrent checkouts
+        with transaction.atomic():
+            payment = Payment.objects.create(
+                user=user,
+                pet=pet,
+                amount=pet.price,
+                payment_method='PENDING',
+                payment_status='PENDING',
+                # Without dashes, as eSewa rejects them
+                transaction_uuid=str(uuid.uuid4()).replace('-', '')[:20],
+                expires_at=now + timedelta(minutes=minutes),
+            )
+    except IntegrityError:
+        # The user's own second request may have won, e.g. a double click
+        mine = reservations.filter(user=user, amount=pet.price).first()
+        if mine:
+            return mine
+        raise PetReserved
+    expire_reservation.enqueue(key=f'payment-expiry:{payment.id}', delay=minutes * 60, payment_id=payment.id)
+    return payment
+
+
+def stale_reservations(now=None):
+    now = now or timezone.now()
+    # Payments from before reservations existed have no expires_at
+    legacy = Q(expires_at__isnull=True, created_at__lt=now - timedelta(minutes=settings.PAYMENT_RESERVATION_MINUTES))
+    return Payment.objects.filter(
+        Q(expires_at__lt=now) | legacy, payment_status__in=Payment.RESERVED_STATUSES
+    )
+
+
+def expire_payments(payments=None, batch_size=None):
+    """Move abandoned reservations among ``payments`` (default: all) to EXPIRED; return how many."""
+    batch_size = batch_size or settings.PAYMENT_SWEEP_BATCH_SIZE
+    stale = stale_reservations()
+    if payments is not None:
+        stale = stale.filter(id__in=payments.values('id'))
+    expired = 0
+    while True:
+        ids = list(stale.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return expired
+        # Re-checking the status leaves payments completed meanwhile alone
+        expired += Payment.objects.filter(id__in=ids, payment_status__in=Payment.RESERVED_STATUSES).update(
+            payment_status='EXPIRED',
+            error_message='The reservation expired before the payment was made.',
+            updated_at=timezone.now(),
+        )
+
+
+def archive_payments(days=None, batch_size=None):
+    """Move finished payments untouched for ``days`` to ArchivedPayment; return how many."""
+    days = settings.PAYMENT_RETENTION_DAYS if days is None else days
+    batch_size = batch_size or settings.PAYMENT_SWEEP_BATCH_SIZE
+    old = Payment.objects.filter(
+        payment_status__in=Payment.ARCHIVABLE_STATUSES,
+        updated_at__lt=timezone.now() - timedelta(days=days),
+    ).order_by('id')
+    archived = 0
+    while True:
+        with transaction.atomic():
+            rows = list(old.values('id', *ArchivedPayment.COPIED_FIELDS)[:batch_size])
+            if not rows:
+                return archived
+            ids = [row.pop('id') for row in rows]
+            # Copy and delete in one transaction so a row is never in both tables or neither
+            ArchivedPayment.objects.bulk_create(
+                [ArchivedPayment(payment_id=id, **row) for id, row in zip(ids, rows)]
+            )
+            Payment.objects.filter(id__in=ids).delete()
+        archived += len(ids)
+
+
+def complete_payment(payment, method=None, transaction_id=None):
+    """
+    Mark ``payment`` COMPLETED and its pet ADOPTED in one transaction.
+
+    Returns True if the payment is completed, whether by this call or an
+    earlier one. Returns False if the pet was already adopted through
+    another payment. In that case this payment is marked FAILED so it can
+    be refunded. Raises DuplicateTransaction, leaving the payment as it
+    was, if ``transaction_id`` already completed another payment.
+    ``payment`` is updated in memory to match the database.
+    """
+    now = timezone.now()
+    fields = {'payment_status': 'COMPLETED', 'updated_at': now}
+    if method:
+        fields['payment_method'] = method
+    if transaction_id:
+        fields['transaction_id'] = transaction_id
+
+    try:
+        with transaction.atomic():
+            won = Payment.objects.filter(id=payment.id).exclude(payment_status='COMPLETED').update(**fields)
+            if not won:
+                # Completed already, e.g. the callback and the redirect both arrived
+                payment.refresh_from_db(fields=['payment_status', 'payment_method', 'transaction_id'])
+                return True
+            adopted = Pet.objects.filter(id=payment.pet_id).exclude(status='ADOPTED').update(
+                status='ADOPTED', updated_at=now
+            )
+            if not adopted:
+                raise PetAlreadyAdopted
+            # Queryset updates skip the Pet signals, so drop the pet from the similarity index here
+            transaction.on_commit(lambda: similarity.remove_pet(payment.pet_id))
+    except PetAlreadyAdopted:
+        fail_payment(payment, 'This pet was already adopted through another payment. A refund is required.')
+        return False
+    except IntegrityError as e:
+        # payment_unique_transaction_id: the same gateway transaction replayed against this payment
+        raise DuplicateTransaction(transaction_id) from e
+
+    for field, value in fields.items():
+        setattr(payment, field, value)
+    if Payment.pet.is_cached(payment):
+        payment.pet.status = 'ADOPTED'
+    return True
+
+
+def fail_payment(payment, error_message=None):
+    """Mark ``payment`` FAILED unless it has already completed; return True if it changed."""
+    fields = {'payment_status': 'FAILED', 'updated_at': timezone.now()}
+    if error_message:
+        fields['error_message'] = error_message
+    changed = Payment.objects.filter(id=payment.id).exclude(payment_status='COMPLETED').update(**fields)
+    if changed:
+        for field, value in fields.items():
+            setattr(payment, field, value)
+    return bool(changed)
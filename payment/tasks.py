@@ -0,0 +1,46 @@
+from django.conf import settings
+
+from taskqueue.runner import task
+
+from . import gateways
+from .models import Payment
+
+ESEWA_TRANSREC_PATH = 'epay/transrec'
+
+
+@task(max_attempts=6)
+def verify_esewa_payment(payment_id, ref_id):
+    """
+    Re-check an eSewa payment that could not be verified while the user waited.
+
+    eSewa is asked to confirm the amount we charge for the payment, never one
+    taken from the callback, which the buyer controls.
+    """
+    payment = Payment.objects.select_related('pet').get(id=payment_id)
+    if payment.payment_status in ('COMPLETED', 'FAILED'):
+        return
+
+    # Connection errors, timeouts and an open circuit propagate so the task is retried with backoff
+    response = gateways.esewa().post(ESEWA_TRANSREC_PATH, data={
+        'amt': payment.amount,
+        'scd': settings.ESEWA_MERCHANT_CODE,
+        'rid': ref_id,
+        'pid': payment.transaction_uuid,
+    })
+    response.raise_for_status()
+
+    if 'Success' in response.text:
+        from .services import DuplicateTransaction
+        try:
+            payment.mark_as_completed(method='ESEWA', transaction_id=ref_id)
+        except DuplicateTransaction:
+            payment.mark_as_failed(f'eSewa transaction {ref_id} was already used by another payment')
+    else:
+        payment.mark_as_failed('Payment verification failed')
+
+
+@task(max_attempts=3)
+def expire_reservation(payment_id):
+    """Release the pet held by a checkout that was abandoned."""
+    from .services import expire_payments
+    expire_payments(Payment.objects.filter(id=payment_id))
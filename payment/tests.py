@@ -1,3 +1,632 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
 
-# Create your tests here.
+import requests
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from taskqueue.models import Task
+from taskqueue.runner import run_pending
+
+from breed_finder.models import CustomUser, Pet
+from breed_finder.testing import full_scans, make_pet
+
+from . import esewa, gateways
+from .models import ArchivedPayment, Payment
+from .services import DuplicateTransaction, PetReserved, complete_payment, reserve_pet, stale_reservations
+from .tasks import verify_esewa_payment
+
+
+class PaymentQueryPlanTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='buyer', email='buyer@gmail.com', password='pass12345'
+        )
+
+    def test_latest_pending_payment_uses_index(self):
+        queryset = Payment.objects.filter(
+            user=self.user, payment_status='PENDING'
+        ).order_by('-created_at')[:1]
+        self.assertEqual(full_scans(queryset), [])
+
+    def test_adoption_history_uses_index(self):
+        queryset = Payment.objects.filter(user=self.user).order_by('-created_at')
+        self.assertEqual(full_scans(queryset), [])
+
+    def test_expiry_sweep_uses_index(self):
+        self.assertEqual(full_scans(stale_reservations().values('id')), [])
+
+
+class FakeGatewayHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep the connection alive between calls
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        self.respond(path, {key: values[0] for key, values in parse_qs(query).items()})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode()
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            body = json.loads(body or '{}')
+        else:
+            body = {key: values[0] for key, values in parse_qs(body).items()}
+        self.respond(self.path, body)
+
+    def respond(self, path, body):
+        self.server.calls.append((path, body, self.client_address[1]))
+        status, content, delay = self.server.reply(path, body)
+        time.sleep(delay)
+        if not isinstance(content, str):
+            content = json.dumps(content)
+        data = content.encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up after its read timeout
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeGateway:
+    """
+    A local stand-in for the Khalti or eSewa API, selected by ``setting``.
+
+    ``reply(path, body)`` returns (status, content, delay), where body holds
+    the JSON, form or query parameters. Dict content is sent as JSON, and
+    the response is held back for ``delay`` seconds.
+    """
+
+    def __init__(self, setting, reply):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGatewayHandler)
+        self.server.daemon_threads = True
+        self.server.reply = reply
+        self.server.calls = []
+        self.setting = setting
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+
+    @property
+    def calls(self):
+        return self.server.calls
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.settings = override_settings(**{self.setting: self.url})
+        self.settings.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        gateways.reset_clients()
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def fake_esewa(reply):
+    return FakeGateway('ESEWA_API_URL', reply)
+
+
+def fake_khalti(reply):
+    return FakeGateway('KHALTI_API_URL', reply)
+
+
+def esewa_says(text, delay=0):
+    return lambda path, body: (200, f'<response_code>{text}</response_code>', delay)
+
+
+class EsewaVerificationTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='buyer', email='buyer@gmail.com', password='pass12345'
+        )
+        self.client.force_login(self.user)
+        self.pet = make_pet()
+        self.payment = Payment.objects.create(
+            user=self.user, pet=self.pet, amount=1000, payment_method='PENDING',
+            payment_status='PENDING', transaction_uuid='abc123',
+        )
+
+    def callback(self, **fields):
+        fields = {
+            'transaction_code': '000AWEO', 'status': 'COMPLETE', 'total_amount': '1,000.0',
+            'transaction_uuid': 'abc123', 'product_code': 'EPAYTEST',
+            'signed_field_names': 'transaction_code,status,total_amount,transaction_uuid,product_code,signed_field_names',
+            **fields,
+        }
+        fields.setdefault('signature', esewa.sign(esewa.signed_message(fields, fields['signed_field_names'].split(','))))
+        data = base64.b64encode(json.dumps(fields).encode()).decode()
+        return self.client.get(reverse('payment:esewa_verify'), {'oid': 'abc123', 'data': data})
+
+    def assertRejected(self, response):
+        self.assertRedirects(response, reverse('payment:payment_failed') + '?error=invalid_callback', fetch_redirect_response=False)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.payment_status, 'PENDING')
+
+    def test_signed_callback_completes_without_calling_esewa(self):
+        with fake_esewa(esewa_says('Success')) as esewa_api:
+            response = self.callback()
+        self.assertRedirects(response, reverse('payment:payment_success') + f'?payment_id={self.payment.id}', fetch_redirect_response=False)
+        self.assertEqual(esewa_api.calls, [])
+        self.payment.refresh_from_db()
+        self.assertEqual((self.payment.payment_status, self.payment.transaction_id), ('COMPLETED', '000AWEO'))
+
+        # The same callback again is recognised as processed
+        response = self.callback()
+        self.assertRedirects(response, reverse('payment:payment_success') + f'?payment_id={self.payment.id}', fetch_redirect_response=False)
+
+    def test_tampered_callback_is_rejected(self):
+        self.assertRejected(self.callback(signature='bm90IHRoZSBzaWduYXR1cmU='))
+        # Valid signature, but over fields that leave the amount out
+        self.assertRejected(self.callback(signed_field_names='transaction_code,status,transaction_uuid,product_code'))
+        self.assertRejected(self.callback(product_code='OTHER'))
+
+    def test_callback_must_match_the_payment(self):
+        self.assertRejected(self.callback(total_amount='10.0'))
+        self.assertRejected(self.callback(transaction_uuid='other'))
+
+    def test_transaction_code_cannot_be_replayed_on_another_payment(self):
+        Payment.objects.create(
+            user=self.user, pet=make_pet(), amount=1000, payment_method='ESEWA',
+            payment_status='COMPLETED', transaction_uuid='first', transaction_id='000AWEO',
+        )
+        self.assertRejected(self.callback())
+
+    def test_reference_callback_is_checked_in_the_background(self):
+        # The amount in the query string is the buyer's; eSewa is asked about ours
+        params = {'oid': 'abc123', 'amt': '1', 'refId': 'REF1'}
+        with fake_esewa(esewa_says('Success')) as esewa_api:
+            response = self.client.get(reverse('payment:esewa_verify'), params)
+            self.assertRedirects(response, reverse('breed_finder:user_profile'))
+            self.assertEqual(esewa_api.calls, [])
+            self.payment.refresh_from_db()
+            self.assertEqual(self.payment.payment_status, 'PENDING')
+
+            self.assertEqual(run_pending(), 1)
+        self.assertEqual(esewa_api.calls[0][:2], ('/epay/transrec', {'amt': '1000.00', 'scd': 'EPAYTEST', 'rid': 'REF1', 'pid': 'abc123'}))
+        self.payment.refresh_from_db()
+        self.pet.refresh_from_db()
+        self.assertEqual((self.payment.payment_status, self.payment.transaction_id), ('COMPLETED', 'REF1'))
+        self.assertEqual(self.pet.status, 'ADOPTED')
+
+    def test_gateway_outage_is_retried_not_failed(self):
+        queued = verify_esewa_payment.enqueue(payment_id=self.payment.id, ref_id='REF1')
+        with fake_esewa(lambda path, body: (503, 'maintenance', 0)):
+            with self.assertLogs('taskqueue.runner', 'WARNING'):
+                run_pending()
+        queued.refresh_from_db()
+        self.payment.refresh_from_db()
+        self.assertEqual((queued.status, self.payment.payment_status), ('QUEUED', 'PENDING'))
+
+
+class KhaltiInitiationTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create(username='buyer', email='buyer@gmail.com')
+        self.client.force_login(self.user)
+        self.payment = Payment.objects.create(
+            user=self.user, pet=make_pet(), amount=1000, payment_method='PENDING',
+            payment_status='PENDING', transaction_uuid='abc123',
+        )
+
+    def initiate(self):
+        return self.client.post(
+            reverse('payment:khalti_verify'), {'payment_id': self.payment.id}, content_type='application/json'
+        )
+
+    def test_initiates_through_the_pooled_client(self):
+        reply = {'pidx': 'PIDX1', 'payment_url': 'https://pay.khalti.com/?pidx=PIDX1'}
+        with fake_khalti(lambda path, body: (200, reply, 0)) as khalti:
+            response = self.initiate()
+        self.assertEqual(response.json(), {'success': True, 'payment_url': reply['payment_url']})
+        path, body, _ = khalti.calls[0]
+        self.assertEqual((path, body['amount'], body['purchase_order_id']), ('/epayment/initiate/', 100000, 'abc123'))
+        self.payment.refresh_from_db()
+        self.assertEqual((self.payment.payment_status, self.payment.pidx), ('INITIATED', 'PIDX1'))
+
+    @override_settings(GATEWAY_FAILURE_THRESHOLD=2)
+    def test_unreachable_khalti_keeps_the_payment(self):
+        with fake_khalti(lambda path, body: (502, 'bad gateway', 0)) as khalti:
+            for _ in range(3):
+                response = self.initiate()
+        self.assertEqual(len(khalti.calls), 2)
+        self.assertEqual(response.status_code, 503)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.payment_status, 'PENDING')
+
+
+class GatewayClientTests(SimpleTestCase):
+    def test_connections_are_kept_alive(self):
+        with fake_esewa(esewa_says('Success')) as esewa:
+            for _ in range(3):
+                gateways.esewa().post('epay/transrec', data={'pid': 'x'})
+        self.assertEqual(len({port for _, _, port in esewa.calls}), 1)
+
+    @override_settings(GATEWAY_READ_TIMEOUT=0.1)
+    def test_read_timeout_bounds_slow_calls(self):
+        with fake_esewa(esewa_says('Success', delay=1)):
+            started = time.monotonic()
+            with self.assertRaises(requests.Timeout):
+                gateways.esewa().post('epay/transrec')
+            self.assertLess(time.monotonic() - started, 0.8)
+
+    @override_settings(GATEWAY_FAILURE_THRESHOLD=3, GATEWAY_RESET_TIMEOUT=0.2)
+    def test_circuit_opens_after_failures_and_recovers(self):
+        healthy = threading.Event()
+
+        def reply(path, body):
+            return (200, 'ok', 0) if healthy.is_set() else (500, 'error', 0)
+
+        with fake_esewa(reply) as esewa:
+            client = gateways.esewa()
+            for _ in range(3):
+                self.assertEqual(client.post('epay/transrec').status_code, 500)
+            with self.assertRaises(gateways.GatewayUnavailable):
+                client.post('epay/transrec')
+            self.assertEqual(len(esewa.calls), 3)
+
+            # After the reset timeout one trial call goes out and closes the circuit
+            healthy.set()
+            time.sleep(0.25)
+            self.assertEqual(client.post('epay/transrec').status_code, 200)
+            self.assertEqual(client.stats()['circuit'], 'closed')
+
+    def test_latency_histogram_per_endpoint(self):
+        with fake_esewa(esewa_says('Success')):
+            client = gateways.esewa()
+            client.post('epay/transrec')
+            client.post('epay/transrec')
+            latency = gateways.stats()['esewa']['latency']
+        self.assertEqual(list(latency), ['epay/transrec'])
+        self.assertEqual(latency['epay/transrec']['count'], 2)
+        self.assertEqual(sum(latency['epay/transrec']['buckets'].values()), 2)
+
+
+class PaymentCompletionTests(TransactionTestCase):
+    def setUp(self):
+        self.pet = make_pet()
+        self.payments = []
+        for i in range(8):
+            user = CustomUser.objects.create(username=f'buyer{i}', email=f'buyer{i}@gmail.com')
+            # One live reservation; late callbacks can still arrive for expired ones
+            self.payments.append(Payment.objects.create(
+                user=user, pet=self.pet, amount=1000, payment_method='PENDING',
+                payment_status='PENDING' if i == 0 else 'EXPIRED', transaction_uuid=f'uuid{i}',
+            ))
+
+    def test_concurrent_completions_have_exactly_one_winner(self):
+        barrier = threading.Barrier(len(self.payments))
+        results = {}
+
+        def complete(payment_id):
+            try:
+                payment = Payment.objects.get(id=payment_id)
+                barrier.wait()
+                results[payment_id] = complete_payment(payment, method='ESEWA', transaction_id=f'ref{payment_id}')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=complete, args=(p.id,)) for p in self.payments]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results.values()), [False] * 7 + [True])
+        winner = next(payment_id for payment_id, won in results.items() if won)
+        statuses = dict(Payment.objects.values_list('id', 'payment_status'))
+        self.assertEqual([pid for pid, status in statuses.items() if status == 'COMPLETED'], [winner])
+        self.assertEqual(list(statuses.values()).count('FAILED'), 7)
+        self.pet.refresh_from_db()
+        self.assertEqual(self.pet.status, 'ADOPTED')
+
+    def test_completion_is_idempotent_and_sticks(self):
+        payment = self.payments[0]
+        self.assertTrue(payment.mark_as_completed(method='ESEWA', transaction_id='ref'))
+        self.assertTrue(complete_payment(Payment.objects.get(id=payment.id)))
+        # A late failure callback cannot undo a completed payment
+        self.assertFalse(payment.mark_as_failed('cancelled'))
+        payment.refresh_from_db()
+        self.assertEqual((payment.payment_status, payment.transaction_id), ('COMPLETED', 'ref'))
+
+    def test_transaction_id_completes_only_one_payment(self):
+        self.assertTrue(complete_payment(self.payments[0], method='ESEWA', transaction_id='ref'))
+        other = Payment.objects.create(
+            user=self.payments[1].user, pet=make_pet(), amount=1000, payment_method='PENDING',
+            payment_status='PENDING', transaction_uuid='other',
+        )
+        with self.assertRaises(DuplicateTransaction):
+            complete_payment(other, method='ESEWA', transaction_id='ref')
+        other.refresh_from_db()
+        self.assertEqual((other.payment_status, other.transaction_id, other.pet.status), ('PENDING', None, 'AVAILABLE'))
+
+
+class ReservationTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create(username='buyer', email='buyer@gmail.com')
+        self.other = CustomUser.objects.create(username='rival', email='rival@gmail.com')
+        self.pet = make_pet()
+        self.url = reverse('payment:payment_page', args=[self.pet.id])
+
+    def checkout(self, user):
+        self.client.force_login(user)
+        return self.client.get(self.url)
+
+    def test_reloading_checkout_reuses_the_reservation(self):
+        for _ in range(3):
+            response = self.checkout(self.user)
+            self.assertEqual(response.status_code, 200)
+        payment = Payment.objects.get()
+        self.assertEqual(response.context['payment'], payment)
+        self.assertGreater(payment.expires_at, timezone.now())
+        self.assertEqual(Task.objects.filter(idempotency_key=f'payment-expiry:{payment.id}').count(), 1)
+
+    def test_initiated_reservation_is_reused(self):
+        self.checkout(self.user)
+        Payment.objects.update(payment_status='INITIATED', pidx='PIDX1')
+        response = self.checkout(self.user)
+        self.assertEqual(response.context['payment'], Payment.objects.get())
+
+    def test_price_change_replaces_the_reservation(self):
+        self.checkout(self.user)
+        Pet.objects.filter(id=self.pet.id).update(price=1500)
+        self.checkout(self.user)
+        self.assertEqual(
+            sorted(Payment.objects.values_list('amount', 'payment_status')),
+            [(1000, 'CANCELLED'), (1500, 'PENDING')],
+        )
+
+    def test_run_out_reservation_does_not_block_a_new_checkout(self):
+        self.checkout(self.user)
+        Payment.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.checkout(self.other).status_code, 200)
+        self.assertEqual(Payment.objects.get(payment_status='EXPIRED').user, self.user)
+        self.assertEqual(Payment.objects.get(payment_status='PENDING').user, self.other)
+
+    def test_reserved_pet_cannot_be_checked_out_by_another_user(self):
+        self.checkout(self.user)
+        response = self.checkout(self.other)
+        self.assertRedirects(response, reverse('breed_finder:pet_detail', args=[self.pet.id]), fetch_redirect_response=False)
+        self.assertFalse(Payment.objects.filter(user=self.other).exists())
+
+    def test_abandoned_reservation_expires_in_the_background(self):
+        self.checkout(self.user)
+        payment = Payment.objects.get()
+        Payment.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        Task.objects.update(run_at=timezone.now())
+        self.assertEqual(run_pending(), 1)
+        payment.refresh_from_db()
+        self.assertEqual(payment.payment_status, 'EXPIRED')
+
+        # The pet is free again, and a new checkout gets a new payment
+        self.assertEqual(self.checkout(self.other).status_code, 200)
+        self.assertEqual(Payment.objects.filter(payment_status='PENDING').get().user, self.other)
+
+    def test_sweep_expires_and_archives_in_batches(self):
+        old = timezone.now() - timedelta(days=400)
+        for i in range(5):
+            Payment.objects.create(
+                user=self.user, pet=make_pet(), amount=1000, payment_method='PENDING',
+                payment_status='PENDING', transaction_uuid=f'stale{i}',
+            )
+        for status in ('FAILED', 'EXPIRED', 'COMPLETED'):
+            Payment.objects.create(
+                user=self.user, pet=self.pet, amount=1000, payment_method='ESEWA',
+                payment_status=status, transaction_uuid=f'old-{status}',
+            )
+        # Legacy rows have no expires_at; these are older than the reservation window
+        Payment.objects.filter(payment_status='PENDING').update(created_at=timezone.now() - timedelta(hours=1))
+        Payment.objects.exclude(payment_status='PENDING').update(created_at=old, updated_at=old)
+
+        out = io.StringIO()
+        call_command('sweep_payments', '--batch-size', '2', stdout=out)
+        self.assertIn('Expired 5 abandoned payments', out.getvalue())
+        self.assertIn('Archived 2 payments', out.getvalue())
+        # Just-expired rows stay for the retention period; completed adoptions are never archived
+        self.assertEqual(Payment.objects.filter(payment_status='EXPIRED').count(), 5)
+        self.assertTrue(Payment.objects.filter(payment_status='COMPLETED').exists())
+        archived = ArchivedPayment.objects.get(transaction_uuid='old-FAILED')
+        self.assertEqual((archived.user_id, archived.pet_id, archived.created_at), (self.user.id, self.pet.id, old))
+
+
+class ReservationRaceTests(TransactionTestCase):
+    def test_concurrent_checkouts_reserve_the_pet_once(self):
+        pet = make_pet()
+        users = [CustomUser.objects.create(username=f'buyer{i}', email=f'buyer{i}@gmail.com') for i in range(8)]
+        barrier = threading.Barrier(len(users))
+        results = {}
+
+        def checkout(user):
+            try:
+                barrier.wait()
+                results[user.id] = reserve_pet(user, pet).user_id
+            except PetReserved:
+                results[user.id] = None
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        payment = Payment.objects.get()
+        self.assertEqual(sorted(results.values(), key=bool), [None] * 7 + [payment.user_id])
+
+    def test_concurrent_checkouts_by_one_user_share_the_reservation(self):
+        pet = make_pet()
+        user = CustomUser.objects.create(username='buyer', email='buyer@gmail.com')
+        barrier = threading.Barrier(4)
+        results = []
+
+        def checkout():
+            try:
+                barrier.wait()
+                results.append(reserve_pet(user, pet).id)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [Payment.objects.get().id] * 4)
+
+
+class ReconcilePaymentsTests(TestCase):
+    # pidx or transaction_uuid -> what the gateway reports
+    KHALTI = {
+        'paid': {'status': 'Completed', 'total_amount': 100000, 'transaction_id': 'KTX1'},
+        'gone': {'status': 'Expired', 'total_amount': 100000},
+        'waiting': {'status': 'Pending', 'total_amount': 100000},
+    }
+    ESEWA = {
+        'paid': {'status': 'COMPLETE', 'total_amount': '1000.0', 'ref_id': 'ETX1'},
+        'cancelled': {'status': 'CANCELED', 'total_amount': '1000.0'},
+        'unknown': {'status': 'NOT_FOUND'},
+        'outage': None,
+    }
+
+    def setUp(self):
+        self.user = CustomUser.objects.create(username='buyer', email='buyer@gmail.com')
+        for pidx in self.KHALTI:
+            self.make_payment(f'k-{pidx}', payment_status='INITIATED', payment_method='KHALTI', pidx=pidx)
+        for uuid in self.ESEWA:
+            self.make_payment(uuid)
+        # Too recent: the user may still be on the gateway's page
+        Payment.objects.create(
+            user=self.user, pet=make_pet(), amount=1000, payment_method='PENDING',
+            payment_status='PENDING', transaction_uuid='fresh',
+        )
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.checkpoint = os.path.join(directory.name, 'reconcile.json')
+
+    def make_payment(self, uuid, **fields):
+        payment = Payment.objects.create(**{
+            'user': self.user, 'pet': make_pet(), 'amount': 1000, 'payment_method': 'PENDING',
+            'payment_status': 'PENDING', 'transaction_uuid': uuid, **fields,
+        })
+        Payment.objects.filter(id=payment.id).update(created_at=timezone.now() - timedelta(hours=1))
+        return payment
+
+    def khalti_reply(self, path, body):
+        return 200, self.KHALTI[body['pidx']], self.delay
+
+    def esewa_reply(self, path, body):
+        reply = self.ESEWA[body['transaction_uuid']]
+        return (200, reply, self.delay) if reply else (503, 'maintenance', 0)
+
+    def reconcile(self, *args, delay=0):
+        self.delay = delay
+        out = io.StringIO()
+        with fake_khalti(self.khalti_reply) as khalti, fake_esewa(self.esewa_reply) as esewa_api:
+            call_command('reconcile_payments', '--checkpoint', self.checkpoint, *args, stdout=out)
+        self.calls = khalti.calls + esewa_api.calls
+        return out.getvalue()
+
+    def statuses(self):
+        return dict(Payment.objects.values_list('transaction_uuid', 'payment_status'))
+
+    def test_applies_gateway_statuses(self):
+        out = self.reconcile()
+        self.assertIn('Reconciled 7 payments: 2 completed, 0 conflicts, 1 expired, 1 cancelled, 0 refunded, 2 unchanged, 1 errors', out)
+        self.assertEqual(self.statuses(), {
+            'k-paid': 'COMPLETED', 'k-gone': 'EXPIRED', 'k-waiting': 'INITIATED',
+            'paid': 'COMPLETED', 'cancelled': 'CANCELLED', 'unknown': 'PENDING', 'outage': 'PENDING',
+            'fresh': 'PENDING',
+        })
+        paid = Payment.objects.select_related('pet').get(transaction_uuid='k-paid')
+        self.assertEqual((paid.payment_method, paid.transaction_id, paid.pet.status), ('KHALTI', 'KTX1', 'ADOPTED'))
+        self.assertEqual(Payment.objects.get(transaction_uuid='paid').transaction_id, 'ETX1')
+        self.assertEqual(len(self.calls), 7)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_paid_reservations_that_expired_are_completed(self):
+        paid = self.KHALTI['paid']
+        self.KHALTI = {**self.KHALTI, 'late': {**paid, 'transaction_id': 'KTX2'}, 'taken': {**paid, 'transaction_id': 'KTX3'}}
+        self.make_payment('k-late', payment_status='EXPIRED', payment_method='KHALTI', pidx='late')
+        taken = self.make_payment('k-taken', payment_status='EXPIRED', payment_method='KHALTI', pidx='taken')
+        Pet.objects.filter(id=taken.pet_id).update(status='ADOPTED')
+        # Expired long enough ago that no gateway link can still be paid
+        old = self.make_payment('k-old', payment_status='EXPIRED', payment_method='KHALTI', pidx='gone')
+        Payment.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(days=1))
+
+        out = self.reconcile()
+        self.assertIn('Reconciled 9 payments: 3 completed, 1 conflicts', out)
+        statuses = self.statuses()
+        self.assertEqual((statuses['k-late'], statuses['k-taken'], statuses['k-old']), ('COMPLETED', 'FAILED', 'EXPIRED'))
+        late = Payment.objects.select_related('pet').get(transaction_uuid='k-late')
+        self.assertEqual((late.transaction_id, late.pet.status), ('KTX2', 'ADOPTED'))
+        self.assertEqual(len(self.calls), 9)
+
+    def test_resumes_from_the_checkpoint(self):
+        out = self.reconcile('--limit', '3', '--page-size', '2')
+        self.assertIn('Reconciled 3 payments', out)
+        self.assertIn('run again to continue', out)
+        with open(self.checkpoint) as f:
+            last_id = json.load(f)['last_id']
+        self.assertEqual(last_id, Payment.objects.get(transaction_uuid='k-waiting').id)
+
+        out = self.reconcile()
+        self.assertIn(f'Resuming after payment {last_id}', out)
+        self.assertIn('Reconciled 4 payments', out)
+        self.assertEqual({uuid for _, body, _ in self.calls for uuid in [body.get('transaction_uuid')] if uuid}, set(self.ESEWA))
+        self.assertIn('No unresolved payments left', out)
+
+    def test_lookups_run_concurrently(self):
+        started = time.monotonic()
+        self.reconcile('--workers', '8', delay=0.3)
+        # Seven sequential lookups would take over two seconds
+        self.assertLess(time.monotonic() - started, 1.5)
+
+
+class EsewaSigningTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create(username='buyer', email='buyer@gmail.com')
+        self.payment = Payment.objects.create(
+            user=self.user, pet=make_pet(), amount=1000, payment_method='PENDING',
+            payment_status='PENDING', transaction_uuid='abc123',
+        )
+
+    def test_there_is_no_public_signing_endpoint(self):
+        message = esewa.form_message('1', 'abc123')
+        response = self.client.post('/payment/esewa/signature/', {'message': message}, content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_initiation_allocates_a_new_uuid_per_attempt(self):
+        self.client.force_login(self.user)
+        url = reverse('payment:esewa_initiate')
+        first = self.client.post(url, {'payment_id': self.payment.id}, content_type='application/json').json()
+        second = self.client.post(url, {'payment_id': self.payment.id}, content_type='application/json').json()
+        self.assertNotEqual(first['transaction_uuid'], second['transaction_uuid'])
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.transaction_uuid, second['transaction_uuid'])
+        message = esewa.signed_message(second, second['signed_field_names'].split(','))
+        self.assertEqual(message, esewa.form_message('1000.00', second['transaction_uuid']))
+        self.assertEqual(second['signature'], esewa.sign(message))
+
+    def test_initiation_is_limited_to_the_owner_and_open_payments(self):
+        url = reverse('payment:esewa_initiate')
+        self.client.force_login(CustomUser.objects.create(username='other', email='other@gmail.com'))
+        self.assertEqual(self.client.post(url, {'payment_id': self.payment.id}, content_type='application/json').status_code, 404)
+        self.client.force_login(self.user)
+        Payment.objects.update(payment_status='COMPLETED')
+        self.assertEqual(self.client.post(url, {'payment_id': self.payment.id}, content_type='application/json').status_code, 409)
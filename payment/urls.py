@@ -7,7 +7,8 @@ urlpatterns = [
     path('payment/<int:pet_id>/', views.payment_page, name='payment_page'),
     path('khalti/verify/', views.khalti_verify, name='khalti_verify'),
     path('esewa/verify/', views.esewa_verify, name='esewa_verify'),
-    path('esewa/signature/', views.get_esewa_signature, name='get_esewa_signature'),
+    path('esewa/initiate/', views.esewa_initiate, name='esewa_initiate'),
     path('success/', views.payment_success, name='payment_success'),
     path('failed/', views.payment_failed, name='payment_failed'),
+    path('gateway-stats/', views.gateway_stats, name='gateway_stats'),
 ]
\ No newline at end of file
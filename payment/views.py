@@ -1,18 +1,19 @@
 import json
 import uuid
-import hmac
-import hashlib
-import base64
 import requests
 from django.views.decorators.http import require_POST
 from django.shortcuts import render, redirect, get_object_or_404
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.conf import settings
 from django.urls import reverse
 from .models import Payment
+from .services import DuplicateTransaction, PetReserved, reserve_pet
+from . import esewa, gateways
+from .tasks import verify_esewa_payment
 from breed_finder.models import Pet
 
 @login_required
@@ -22,17 +23,13 @@ def payment_page(request, pet_id):
         messages.error(request, 'This pet is not available for adoption.')
         return redirect('breed_finder:pet_detail', pet_id=pet_id)
 
-    # Create a pending payment record with a unique transaction ID
-    # Format the UUID as a string without dashes to avoid eSewa validation issues
-    unique_id = str(uuid.uuid4()).replace('-', '')[:20]
-    payment = Payment.objects.create(
-        user=request.user,
-        pet=pet,
-        amount=pet.price,  # Use the pet's price from the model
-        payment_method='PENDING',
-        payment_status='PENDING',
-        transaction_uuid=unique_id
-    )
+    # Reuse this user's reservation on reloads instead of creating a payment per view
+    try:
+        payment = reserve_pet(request.user, pet)
+    except PetReserved:
+        messages.error(request, 'Another adopter is checking out this pet. Please try again in a few minutes.')
+        return redirect('breed_finder:pet_detail', pet_id=pet_id)
+    unique_id = payment.transaction_uuid
 
     # Build eSewa success and failure URLs with the transaction UUID
     esewa_success_url = request.build_absolute_uri(reverse('payment:esewa_verify') + f'?oid={unique_id}')
@@ -60,7 +57,6 @@ def khalti_verify(request):
             payment = get_object_or_404(Payment, id=payment_id)
 
             # Initiate Khalti payment
-            url = "https://a.khalti.com/api/v2/epayment/initiate/"
             payload = {
                 "return_url": request.build_absolute_uri(reverse('payment:payment_success')),
                 "website_url": request.build_absolute_uri('/'),
@@ -79,7 +75,17 @@ def khalti_verify(request):
                 "Content-Type": "application/json"
             }
             
-            response = requests.post(url, json=payload, headers=headers)
+            try:
+                response = gateways.khalti().post('epayment/initiate/', json=payload, headers=headers)
+                if response.status_code >= 500:
+                    response.raise_for_status()
+            except requests.RequestException as e:
+                # Khalti is down, slow or erroring: keep the payment so the user can retry
+                print(f"Khalti initiation failed: {str(e)}")
+                return JsonResponse({
+                    'success': False,
+                    'message': 'Khalti is not reachable right now. Please try again in a moment.'
+                }, status=503)
             
             if response.status_code == 200:
                 response_data = response.json()
@@ -87,7 +93,7 @@ def khalti_verify(request):
                 payment.payment_status = 'INITIATED'
                 payment.pidx = response_data.get('pidx')
                 payment.payment_url = response_data.get('payment_url')
-                payment.save()
+                payment.save(update_fields=['payment_method', 'payment_status', 'pidx', 'payment_url', 'updated_at'])
 
                 return JsonResponse({
                     'success': True,
@@ -97,7 +103,7 @@ def khalti_verify(request):
             return JsonResponse({
                 'success': False,
                 'message': 'Payment initiation failed',
-                'details': response.json() if response.status_code != 500 else 'Internal Server Error'
+                'details': response.json()
             })
 
         except Exception as e:
@@ -109,63 +115,31 @@ def khalti_verify(request):
     
     return redirect('payment:payment_failed')
 
-@csrf_exempt
+@login_required
 @require_POST
-def get_esewa_signature(request):
+def esewa_initiate(request):
+    """Give the payment a fresh transaction UUID and return the signed eSewa form fields."""
     try:
-        # Parse the request body
-        data = json.loads(request.body)
-        message = data.get('message')
-        api_version = data.get('api_version', 'v2')  # Default to v2 API
-        payment_id = data.get('payment_id')
-        
-        if not message:
-            return JsonResponse({'success': False, 'error': 'Message is required'})
-        
-        # If payment_id is provided, update the transaction_uuid to ensure uniqueness
-        if payment_id:
-            try:
-                payment = Payment.objects.get(id=payment_id)
-                # Generate a new transaction UUID if this is a retry or the payment failed
-                if payment.payment_status == 'FAILED' or payment.payment_status == 'PENDING':
-                    # Generate a new UUID without dashes and limit to 20 chars
-                    new_uuid = str(uuid.uuid4()).replace('-', '')[:20]
-                    payment.transaction_uuid = new_uuid
-                    payment.save()
-                    print(f"Generated new transaction UUID for payment {payment_id}: {new_uuid}")
-                    
-                    # Update the message with the new transaction UUID
-                    # Extract the parts of the message
-                    parts = message.split(',')
-                    updated_parts = []
-                    for part in parts:
-                        if part.startswith('transaction_uuid='):
-                            updated_parts.append(f'transaction_uuid={new_uuid}')
-                        else:
-                            updated_parts.append(part)
-                    
-                    message = ','.join(updated_parts)
-            except Payment.DoesNotExist:
-                pass  # Continue with the original message if payment not found
-        
-        # Generate HMAC-SHA256 signature for eSewa v2 API
-        signature = base64.b64encode(
-            hmac.new(
-                settings.ESEWA_SECRET_KEY.encode(),
-                message.encode(),
-                hashlib.sha256
-            ).digest()
-        ).decode()
-        
-        return JsonResponse({
-            'success': True,
-            'signature': signature,
-            'message': message  # Return the possibly updated message
-        })
-    except Exception as e:
-            return JsonResponse({'success': False, 'error': str(e)})
+        payment_id = json.loads(request.body).get('payment_id')
+    except (ValueError, AttributeError):
+        return JsonResponse({'success': False, 'error': 'Invalid request'}, status=400)
+    payment = get_object_or_404(Payment, id=payment_id, user=request.user)
+    if payment.payment_status not in ('PENDING', 'FAILED'):
+        return JsonResponse({'success': False, 'error': 'This payment can no longer be paid'}, status=409)
+
+    # eSewa rejects a transaction UUID it has seen before, so every attempt
+    # gets a new one. Format it without dashes to avoid eSewa validation issues
+    payment.transaction_uuid = str(uuid.uuid4()).replace('-', '')[:20]
+    payment.save(update_fields=['transaction_uuid', 'updated_at'])
 
-    return JsonResponse({'error': 'Invalid request'}, status=400)
+    return JsonResponse({
+        'success': True,
+        'total_amount': str(payment.amount),
+        'transaction_uuid': payment.transaction_uuid,
+        'product_code': settings.ESEWA_MERCHANT_CODE,
+        'signed_field_names': ','.join(esewa.FORM_FIELDS),
+        'signature': esewa.sign(esewa.form_message(payment.amount, payment.transaction_uuid)),
+    })
 
 @csrf_exempt
 def esewa_verify(request):
@@ -196,7 +170,7 @@ def esewa_verify(request):
                         if payment:
                             # Update the transaction UUID to match the one from eSewa
                             payment.transaction_uuid = oid
-                            payment.save()
+                            payment.save(update_fields=['transaction_uuid', 'updated_at'])
                             print(f"Found pending payment {payment.id} for user {request.user.username}, updated transaction_uuid to {oid}")
                         else:
                             # No pending payment found
@@ -217,104 +191,62 @@ def esewa_verify(request):
             # Check if we're in development mode
             if settings.DEBUG:
                 # In development mode, we'll simulate a successful payment
-                payment.payment_method = 'ESEWA'
-                payment.payment_status = 'COMPLETED'
-                payment.transaction_id = 'DEV_' + str(uuid.uuid4())[:8]
-                payment.save()
-                
-                # Update pet status if this is a pet adoption payment
-                if payment.pet:
-                    payment.pet.status = 'ADOPTED'
-                    payment.pet.save()
+                # Completes the payment and adopts the pet in one transaction
+                if not payment.mark_as_completed(method='ESEWA', transaction_id='DEV_' + str(uuid.uuid4())[:8]):
+                    messages.error(request, 'This pet has already been adopted through another payment. Your payment will be refunded.')
+                    return redirect(f"{reverse('payment:payment_failed')}?payment_id={payment.id}")
                 
                 messages.success(request, 'Development Mode: Payment simulated successfully!')
                 return redirect(f"{reverse('payment:payment_success')}?payment_id={payment.id}")
             
-            # For v2 API, we need to decode the data parameter
+            # For v2 API, the signed callback data is verified locally
             if data:
                 try:
-                    # Decode base64 data and parse JSON
-                    decoded_data = json.loads(base64.b64decode(data).decode('utf-8'))
-                    print(f"Decoded eSewa data: {decoded_data}")
-                    
-                    # Check if the status is COMPLETE (case insensitive check)
-                    status = decoded_data.get('status', '')
-                    if status.upper() != 'COMPLETE':
-                        error_msg = f"Payment not completed. Status: {status}"
-                        payment.mark_as_failed(error_msg)
-                        messages.error(request, error_msg)
-                        return redirect('payment:payment_failed')
-                    
-                    # Get the transaction code
-                    refId = decoded_data.get('transaction_code', '')
-                    
-                    # Payment successful
-                    payment.payment_method = 'ESEWA'
-                    payment.payment_status = 'COMPLETED'
-                    payment.transaction_id = refId
-                    payment.save()
-                    
-                    # Update pet status if this is a pet adoption payment
-                    if payment.pet:
-                        payment.pet.status = 'ADOPTED'
-                        payment.pet.save()
-                    
-                    messages.success(request, 'Payment successful!')
-                    return redirect(f"{reverse('payment:payment_success')}?payment_id={payment.id}")
-                except Exception as e:
-                    error_msg = f'Error decoding eSewa data: {str(e)}'
+                    decoded_data = esewa.decode_callback(data)
+                except esewa.InvalidCallback as e:
+                    # A forged or corrupted callback must not touch the payment
+                    print(f"Rejected eSewa callback for oid={oid}: {str(e)}")
+                    return redirect(f"{reverse('payment:payment_failed')}?error=invalid_callback")
+                print(f"Verified eSewa data: {decoded_data}")
+
+                refId = decoded_data['transaction_code']
+                if decoded_data['transaction_uuid'] != payment.transaction_uuid or not esewa.amount_matches(decoded_data, payment.amount):
+                    print(f"eSewa callback for {decoded_data['transaction_uuid']} does not match payment {payment.id}")
+                    return redirect(f"{reverse('payment:payment_failed')}?error=invalid_callback")
+
+                # Check if the status is COMPLETE (case insensitive check)
+                status = decoded_data['status']
+                if status.upper() != 'COMPLETE':
+                    error_msg = f"Payment not completed. Status: {status}"
                     payment.mark_as_failed(error_msg)
                     messages.error(request, error_msg)
                     return redirect('payment:payment_failed')
+
+                # Payment successful
+                try:
+                    completed = payment.mark_as_completed(method='ESEWA', transaction_id=refId)
+                except DuplicateTransaction:
+                    # The same eSewa transaction replayed against another payment
+                    print(f"eSewa transaction {refId} was already used by another payment")
+                    return redirect(f"{reverse('payment:payment_failed')}?error=invalid_callback")
+                if not completed:
+                    messages.error(request, 'This pet has already been adopted through another payment. Your payment will be refunded.')
+                    return redirect(f"{reverse('payment:payment_failed')}?payment_id={payment.id}")
+
+                messages.success(request, 'Payment successful!')
+                return redirect(f"{reverse('payment:payment_success')}?payment_id={payment.id}")
             else:
-                # Fallback to old verification method if data is not provided
-                amt = request.GET.get('amt')
+                # Old callbacks carry only a reference id, which has to be
+                # checked with eSewa. That round-trip happens in the task
+                # worker so the redirect does not wait on eSewa.
                 refId = request.GET.get('refId')  # eSewa's transaction reference
-                
-                # Verify the payment with eSewa
-                url = "https://uat.esewa.com.np/epay/transrec"
-                payload = {
-                    'amt': amt,
-                    'scd': settings.ESEWA_MERCHANT_CODE,
-                    'rid': refId,
-                    'pid': oid,
-                }
-                
-                # Log the verification request for debugging
-                print(f"eSewa verification request: {payload}")
-                
-                try:
-                    response = requests.post(url, payload, timeout=10)
-                    print(f"eSewa verification response: {response.text}")
-                    
-                    if 'Success' in response.text:
-                        # Payment successful
-                        payment.payment_method = 'ESEWA'
-                        payment.payment_status = 'COMPLETED'
-                        payment.transaction_id = refId
-                        payment.save()
-                        
-                        # Update pet status if this is a pet adoption payment
-                        if payment.pet:
-                            payment.pet.status = 'ADOPTED'
-                            payment.pet.save()
-                        
-                        messages.success(request, 'Payment successful!')
-                        return redirect('payment:payment_success')
-                    else:
-                        # Payment failed
-                        error_msg = 'Payment verification failed'
-                        if 'Duplicate' in response.text:
-                            error_msg = 'Duplicate transaction detected. Please try again with a new payment.'
-                        payment.mark_as_failed(error_msg)
-                        messages.error(request, error_msg)
-                        return redirect('payment:payment_failed')
-                except requests.RequestException as req_err:
-                    # Handle request errors (timeout, connection issues, etc.)
-                    error_msg = f'Connection error during payment verification: {str(req_err)}'
-                    payment.mark_as_failed(error_msg)
-                    messages.error(request, 'Payment verification failed due to connection issues. Please try again.')
-                    return redirect('payment:payment_failed')
+                verify_esewa_payment.enqueue(
+                    key=f'esewa-verify:{payment.id}:{refId}',
+                    payment_id=payment.id, ref_id=refId,
+                )
+                messages.info(request, 'We are confirming your payment with eSewa. '
+                                       'Your adoption will be updated shortly.')
+                return redirect('breed_finder:user_profile')
                 
         except Exception as e:
             print(f"eSewa verification error: {str(e)}")
@@ -341,14 +273,9 @@ def payment_success(request):
         
         # If payment found but not marked as completed, update it
         if payment and payment.payment_status != 'COMPLETED':
-            payment.payment_method = 'ESEWA'
-            payment.payment_status = 'COMPLETED'
-            payment.save()
-            
-            # Update pet status if this is a pet adoption payment
-            if payment.pet and payment.pet.status != 'ADOPTED':
-                payment.pet.status = 'ADOPTED'
-                payment.pet.save()
+            if not payment.mark_as_completed(method='ESEWA'):
+                messages.error(request, 'This pet has already been adopted through another payment. Your payment will be refunded.')
+                return redirect(f"{reverse('payment:payment_failed')}?payment_id={payment.id}")
         
         # In development mode, use the development template
         if settings.DEBUG and payment:
@@ -381,6 +308,8 @@ def payment_failed(request):
             context['error_message'] = 'There was an error finding your payment. Please try again.'
         elif error_code == 'not_logged_in':
             context['error_message'] = 'You must be logged in to complete this payment. Please log in and try again.'
+        elif error_code == 'invalid_callback':
+            context['error_message'] = 'We could not verify the response from eSewa. If you were charged, please contact us.'
     
     # Try to find the payment by transaction_uuid or payment_id
     payment = None
@@ -431,3 +360,7 @@ def payment_failed(request):
         context['error_message'] = f'An error occurred while processing your payment: {str(e)}'
     
     return render(request, 'payment/failed.html', context)
+
+@staff_member_required
+def gateway_stats(request):
+    return JsonResponse(gateways.stats())
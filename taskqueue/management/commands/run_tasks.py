@@ -0,0 +1,48 @@
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from taskqueue.runner import run_pending, worker_name
+
+
+class Command(BaseCommand):
+    help = 'Runs queued background tasks until stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the tasks that are due now, then exit')
+        parser.add_argument('--max-tasks', type=int, help='Exit after running this many tasks')
+        parser.add_argument('--sleep', type=float, default=settings.TASKS_POLL_INTERVAL,
+                            help='Seconds to wait when the queue is empty')
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        # Finish the current task on SIGTERM instead of dying mid-run
+        previous_handler = signal.signal(signal.SIGTERM, self.stop)
+
+        worker = worker_name()
+        remaining = options['max_tasks']
+        total = 0
+        self.stdout.write(f"Worker {worker} started")
+        try:
+            while not self.stopping:
+                ran = run_pending(worker, limit=1)
+                total += ran
+                if not connection.in_atomic_block:
+                    # Drop broken or expired connections between tasks, as a request would
+                    close_old_connections()
+                if remaining is not None:
+                    remaining -= ran
+                    if remaining <= 0:
+                        break
+                if not ran:
+                    if options['once']:
+                        break
+                    time.sleep(options['sleep'])
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+        self.stdout.write(self.style.SUCCESS(f"Worker {worker} ran {total} tasks"))
+
+    def stop(self, signum, frame):
+        self.stopping = True
@@ -0,0 +1,25 @@
+# Generated by Django 5.0.2 on 2026-10-18 16:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("taskqueue", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="task",
+            name="idempotency_key",
+            field=models.CharField(blank=True, max_length=200, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name="task",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("status__in", ("QUEUED", "RUNNING"))),
+                fields=("idempotency_key",),
+                name="task_active_idempotency_key",
+            ),
+        ),
+    ]
@@ -0,0 +1,45 @@
+from django.db import models
+from django.utils import timezone
+
+
+class Task(models.Model):
+    STATUS_CHOICES = [
+        ('QUEUED', 'Queued'),
+        ('RUNNING', 'Running'),
+        ('DONE', 'Done'),
+        ('FAILED', 'Failed'),
+    ]
+
+    # A key is taken while its task is in one of these states
+    ACTIVE_STATUSES = ('QUEUED', 'RUNNING')
+
+    name = models.CharField(max_length=200)
+    kwargs = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='QUEUED')
+    # Enqueueing twice with the same key returns the existing task until it finishes
+    idempotency_key = models.CharField(max_length=200, null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Next due task for the worker
+            models.Index(fields=['status', 'run_at', 'id'], name='task_status_run_at_idx'),
+        ]
+        constraints = [
+            # Finished tasks release their key, so e.g. an activation email can be sent again
+            models.UniqueConstraint(
+                fields=['idempotency_key'],
+                condition=models.Q(status__in=('QUEUED', 'RUNNING')),
+                name='task_active_idempotency_key',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.name} #{self.id} - {self.status}'
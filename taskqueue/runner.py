@@ -0,0 +1,158 @@
+"""
+A small database-backed task queue.
+
+Slow side effects such as emails, payment gateway re-checks and image
+rendering are stored as Task rows and run by ``manage.py run_tasks``, so
+the request that triggers them can return immediately. No broker is
+needed. Workers claim a task with a conditional UPDATE, so several workers
+can share one database. A task that raises is retried with exponential
+backoff until it has run ``max_attempts`` times. Enqueueing with the
+idempotency key of a task that is still queued or running returns that
+task; once it has finished, the key can be used again.
+
+Tasks are plain functions registered with ``@task`` in an app's tasks.py:
+
+    @task(max_attempts=3)
+    def send_receipt(payment_id):
+        ...
+
+    send_receipt.enqueue(key=f'receipt:{payment.id}', payment_id=payment.id)
+
+Arguments are stored as JSON, so pass ids rather than model instances.
+"""
+import logging
+import os
+import random
+import socket
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+_registry = {}
+
+
+class TaskFunction:
+    def __init__(self, func, name, max_attempts):
+        self.func = func
+        self.name = name
+        self.max_attempts = max_attempts
+
+    def __call__(self, **kwargs):
+        return self.func(**kwargs)
+
+    def enqueue(self, key=None, delay=0, **kwargs):
+        return enqueue(self.name, kwargs, key=key, delay=delay, max_attempts=self.max_attempts)
+
+
+def task(func=None, *, name=None, max_attempts=5):
+    """Register ``func`` as a task; it gains an ``enqueue(key=None, delay=0, **kwargs)`` method."""
+    def register(func):
+        task_name = name or f'{func.__module__}.{func.__qualname__}'
+        wrapped = TaskFunction(func, task_name, max_attempts)
+        _registry[task_name] = wrapped
+        return wrapped
+    return register(func) if func is not None else register
+
+
+def enqueue(name, kwargs=None, key=None, delay=0, max_attempts=5):
+    fields = {
+        'name': name,
+        'kwargs': kwargs or {},
+        'run_at': timezone.now() + timedelta(seconds=delay),
+        'max_attempts': max_attempts,
+    }
+    if key is None:
+        return Task.objects.create(**fields)
+    active = Task.objects.filter(idempotency_key=key, status__in=Task.ACTIVE_STATUSES)
+    queued = active.first()
+    if queued:
+        return queued
+    try:
+        # task_active_idempotency_key decides between concurrent enqueues
+        with transaction.atomic():
+            return Task.objects.create(idempotency_key=key, **fields)
+    except IntegrityError:
+        # The winner may already have finished, in which case enqueue again
+        return active.first() or enqueue(name, kwargs, key=key, delay=delay, max_attempts=max_attempts)
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def retry_delay(attempts):
+    """Seconds before retry number ``attempts``: doubling from TASKS_RETRY_BACKOFF, capped, with jitter."""
+    delay = min(settings.TASKS_RETRY_BACKOFF * 2 ** (attempts - 1), settings.TASKS_RETRY_MAX_DELAY)
+    return delay * random.uniform(1, 1.1)
+
+
+def requeue_stale():
+    # A RUNNING task whose lock is this old belonged to a worker that died
+    stale = Task.objects.filter(
+        status='RUNNING', locked_at__lt=timezone.now() - timedelta(seconds=settings.TASKS_LOCK_TIMEOUT)
+    )
+    stale.filter(attempts__gte=F('max_attempts')).update(
+        status='FAILED', finished_at=timezone.now(), last_error='Worker stopped while running the task'
+    )
+    stale.update(status='QUEUED', locked_by='', locked_at=None)
+
+
+def claim_next(worker=None):
+    """Lock and return the next due task, or None if nothing is due."""
+    worker = worker or worker_name()
+    now = timezone.now()
+    due = Task.objects.filter(status='QUEUED', run_at__lte=now).order_by('run_at', 'id')
+    for task_id in due.values_list('id', flat=True)[:10]:
+        # Only one worker's UPDATE can match while the row is still QUEUED
+        claimed = Task.objects.filter(id=task_id, status='QUEUED').update(
+            status='RUNNING', locked_by=worker, locked_at=now, attempts=F('attempts') + 1
+        )
+        if claimed:
+            return Task.objects.get(id=task_id)
+    return None
+
+
+def run_task(queued):
+    """Run a claimed task and record the outcome; return True if it succeeded."""
+    func = _registry.get(queued.name)
+    try:
+        if func is None:
+            raise LookupError(f'No task is registered as {queued.name}')
+        func(**queued.kwargs)
+    except Exception as e:
+        now = timezone.now()
+        error = traceback.format_exc()
+        if func is None or queued.attempts >= queued.max_attempts:
+            logger.error('Task %s #%s failed for good: %s', queued.name, queued.id, e)
+            Task.objects.filter(id=queued.id).update(status='FAILED', finished_at=now, last_error=error)
+        else:
+            run_at = now + timedelta(seconds=retry_delay(queued.attempts))
+            logger.warning('Task %s #%s failed, retrying at %s: %s', queued.name, queued.id, run_at, e)
+            Task.objects.filter(id=queued.id).update(
+                status='QUEUED', run_at=run_at, locked_by='', locked_at=None, last_error=error
+            )
+        return False
+    Task.objects.filter(id=queued.id).update(status='DONE', finished_at=timezone.now(), last_error='')
+    return True
+
+
+def run_pending(worker=None, limit=None):
+    """Run due tasks until none are left (or ``limit`` ran); return how many ran."""
+    worker = worker or worker_name()
+    requeue_stale()
+    ran = 0
+    while limit is None or ran < limit:
+        queued = claim_next(worker)
+        if queued is None:
+            break
+        run_task(queued)
+        ran += 1
+    return ran
@@ -0,0 +1,119 @@
+import io
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .models import Task
+from .runner import claim_next, enqueue, run_pending, task
+
+calls = []
+
+
+@task(name='taskqueue.tests.record')
+def record(value):
+    calls.append(value)
+
+
+@task(name='taskqueue.tests.flaky', max_attempts=3)
+def flaky(failures):
+    calls.append('attempt')
+    if calls.count('attempt') <= failures:
+        raise ConnectionError('gateway unreachable')
+
+
+@override_settings(TASKS_RETRY_BACKOFF=10, TASKS_RETRY_MAX_DELAY=60, TASKS_LOCK_TIMEOUT=60)
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        calls.clear()
+
+    def make_due(self):
+        Task.objects.filter(status='QUEUED').update(run_at=timezone.now())
+
+    def test_runs_queued_tasks_in_order(self):
+        record.enqueue(value='first')
+        record.enqueue(value='second')
+        record.enqueue(value='later', delay=60)
+        self.assertEqual(run_pending(), 2)
+        self.assertEqual(calls, ['first', 'second'])
+        self.assertEqual(Task.objects.filter(status='DONE').count(), 2)
+        self.assertEqual(Task.objects.get(status='QUEUED').kwargs, {'value': 'later'})
+
+    def test_idempotency_key_enqueues_once_while_active(self):
+        first = record.enqueue(key='welcome:1', value='a')
+        second = record.enqueue(key='welcome:1', value='b')
+        self.assertEqual(first.id, second.id)
+        run_pending()
+        self.assertEqual(calls, ['a'])
+
+    def test_finished_task_releases_its_key(self):
+        record.enqueue(key='welcome:1', value='a')
+        run_pending()
+        # e.g. the user asks for the activation email again
+        again = record.enqueue(key='welcome:1', value='b')
+        self.assertEqual(again.status, 'QUEUED')
+        self.assertEqual(record.enqueue(key='welcome:1', value='c').id, again.id)
+        run_pending()
+        self.assertEqual(calls, ['a', 'b'])
+        self.assertEqual(Task.objects.filter(idempotency_key='welcome:1', status='DONE').count(), 2)
+
+    def test_failures_are_retried_with_backoff(self):
+        queued = flaky.enqueue(failures=1)
+        before = timezone.now()
+        with self.assertLogs('taskqueue.runner', 'WARNING'):
+            run_pending()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), ('QUEUED', 1))
+        self.assertIn('gateway unreachable', queued.last_error)
+        self.assertGreaterEqual(queued.run_at, before + timedelta(seconds=10))
+
+        # Not due yet, so nothing runs
+        self.assertEqual(run_pending(), 0)
+
+        self.make_due()
+        run_pending()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), ('DONE', 2))
+
+    def test_gives_up_after_max_attempts(self):
+        queued = flaky.enqueue(failures=10)
+        delays = []
+        for _ in range(3):
+            self.make_due()
+            started = timezone.now()
+            with self.assertLogs('taskqueue.runner', 'WARNING'):
+                run_pending()
+            queued.refresh_from_db()
+            delays.append((queued.run_at - started).total_seconds())
+        self.assertEqual((queued.status, queued.attempts), ('FAILED', 3))
+        self.assertIsNotNone(queued.finished_at)
+        # 10s, then 20s: the delay doubles between attempts
+        self.assertTrue(10 <= delays[0] < 12 and 20 <= delays[1] < 23)
+
+    def test_unknown_task_fails_without_retry(self):
+        queued = enqueue('taskqueue.tests.missing')
+        with self.assertLogs('taskqueue.runner', 'ERROR'):
+            run_pending()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), ('FAILED', 1))
+
+    def test_a_task_is_claimed_by_one_worker(self):
+        record.enqueue(value='only')
+        self.assertIsNotNone(claim_next('worker-a'))
+        self.assertIsNone(claim_next('worker-b'))
+
+    def test_tasks_of_a_dead_worker_are_requeued(self):
+        record.enqueue(value='orphan')
+        claim_next('dead-worker')
+        Task.objects.update(locked_at=timezone.now() - timedelta(seconds=120))
+        self.assertEqual(run_pending('worker-b'), 1)
+        self.assertEqual(calls, ['orphan'])
+
+    def test_worker_command(self):
+        for value in range(3):
+            record.enqueue(value=value)
+        out = io.StringIO()
+        call_command('run_tasks', '--once', stdout=out)
+        self.assertEqual(calls, [0, 1, 2])
+        self.assertIn('ran 3 tasks', out.getvalue())
@@ -98,7 +98,7 @@ def test_esewa_login():
     print_info("MPIN: 1122 (for mobile app)")
     
     print_info("\nTo test eSewa integration:")
-    print_info("1. Run the Django server: python manage.py runserver 8001")
+    print_info("1. Run the Django server: uvicorn breedchat.asgi:application --reload --port 8001")
     print_info("2. Navigate to a pet's payment page")
     print_info("3. Click 'Pay with eSewa'")
     print_info("4. You should be redirected to the eSewa login page")